@@ -0,0 +1,105 @@
+"""
+Saves per second and websocket group messages of exchange rates saved one by one in a transaction, with
+one message per rate on post_save ("before") vs the batched broadcast on commit ("after").
+
+It runs on its own: the rates are saved in a temporary test database and sent through an in-memory channel
+layer of this process, so neither the database nor the channel layer of the project are used.
+
+    python my_currency/benchmark_broadcast.py --rates 1000 --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'my_currency.settings')
+django.setup()
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from datetime import date, timedelta
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+from default_app.models import Currency, CurrencyExchangeRate
+from default_app.signals import input_created
+
+
+class CountingChannelLayer(InMemoryChannelLayer):
+    group_messages = 0
+
+    async def group_send(self, group, message):
+        CountingChannelLayer.group_messages += 1
+        await super().group_send(group, message)
+
+
+def legacy_input_created(instance, created, **kwargs):
+    # signals.input_created before the batched broadcast: one group message per saved rate,
+    # loading both currencies of the rate
+    if created:
+        async_to_sync(get_channel_layer().group_send)(instance.source_currency.code, {
+            'type': 'new_exchange_rate',
+            'new_exchange_rate': {
+                'source_currency': instance.source_currency.code,
+                'exchanged_currency': instance.exchanged_currency.code,
+                'valuation_date': instance.valuation_date.strftime('%Y-%m-%d'),
+                'rate_value': str(instance.rate_value)
+            }
+        })
+
+
+def save_rates(currency_ids, rates):
+    with transaction.atomic():
+        for day in range(rates):
+            CurrencyExchangeRate.objects.create(
+                source_currency_id=currency_ids[0],
+                exchanged_currency_id=currency_ids[1 + day % 2],
+                valuation_date=date(2000, 1, 1) + timedelta(days=day // 2),
+                rate_value=1 + day / rates
+            )
+
+
+def run(rates, repeat, skip_legacy):
+    currency_ids = [Currency.objects.create(code=code, name=code, symbol=code).id for code in ('EUR', 'USD', 'GBP')]
+    implementations = [('after', False)]
+    if not skip_legacy:
+        implementations.insert(0, ('before', True))
+    for label, legacy in implementations:
+        if legacy:
+            post_save.disconnect(input_created, sender=CurrencyExchangeRate)
+            post_save.connect(legacy_input_created, sender=CurrencyExchangeRate)
+        best_time, CountingChannelLayer.group_messages = None, 0
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                save_rates(currency_ids, rates)
+                elapsed = time.perf_counter() - start
+                best_time = elapsed if best_time is None else min(best_time, elapsed)
+                CurrencyExchangeRate.objects.all().delete()
+        finally:
+            if legacy:
+                post_save.disconnect(legacy_input_created, sender=CurrencyExchangeRate)
+                post_save.connect(input_created, sender=CurrencyExchangeRate)
+        print('%-10s %10d saves in %8.3fs -> %12.0f saves/s' % (label, rates, best_time, rates / best_time if best_time else 0))
+        print('%-10s %10d group messages per %d saved rates' % (label, CountingChannelLayer.group_messages // repeat, rates))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rates', type=int, default=1000, help='Number of exchange rates saved per run')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of runs per implementation (best one is reported)')
+    parser.add_argument('--skip-legacy', action='store_true', help='Only run the current implementation')
+    options = parser.parse_args()
+    test_database_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': '__main__.CountingChannelLayer'}}):
+            run(options.rates, options.repeat, options.skip_legacy)
+    finally:
+        connection.creation.destroy_test_db(test_database_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+from django.apps import apps
+from django.db import transaction
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+from my_currency.settings import RATE_BROADCAST_MAX_BATCH
+from .models import format_rate
+from .recent_rates import recent_rates
+import threading
+import weakref
+
+
+class CurrencyCodeCache:
+    """
+    Currency id -> code of the process, so broadcasting a rate does not load its two currencies.
+    Unknown ids are read with a single query. Saves and deletes of currencies invalidate it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._codes = {}
+
+    def add(self, currency):
+        with self._lock:
+            self._codes[currency.pk] = currency.code
+
+    def get_codes(self, currency_ids):
+        with self._lock:
+            missing_ids = set(currency_ids) - self._codes.keys()
+        if missing_ids:
+            codes = apps.get_model('default_app', 'Currency').objects.filter(pk__in=missing_ids).order_by().values_list('pk', 'code')
+            with self._lock:
+                self._codes.update(codes)
+        with self._lock:
+            return dict(self._codes)
+
+    def invalidate(self):
+        with self._lock:
+            self._codes = {}
+
+
+currency_code_cache = CurrencyCodeCache()
+
+
+class RateBroadcaster:
+    """
+    Sends new exchange rates to the GraphConsumer group of their base currency, in batches.
+
+    Rates saved inside a transaction are buffered and sent once it commits, as one new_exchange_rates
+    message per base currency (of at most max_batch_size rates), so a transaction saving many rates
+    sends a few messages instead of one per rate, and rates that are rolled back are not sent.
+    Rates saved in autocommit mode are sent right away.
+    """
+
+    def __init__(self, max_batch_size=RATE_BROADCAST_MAX_BATCH):
+        self.max_batch_size = max_batch_size
+        self._local = threading.local()
+
+    def add(self, rates):
+        # rates: (source_currency_id, exchanged_currency_id, valuation_date, rate_value) tuples
+        if not transaction.get_connection().in_atomic_block:
+            self.send(rates)
+            return
+        # The pending batch of the thread is only referenced by its on_commit callback, which clears it, and
+        # the rates of every call by a no-op on_commit callback of their own: a rollback dropping callbacks
+        # drops their rates (or the batch, and the next rates start a new one).
+        batch_ref = getattr(self._local, 'batch', None)
+        batch = batch_ref() if batch_ref is not None else None
+        if batch is None:
+            batch = _PendingBatch(self)
+            transaction.on_commit(batch)
+            self._local.batch = weakref.ref(batch)
+        batch_rates = _BatchRates(rates)
+        transaction.on_commit(batch_rates)
+        batch.rates.append(weakref.ref(batch_rates))
+
+    def send(self, rates):
+        channel_layer = get_channel_layer()
+        if channel_layer is None or not rates:
+            return
+        codes = currency_code_cache.get_codes({currency_id for rate in rates for currency_id in rate[:2]})
+        rates_by_base = {}
+        for source_currency_id, exchanged_currency_id, valuation_date, rate_value in rates:
+            rates_by_base.setdefault(codes[source_currency_id], []).append({
+                'source_currency': codes[source_currency_id],
+                'exchanged_currency': codes[exchanged_currency_id],
+                'valuation_date': valuation_date.strftime('%Y-%m-%d'),
+                'rate_value': format_rate(rate_value)
+            })
+        for base_currency_code, base_rates in rates_by_base.items():
+            recent_rates.add(base_currency_code, base_rates)
+            for start in range(0, len(base_rates), self.max_batch_size):
+                async_to_sync(channel_layer.group_send)(base_currency_code, {
+                    'type': 'new_exchange_rates',
+                    'new_exchange_rates': base_rates[start:start + self.max_batch_size]
+                })
+
+
+class _BatchRates:
+    # Rates added to a pending batch, alive until their on_commit callback is run or dropped
+
+    def __init__(self, rates):
+        self.rates = rates
+
+    def __call__(self):
+        pass
+
+
+class _PendingBatch:
+    # The on_commit callback sending the rates saved in a transaction that were not rolled back
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.rates = []
+
+    def __call__(self):
+        self.broadcaster._local.batch = None
+        rates = [batch_rates() for batch_rates in self.rates]
+        self.broadcaster.send([rate for batch_rates in rates if batch_rates is not None for rate in batch_rates.rates])
+
+
+rate_broadcaster = RateBroadcaster()
@@ -0,0 +1,85 @@
+from django.db import transaction
+from .models import Currency, CurrencyExchangeRate
+from datetime import date
+import time
+
+
+IMPORT_BATCH_SIZE = 5000
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ExchangeRatesImporter:
+    """
+    Set-based import of exchange rates ({"source_currency", "exchanged_currency", "valuation_date",
+    "rate_value"} items), as import_exchange_rates does.
+
+    Currency codes are resolved through a code -> id map loaded once (unknown codes are created with the
+    code only), and every batch is stored with one bulk upsert inside its own transaction. Items whose
+    (source, exchanged, date) already existed, in the database or earlier in the input, are counted as
+    already existed and their rate is updated.
+    """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.currency_ids = None
+
+    def _add_currencies(self, codes):
+        missing_codes = codes - self.currency_ids.keys()
+        if missing_codes:
+            Currency.objects.bulk_create([Currency(code=code) for code in missing_codes], ignore_conflicts=True)
+            self.currency_ids.update(Currency.objects.filter(code__in=missing_codes).order_by().values_list('code', 'id'))
+
+    def _import_batch(self, items):
+        # Returns how many items of the batch already existed
+        self._add_currencies({item['source_currency'] for item in items} | {item['exchanged_currency'] for item in items})
+        rates = {}
+        for item in items:
+            key = (
+                self.currency_ids[item['source_currency']],
+                self.currency_ids[item['exchanged_currency']],
+                date.fromisoformat(item['valuation_date'])
+            )
+            rates[key] = item['rate_value']
+        existing_keys = set(CurrencyExchangeRate.objects.filter(
+            source_currency_id__in={key[0] for key in rates},
+            valuation_date__in={key[2] for key in rates}
+        ).order_by().values_list('source_currency_id', 'exchanged_currency_id', 'valuation_date'))
+        CurrencyExchangeRate.objects.bulk_upsert([
+            CurrencyExchangeRate(
+                source_currency_id=source_currency_id,
+                exchanged_currency_id=exchanged_currency_id,
+                valuation_date=valuation_date,
+                rate_value=rate_value
+            )
+            for (source_currency_id, exchanged_currency_id, valuation_date), rate_value in rates.items()
+        ])
+        return len(items) - len(rates) + len(existing_keys & rates.keys())
+
+    def import_items(self, items, on_batch=None):
+        # on_batch(stats) is called after every stored batch, e.g. to report progress
+        start = time.perf_counter()
+        self.currency_ids = dict(Currency.objects.order_by().values_list('code', 'id'))
+        stats = {'imported': 0, 'already_existed': 0, 'seconds': 0, 'rates_per_second': 0}
+        for batch in iter_batches(items, self.batch_size):
+            with transaction.atomic():
+                stats['already_existed'] += self._import_batch(batch)
+            stats['imported'] += len(batch)
+            self._update_throughput(stats, start)
+            if on_batch:
+                on_batch(stats)
+        self._update_throughput(stats, start)
+        return stats
+
+    def _update_throughput(self, stats, start):
+        stats['seconds'] = time.perf_counter() - start
+        stats['rates_per_second'] = stats['imported'] / stats['seconds'] if stats['seconds'] else 0
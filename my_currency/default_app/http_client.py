@@ -0,0 +1,110 @@
+from my_currency.settings import PROVIDER_TIMEOUT_IN_SECONDS, PROVIDER_HTTP_POOL_SIZE, PROVIDER_HTTP_RETRIES, PROVIDER_HTTP_BACKOFF_FACTOR
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import threading
+
+
+class ProviderHttpClient:
+    """
+    HTTP client shared by all the providers of the process.
+
+    It keeps one requests.Session per provider host, so connections (and TLS sessions) are
+    kept alive and reused between calls instead of opening a new one per request. Requests
+    get a default timeout and are retried with exponential backoff on connection errors and
+    5xx answers. Read timeouts are not retried, so a slow provider holds the caller for one
+    timeout, not retries + 1 of them.
+    """
+
+    def __init__(self, pool_size=PROVIDER_HTTP_POOL_SIZE, timeout=PROVIDER_TIMEOUT_IN_SECONDS,
+                 retries=PROVIDER_HTTP_RETRIES, backoff_factor=PROVIDER_HTTP_BACKOFF_FACTOR):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self.requests_count = 0
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(
+                total=self.retries,
+                read=False,
+                backoff_factor=self.backoff_factor,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            )
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _get_session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self._create_session()
+            return self._sessions[host]
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.requests_count += 1
+        return self._get_session(url).get(url, **kwargs)
+
+    def get_stats(self):
+        # Requests sent and connections opened so far; reuse rate is the share of requests without a new connection
+        connections_count = 0
+        with self._lock:
+            sessions = list(self._sessions.values())
+            requests_count = self.requests_count
+        for session in sessions:
+            pools = session.get_adapter('http://').poolmanager.pools
+            connections_count += sum(pools[key].num_connections for key in pools.keys())
+        return {
+            'requests': requests_count,
+            'connections': connections_count,
+            'reuse_rate': 1 - connections_count / requests_count if requests_count else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+
+http_client = ProviderHttpClient()
+
+
+class ThreadPoolHttpClient:
+    """
+    Awaitable wrapper of a ProviderHttpClient for the async views. It is not an async HTTP client:
+    every request is sent by the wrapped client (same sessions, timeout and retries) in a pool of
+    pool_size threads, and holds one of them until it answers or times out. It only keeps the
+    event loop free while waiting for the provider.
+    """
+
+    def __init__(self, client=http_client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.client.pool_size, thread_name_prefix='provider-http')
+            return self._executor
+
+    async def get(self, url, **kwargs):
+        return await sync_to_async(self.client.get, thread_sensitive=False, executor=self._get_executor())(url, **kwargs)
+
+
+thread_pool_http_client = ThreadPoolHttpClient()
@@ -0,0 +1,35 @@
+import threading
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:
+    TcpFakeServer = None
+
+
+class LocalRedisServer:
+    """
+    Redis-protocol server on 127.0.0.1 (fakeredis, in a thread of this process), standing in for a Redis
+    server in tests and benchmarks of the Redis channel layers (see CHANNEL_LAYERS_REDIS_URL).
+
+    It answers real Redis connections, so channel layers of other processes can use its url too. Lua
+    scripting (needed by the 'core' backend) only works with lupa installed.
+    """
+
+    def __init__(self):
+        if TcpFakeServer is None:
+            raise RuntimeError('The local Redis server needs fakeredis (pip install fakeredis)')
+        self._server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:{}/0'.format(self._server.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,339 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.conf import settings
+from django.test import AsyncClient, Client, override_settings
+from django.urls import path, re_path
+from asgiref.sync import async_to_sync
+from default_app.models import Currency, CurrencyExchangeRate, Provider
+from default_app.providers import StoredDataProvider
+from default_app.provider_registry import provider_chain_registry
+from default_app.views import currency_converter, acurrency_converter
+from default_app.recent_rates import recent_rates
+from default_app.websocket import GraphConsumer
+from default_app.local_redis_server import LocalRedisServer
+from default_app.management.commands.fill_database_with_random_data import get_currency_codes
+from my_currency.settings import CHANNEL_LAYERS_REDIS_BACKENDS, CHANNEL_LAYERS_REDIS_BACKEND
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from contextlib import ExitStack
+from datetime import date
+from default_app.http_client import ProviderHttpClient
+from default_app.stub_provider_server import StubProviderServer
+from requests import get as requests_get
+import asyncio
+import itertools
+import random
+import time
+
+
+def legacy_rates_dict_timeseries(base_currency_code, date_from, date_to):
+    # StoredDataProvider.get_rates_dict_timeseries before the columnar fetch, kept
+    # as the "before" reference: one model instance and one FK query per row.
+    rates = {}
+    base_currency_object = Currency.objects.all().filter(code=base_currency_code).first()
+    if not base_currency_object:
+        return rates
+    for rate in base_currency_object.exchanges.filter(
+        valuation_date__gte=date_from,
+        valuation_date__lte=date_to
+    ):
+        date_key = rate.valuation_date.strftime("%Y-%m-%d")
+        if date_key not in rates:
+            rates[date_key] = {}
+        rates[date_key][rate.exchanged_currency.code] = float(rate.rate_value)
+    return rates
+
+
+class SyncViewsUrlconf:
+    urlpatterns = [re_path(r'^v1/calculate-exchange/', currency_converter)]
+
+
+class AsyncViewsUrlconf:
+    urlpatterns = [re_path(r'^v1/calculate-exchange/', acurrency_converter)]
+
+
+class Command(BaseCommand):
+    help = 'Runs a performance benchmark against the data currently in the database'
+
+    benchmarks = ('timeseries', 'http_client', 'batch_conversion', 'rate_decode', 'async_views', 'ws_fanout', 'ws_throttling', 'graph_history')
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', type=str, choices=self.benchmarks, help='Name of the benchmark to run')
+        parser.add_argument('base_currency_code', type=str, nargs='?', default='EUR', help='3 letter code of the base currency (default EUR)')
+        parser.add_argument('--date-from', type=str, default='1900-01-01', help='Day string with format yyyy-mm-dd')
+        parser.add_argument('--date-to', type=str, default='2100-01-01', help='Day string with format yyyy-mm-dd')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of runs per implementation (best one is reported)')
+        parser.add_argument('--requests', type=int, default=500, help='Number of HTTP requests for the http_client and async_views benchmarks, of conversions for batch_conversion, and of page loads for graph_history')
+        parser.add_argument('--connections', type=int, default=1000, help='Number of websocket connections opened by the ws_fanout benchmark')
+        parser.add_argument('--groups', type=int, default=1, help='Number of base currency groups the ws_fanout connections are spread over')
+        parser.add_argument('--messages', type=int, default=100, help='Number of messages sent to every group by the ws_fanout benchmark, and by the feed of ws_throttling')
+        parser.add_argument('--feed-rate', type=float, default=500, help='Messages per second of the feed of the ws_throttling benchmark')
+        parser.add_argument('--redis-url', type=str, default=None, help='Redis server of the channel layer for ws_fanout, or "local" to start a local one (needs fakeredis). Without it the configured channel layer is used')
+        parser.add_argument('--delay', type=float, default=0.05, help='Seconds the stub provider of the async_views benchmark takes to answer')
+        parser.add_argument('--skip-legacy', action='store_true', help='Do not run the implementation before the optimization (it can be very slow on big tables)')
+
+    def _time(self, function, repeat):
+        best_time, result = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        return best_time, result
+
+    def _report(self, label, elapsed, count, unit='rows'):
+        self.stdout.write('%-10s %10d %s in %8.3fs -> %12.0f %s/s' % (label, count, unit, elapsed, count / elapsed if elapsed else 0, unit))
+
+    def handle(self, *args, **options):
+        getattr(self, 'benchmark_' + options['benchmark'])(**options)
+
+    def benchmark_timeseries(self, base_currency_code, date_from, date_to, repeat, skip_legacy, **options):
+        implementations = [('after', lambda: StoredDataProvider().get_rates_dict_timeseries(base_currency_code, date_from, date_to))]
+        if not skip_legacy:
+            implementations.insert(0, ('before', lambda: legacy_rates_dict_timeseries(base_currency_code, date_from, date_to)))
+        results = []
+        for label, function in implementations:
+            elapsed, rates = self._time(function, repeat)
+            self._report(label, elapsed, sum(len(day_rates) for day_rates in rates.values()))
+            results.append(rates)
+        if len(results) == 2 and results[0] != results[1]:
+            self.stderr.write(self.style.ERROR('Implementations returned different timeseries'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Finished timeseries benchmark for %s' % base_currency_code))
+
+    def benchmark_http_client(self, base_currency_code, requests, repeat, skip_legacy, **options):
+        # Against a local stub provider: a new connection per request (module-level requests.get)
+        # vs the keep-alive pool of ProviderHttpClient
+        routes = {'latest': {'json': {'success': True, 'base': base_currency_code, 'rates': {'USD': 1.1}}}}
+        with StubProviderServer(routes) as server:
+            url = server.base_url + '/latest?base=' + base_currency_code
+            if not skip_legacy:
+                elapsed, _ = self._time(lambda: [requests_get(url).json() for _ in range(requests)], repeat)
+                self._report('before', elapsed, requests, 'requests')
+            client = ProviderHttpClient()
+            elapsed, _ = self._time(lambda: [client.get(url).json() for _ in range(requests)], repeat)
+            self._report('after', elapsed, requests, 'requests')
+            stats = client.get_stats()
+            client.close()
+        self.stdout.write('Pooled client: %(requests)s requests over %(connections)s connections (reuse rate %(reuse_rate).4f)' % stats)
+        self.stdout.write(self.style.SUCCESS('Finished http_client benchmark'))
+
+    def benchmark_batch_conversion(self, base_currency_code, requests, repeat, skip_legacy, **options):
+        # N calls to /v1/calculate-exchange/ vs one call to /v1/calculate-exchange/batch/ with N items,
+        # through the whole Django stack (without network), from the latest stored rates of the base currency
+        exchanged_currencies = list(StoredDataProvider().get_latest_rates_dict(base_currency_code))
+        if not exchanged_currencies:
+            raise CommandError('There are no stored rates from %s, fill the database first' % base_currency_code)
+        items = [
+            {'source_currency': base_currency_code, 'exchanged_currency': exchanged_currencies[index % len(exchanged_currencies)], 'amount': index + 1}
+            for index in range(requests)
+        ]
+        client = Client()
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            if not skip_legacy:
+                elapsed, _ = self._time(lambda: [client.get('/v1/calculate-exchange/', data=item).json() for item in items], repeat)
+                self._report('before', elapsed, requests, 'conversions')
+            elapsed, response = self._time(lambda: client.post('/v1/calculate-exchange/batch/', data={'items': items}, content_type='application/json'), repeat)
+            self._report('after', elapsed, requests, 'conversions')
+        if response.status_code != 200 or not all(result['success'] for result in response.json()['results']):
+            self.stderr.write(self.style.ERROR('Batch conversion failed for some items'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Finished batch_conversion benchmark for %s' % base_currency_code))
+
+    def benchmark_rate_decode(self, base_currency_code, date_from, date_to, repeat, skip_legacy, **options):
+        # Reading the rates of the base currency in the period as floats: a Decimal per row from
+        # rate_value vs whole chunks of rate_value_scaled converted at once
+        rates = CurrencyExchangeRate.objects.filter(
+            source_currency__code=base_currency_code,
+            valuation_date__gte=date_from,
+            valuation_date__lte=date_to
+        ).order_by()
+        implementations = [('after', True)]
+        if not skip_legacy:
+            implementations.insert(0, ('before', False))
+        results = []
+        for label, scaled in implementations:
+            elapsed, result = self._time(lambda: [rate for _, chunk_rates in rates.iter_rate_chunks(scaled=scaled) for rate in chunk_rates], repeat)
+            self._report(label, elapsed, len(result))
+            results.append(result)
+        if len(results) == 2 and results[0] != results[1]:
+            self.stderr.write(self.style.ERROR('Implementations decoded different rates, fill rate_value_scaled first'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Finished rate_decode benchmark for %s' % base_currency_code))
+
+    def benchmark_async_views(self, base_currency_code, requests, repeat, skip_legacy, delay, **options):
+        # --requests concurrent calls to /v1/calculate-exchange/ through Django's ASGI handler, every one
+        # fetching the latest rates of a different base currency from a local stub provider that answers
+        # after --delay seconds: the sync DRF view (sync views share a single thread under ASGI) vs the
+        # async view. The provider is created in a transaction that is rolled back.
+        routes = {'latest': {'delay': delay, 'json': {'success': True, 'base': base_currency_code, 'rates': {'USD': 1.1}}}}
+        runs = itertools.count()
+        implementations = [('after', AsyncViewsUrlconf)]
+        if not skip_legacy:
+            implementations.insert(0, ('before', SyncViewsUrlconf))
+        with StubProviderServer(routes) as server, transaction.atomic():
+            Provider.objects.create(name='benchmark stub', access_key='key', latest_endpoint=server.base_url + '/latest?access_key={0}&base={1}')
+            try:
+                for label, urlconf in implementations:
+                    with override_settings(ALLOWED_HOSTS=['testserver'], ROOT_URLCONF=urlconf):
+                        elapsed, responses = self._time(lambda: async_to_sync(self._get_concurrently)(next(runs), requests), repeat)
+                    self._report(label, elapsed, requests, 'requests')
+            finally:
+                transaction.set_rollback(True)
+                provider_chain_registry.invalidate()
+        if not all(response.status_code == 200 for response in responses):
+            self.stderr.write(self.style.ERROR('Some requests failed'))
+        else:
+            self.stdout.write(self.style.SUCCESS('Finished async_views benchmark (%s requests at once, provider delay %ss)' % (requests, delay)))
+
+    async def _get_concurrently(self, run, requests):
+        # Base currencies are made up per request, so no answer comes from the cache
+        client = AsyncClient()
+        return await asyncio.gather(*(
+            client.get('/v1/calculate-exchange/', data={'source_currency': 'R%sB%s' % (run, index), 'exchanged_currency': 'USD', 'provider': 'benchmark stub'})
+            for index in range(requests)
+        ))
+
+    def benchmark_ws_fanout(self, base_currency_code, connections, groups, messages, redis_url, **options):
+        # --connections websockets to ws/graph/ spread over --groups base currency groups (the base currency
+        # and made-up ones), and --messages rates sent to every group one round at a time: latency from
+        # group_send to every connection of the group receiving the rate, and messages per second per group.
+        # The connections are served by this process, through the configured channel layer or the Redis
+        # channel layer of --redis-url.
+        group_codes = [base_currency_code] + get_currency_codes(base_currency_code, groups - 1)
+        with ExitStack() as stack:
+            if redis_url == 'local':
+                redis_url = stack.enter_context(LocalRedisServer()).url
+            if redis_url:
+                stack.enter_context(override_settings(CHANNEL_LAYERS={'default': {
+                    'BACKEND': CHANNEL_LAYERS_REDIS_BACKENDS[CHANNEL_LAYERS_REDIS_BACKEND],
+                    'CONFIG': {'hosts': [redis_url]},
+                }}))
+            backend = settings.CHANNEL_LAYERS['default']['BACKEND'].rsplit('.', 1)[-1]
+            elapsed, latencies = async_to_sync(self._fan_out)(group_codes, connections, messages)
+        latencies.sort()
+        self.stdout.write('%s, %d connections in %d groups' % (backend, connections, len(group_codes)))
+        self._report('per group', elapsed, messages, 'messages')
+        self._report('all', elapsed, len(latencies), 'frames')
+        self.stdout.write('latency    p50 %.2fms, p99 %.2fms, max %.2fms' % tuple(
+            1000 * latencies[int(quantile * (len(latencies) - 1))] for quantile in (0.5, 0.99, 1)
+        ))
+        self.stdout.write(self.style.SUCCESS('Finished ws_fanout benchmark'))
+
+    async def _fan_out(self, group_codes, connections, messages):
+        application = URLRouter([path('ws/graph/', GraphConsumer.as_asgi())])
+        communicators = [
+            WebsocketCommunicator(application, 'ws/graph/?base_currency=' + group_codes[index % len(group_codes)])
+            for index in range(connections)
+        ]
+        await asyncio.gather(*(communicator.connect(30) for communicator in communicators))
+        # Redis subscriptions of the groups are not acknowledged, give them time before the first message
+        await asyncio.sleep(0.5)
+        channel_layer = get_channel_layer()
+
+        async def receive(communicator):
+            await communicator.receive_json_from(30)
+            return time.perf_counter()
+
+        latencies = []
+        start = time.perf_counter()
+        try:
+            for sequence in range(messages):
+                sent = time.perf_counter()
+                await asyncio.gather(*(channel_layer.group_send(code, {'type': 'new_exchange_rates', 'new_exchange_rates': [{
+                    'source_currency': code,
+                    'exchanged_currency': 'USD',
+                    'valuation_date': '2000-01-01',
+                    'rate_value': str(sequence)
+                }]}) for code in group_codes))
+                latencies.extend(received - sent for received in await asyncio.gather(*(receive(communicator) for communicator in communicators)))
+            elapsed = time.perf_counter() - start
+        finally:
+            await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+            await channel_layer.flush()
+        return elapsed, latencies
+
+    def benchmark_ws_throttling(self, base_currency_code, messages, feed_rate, **options):
+        # A synthetic feed of --messages rates of the base currency at --feed-rate messages per second (a
+        # random walk per default currency, on the same day) to websockets with different subscription
+        # options: the frames and bytes per second every client receives
+        subscriptions = [
+            ('every rate', ''),
+            ('max_rate=10', '&max_rate=10'),
+            ('+conflate', '&max_rate=10&conflate=true'),
+            ('+delta', '&max_rate=10&conflate=true&format=delta'),
+        ]
+        elapsed, received = async_to_sync(self._feed)(base_currency_code, [query for _, query in subscriptions], messages, feed_rate)
+        for (label, _), frames in zip(subscriptions, received):
+            self.stdout.write('%-12s %8.0f frames/s %10.0f bytes/s' % (label, len(frames) / elapsed, sum(len(frame) for frame in frames) / elapsed))
+        self.stdout.write(self.style.SUCCESS('Finished ws_throttling benchmark (%s messages in %.3fs)' % (messages, elapsed)))
+
+    async def _feed(self, base_currency_code, query_strings, messages, feed_rate):
+        application = URLRouter([path('ws/graph/', GraphConsumer.as_asgi())])
+        communicators = [WebsocketCommunicator(application, 'ws/graph/?base_currency=' + base_currency_code + query) for query in query_strings]
+        await asyncio.gather(*(communicator.connect(30) for communicator in communicators))
+        channel_layer = get_channel_layer()
+        codes = get_currency_codes(base_currency_code, None)
+        rng = random.Random(0)
+        rates = dict.fromkeys(codes, 1.0)
+        valuation_date = date.today().isoformat()
+        start = time.perf_counter()
+        for sequence in range(messages):
+            code = rng.choice(codes)
+            rates[code] *= 1 + rng.gauss(0, 0.0005)
+            await channel_layer.group_send(base_currency_code, {'type': 'new_exchange_rates', 'new_exchange_rates': [{
+                'source_currency': base_currency_code,
+                'exchanged_currency': code,
+                'valuation_date': valuation_date,
+                'rate_value': '%.6f' % rates[code]
+            }]})
+            await asyncio.sleep(max(0, start + (sequence + 1) / feed_rate - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        # The last throttled frames are sent after the feed
+        await asyncio.sleep(0.2)
+        received = []
+        for communicator in communicators:
+            frames = []
+            while not communicator.output_queue.empty():
+                frames.append(communicator.output_queue.get_nowait()['text'])
+            received.append(frames)
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+        await channel_layer.flush()
+        return elapsed, received
+
+    def benchmark_graph_history(self, base_currency_code, requests, repeat, skip_legacy, **options):
+        # --requests loads of the history graph page for the first stored pair of the base currency, one after
+        # the other: the websocket plus the history from /v1/calculate-exchange-twrr/ (through the Django
+        # stack, without network) vs the websocket sending the history as its snapshot
+        pair = CurrencyExchangeRate.objects.filter(source_currency__code=base_currency_code).values_list('exchanged_currency__code', flat=True).first()
+        if pair is None:
+            raise CommandError('There are no stored rates of %s' % base_currency_code)
+        implementations = [('after', True)]
+        if not skip_legacy:
+            implementations.insert(0, ('before', False))
+        for label, snapshot in implementations:
+            recent_rates.invalidate()
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                elapsed, points = self._time(lambda: async_to_sync(self._load_graph_pages)(base_currency_code, pair, requests, snapshot), repeat)
+            self._report(label, elapsed, requests, 'loads')
+        self.stdout.write(self.style.SUCCESS('Finished graph_history benchmark for %s/%s (%s points)' % (base_currency_code, pair, points)))
+
+    async def _load_graph_pages(self, base_currency_code, exchanged_currency_code, requests, snapshot):
+        application = URLRouter([path('ws/graph/', GraphConsumer.as_asgi())])
+        query = 'base_currency=%s&exchanged_currency=%s&max_rate=2' % (base_currency_code, exchanged_currency_code)
+        client = AsyncClient()
+        for _ in range(requests):
+            communicator = WebsocketCommunicator(application, 'ws/graph/?' + query + ('&snapshot_from=1900-01-01' if snapshot else ''))
+            await communicator.connect(30)
+            if snapshot:
+                frame = await communicator.receive_json_from(30)
+                if not frame['complete']:
+                    # The page would request the history over HTTP too
+                    raise CommandError('The snapshot of %s/%s is not complete' % (base_currency_code, exchanged_currency_code))
+                points = len(frame['snapshot'])
+            else:
+                response = await client.get('/v1/calculate-exchange-twrr/', data={'source_currency': base_currency_code, 'exchanged_currency': exchanged_currency_code})
+                points = len(response.json()['values'])
+            await communicator.disconnect()
+        return points
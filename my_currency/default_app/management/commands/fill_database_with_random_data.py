@@ -1,9 +1,37 @@
-import json
 from django.core.management.base import BaseCommand
-from default_app.models import Currency, CurrencyExchangeRate
+from default_app.models import RATE_SCALE, Currency, CurrencyExchangeRate, rates_bulk_deleted, rates_bulk_saved
 from datetime import datetime, timedelta
-import random
-from django.db import transaction
+from itertools import product
+from string import ascii_uppercase
+from django.db import connection, transaction
+import numpy as np
+
+
+DEFAULT_CURRENCIES = ['USD', 'EUR', 'GBP', 'JPY', 'AUD', 'CAD', 'CHF', 'CNY']
+# Standard deviation of the daily log-return of every rate
+DAILY_VOLATILITY = 0.005
+BATCH_SIZE = 10000
+
+
+def get_currency_codes(base_currency_code, number_of_currencies):
+    # The default currencies first and then made-up 3 letter codes (AAA, AAB...), never the base currency
+    codes = [code for code in DEFAULT_CURRENCIES if code != base_currency_code]
+    if number_of_currencies is None:
+        return codes
+    letters = (''.join(code) for code in product(ascii_uppercase, repeat=3))
+    codes.extend(code for code in letters if code != base_currency_code and code not in DEFAULT_CURRENCIES)
+    return codes[:number_of_currencies]
+
+
+def iter_random_walk_batches(number_of_days, number_of_currencies, days_per_batch, rng):
+    # Yields (first_day, rates): rates is a (days, currencies) array of the next days of a geometric
+    # random walk per currency, continuing from the last day of the previous batch
+    log_rates = np.log(rng.uniform(0.5, 1.5, number_of_currencies))
+    for first_day in range(0, number_of_days, days_per_batch):
+        days = min(days_per_batch, number_of_days - first_day)
+        walk = log_rates + np.cumsum(rng.normal(0, DAILY_VOLATILITY, (days, number_of_currencies)), axis=0)
+        log_rates = walk[-1]
+        yield first_day, np.round(np.exp(walk), 6)
 
 
 class Command(BaseCommand):
@@ -13,37 +41,55 @@ class Command(BaseCommand):
         parser.add_argument('base_currency_code', type=str, help='3 letter code of the base currency')
         parser.add_argument('number_of_days', type=int, help='Number of days to generate exchange rates for')
         parser.add_argument('erase_data', type=str, help='True/False, if it is True, it will erase all data in the database before creating new data, if it is False, it will only create new data without erasing the old data.')
-
+        parser.add_argument('--currencies', type=int, default=None, help='Number of exchanged currencies (default: %s, except the base currency). Made-up codes are added after them.' % ', '.join(DEFAULT_CURRENCIES))
+        parser.add_argument('--seed', type=int, default=None, help='Seed of the random generator, to create the same rates again')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Number of exchange rates created per transaction (default %s)' % BATCH_SIZE)
 
     def handle(self, *args, **options):
-        all_currencies = ['USD', 'EUR', 'GBP', 'JPY', 'AUD', 'CAD', 'CHF', 'CNY']
         if options['erase_data'] in ('True', 'true', '1', 'yes'):
-            rates_deleted, _ = CurrencyExchangeRate.objects.all().delete()
+            # A single DELETE: QuerySet.delete() would load every rate to send post_delete, and nothing references the rates
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM {}'.format(connection.ops.quote_name(CurrencyExchangeRate._meta.db_table)))
+                rates_deleted = cursor.rowcount
+            rates_bulk_deleted.send(sender=CurrencyExchangeRate)
             currencies_deleted, _ = Currency.objects.all().delete()
             self.stdout.write(self.style.SUCCESS('Successfully cleaned data (%s exchange rates, %s currencies)' % (rates_deleted, currencies_deleted)))
         base_currency_code = options['base_currency_code']
         number_of_days = options['number_of_days']
-        for currency in all_currencies + ([base_currency_code] if base_currency_code not in all_currencies else []):
-            Currency.objects.update_or_create(code=currency, name=currency, symbol=currency)
-        base_currency = Currency.objects.get(code=base_currency_code)
-        today = datetime.now().date()
-        all_rates = []
-        for currency in all_currencies:
-            initial_rate = 0.5 + random.random()
-            if currency == base_currency_code:
-                # initial_rate = 1.0
-                continue
-            exchanged_currency = Currency.objects.get(code=currency)
-            all_rates.extend([
-                CurrencyExchangeRate(
-                    source_currency=base_currency,
-                    exchanged_currency=exchanged_currency,
-                    valuation_date=today - timedelta(days=i),
-                    rate_value=initial_rate + random.uniform(-0.01, 0.01)
-                )
-                for i in range(number_of_days)
-            ])
-        with transaction.atomic():
-            CurrencyExchangeRate.objects.bulk_create(all_rates, ignore_conflicts=True)
-                
-        self.stdout.write(self.style.SUCCESS('Successfully created exchange rates for %s days from %s to %s' % (number_of_days, base_currency_code, all_currencies, )))
+        currency_codes = get_currency_codes(base_currency_code, options['currencies'])
+        all_codes = [base_currency_code] + currency_codes
+        Currency.objects.bulk_create([Currency(code=code, name=code, symbol=code) for code in all_codes], ignore_conflicts=True)
+        currency_ids = dict(Currency.objects.filter(code__in=all_codes).order_by().values_list('code', 'id'))
+        base_currency_id = currency_ids[base_currency_code]
+        exchanged_currency_ids = [currency_ids[code] for code in currency_codes]
+        # The walk goes forward in time and ends today
+        first_date = datetime.now().date() - timedelta(days=number_of_days - 1)
+        days_per_batch = max(1, options['batch_size'] // max(1, len(currency_codes)))
+        rng = np.random.default_rng(options['seed'])
+        created = 0
+        for first_day, rates in iter_random_walk_batches(number_of_days, len(currency_codes), days_per_batch, rng):
+            # The whole batch is scaled at once instead of a Decimal per rate in bulk_create
+            scaled_rates = np.rint(rates * RATE_SCALE).astype(np.int64)
+            dates = [first_date + timedelta(days=first_day + day) for day in range(len(rates))]
+            with transaction.atomic():
+                # Existing rates are left out (and the ones written meanwhile by others ignored), so only the
+                # rates written are broadcast
+                existing = set(CurrencyExchangeRate.objects.filter(
+                    source_currency_id=base_currency_id, valuation_date__range=(dates[0], dates[-1])
+                ).order_by().values_list('exchanged_currency_id', 'valuation_date'))
+                batch = [
+                    CurrencyExchangeRate(
+                        source_currency_id=base_currency_id,
+                        exchanged_currency_id=exchanged_currency_id,
+                        valuation_date=valuation_date,
+                        rate_value=rate_value,
+                        rate_value_scaled=rate_value_scaled
+                    )
+                    for valuation_date, day_rates, day_scaled_rates in zip(dates, rates.tolist(), scaled_rates.tolist())
+                    for exchanged_currency_id, rate_value, rate_value_scaled in zip(exchanged_currency_ids, day_rates, day_scaled_rates)
+                    if (exchanged_currency_id, valuation_date) not in existing
+                ]
+                CurrencyExchangeRate.objects.bulk_create(batch, ignore_conflicts=True, rates_scaled=True)
+                rates_bulk_saved.send(sender=CurrencyExchangeRate, rates=batch)
+            created += len(batch)
+        self.stdout.write(self.style.SUCCESS('Successfully created %s exchange rates for %s days from %s to %s currencies' % (created, number_of_days, base_currency_code, len(currency_codes), )))
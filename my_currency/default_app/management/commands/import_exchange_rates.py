@@ -1,27 +1,30 @@
-import json
-from django.core.management.base import BaseCommand
-from default_app.models import Currency, CurrencyExchangeRate
-from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from default_app.bulk_import import ExchangeRatesImporter, IMPORT_BATCH_SIZE
+from default_app.rate_files import FORMATS, iter_rates
 
 class Command(BaseCommand):
-    help = 'Imports historical exchange rates from a JSON file'
+    help = 'Imports historical exchange rates from a JSON array, CSV or NDJSON file (optionally .gz)'
 
     def add_arguments(self, parser):
-        parser.add_argument('file_path', type=str, help='Path to the JSON file containing the exchange rates')
+        parser.add_argument('file_path', type=str, help='Path to the file containing the exchange rates')
+        parser.add_argument('--format', type=str, choices=FORMATS, help='Format of the file (by default, from its extension: .json, .csv, .ndjson or .jsonl, plus .gz if compressed)')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing csv and ndjson files (default 1, parsed by the command itself)')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Number of exchange rates stored per transaction (default %s)' % IMPORT_BATCH_SIZE)
+        parser.add_argument('--progress', action='store_true', help='Report the throughput after every batch')
+
+    def _report_progress(self, stats):
+        self.stdout.write('%(imported)s exchange rates in %(seconds).2fs (%(rates_per_second).0f rates/s)' % stats)
 
     def handle(self, *args, **options):
         file_path = options['file_path']
-        already_in_db = 0
-        with open(file_path, mode='r') as file:
-            data = json.load(file)
-            for item in data:
-                source_currency, _ = Currency.objects.get_or_create(code=item['source_currency'])
-                exchanged_currency, _ = Currency.objects.get_or_create(code=item['exchanged_currency'])
-                _, created = CurrencyExchangeRate.objects.update_or_create(
-                    valuation_date=datetime.strptime(item['valuation_date'], '%Y-%m-%d'),
-                    source_currency=source_currency,
-                    exchanged_currency=exchanged_currency,
-                    rate_value=item['rate_value']
-                )
-                already_in_db += int(not created)
-        self.stdout.write(self.style.SUCCESS('Successfully imported %s exchange rates (%s already existed) from "%s"' % (len(data), already_in_db, file_path, )))
+        importer = ExchangeRatesImporter(batch_size=options['batch_size'])
+        try:
+            stats = importer.import_items(
+                iter_rates(file_path, file_format=options['format'], workers=options['workers']),
+                on_batch=self._report_progress if options['progress'] else None
+            )
+        except ValueError as e:
+            # Batches stored before the invalid item are kept
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS('Successfully imported %s exchange rates (%s already existed) from "%s"' % (stats['imported'], stats['already_existed'], file_path, )))
+        self.stdout.write('Imported in %(seconds).2fs (%(rates_per_second).0f rates/s)' % stats)
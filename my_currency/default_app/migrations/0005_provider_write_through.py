@@ -0,0 +1,18 @@
+# Generated by Django 4.1.13 on 2026-10-18 11:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default_app', '0004_siteconfiguration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='write_through',
+            field=models.BooleanField(default=False, help_text='Store every successful answer of the endpoints as CurrencyExchangeRate, so it is served from the database afterwards.'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default_app', '0005_provider_write_through'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='provider',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
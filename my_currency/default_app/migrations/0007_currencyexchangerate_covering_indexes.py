@@ -0,0 +1,21 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default_app', '0006_provider_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='currencyexchangerate',
+            index=models.Index(fields=['source_currency', 'valuation_date', 'exchanged_currency', 'rate_value'], name='rate_source_date_cover_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='currencyexchangerate',
+            index=models.Index(fields=['source_currency', 'exchanged_currency', '-valuation_date', 'rate_value'], name='rate_pair_date_cover_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.1.13 on 2026-10-18 12:19
+
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Cast, Round
+
+
+def fill_rate_value_scaled(apps, schema_editor):
+    # A single UPDATE: rate_value has at most 6 decimal places, so rounding only removes float noise
+    CurrencyExchangeRate = apps.get_model('default_app', 'CurrencyExchangeRate')
+    CurrencyExchangeRate.objects.update(
+        rate_value_scaled=Cast(Round(F('rate_value') * 10 ** 6), output_field=models.BigIntegerField())
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default_app', '0007_currencyexchangerate_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='currencyexchangerate',
+            name='rate_source_date_cover_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='currencyexchangerate',
+            name='rate_pair_date_cover_idx',
+        ),
+        migrations.AddField(
+            model_name='currencyexchangerate',
+            name='rate_value_scaled',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_rate_value_scaled, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='currencyexchangerate',
+            index=models.Index(fields=['source_currency', 'valuation_date', 'exchanged_currency', 'rate_value', 'rate_value_scaled'], name='rate_source_date_cover_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='currencyexchangerate',
+            index=models.Index(fields=['source_currency', 'exchanged_currency', '-valuation_date', 'rate_value', 'rate_value_scaled'], name='rate_pair_date_cover_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-18 13:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('default_app', '0008_currencyexchangerate_rate_value_scaled'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='currencyexchangerate',
+            name='rate_pair_date_cover_idx',
+        ),
+    ]
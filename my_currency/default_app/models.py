@@ -1,9 +1,41 @@
 from django.db import models
-import requests
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Cast, Round
+from django.dispatch import Signal
 from django.core.cache import cache
-from my_currency.settings import CACHE_TIME_IN_SECONDS
+from my_currency.settings import RATE_READ_SCALED_INTEGERS
+from .http_client import http_client, thread_pool_http_client
+from .provider_registry import compiled_provider_registry
+from .segment_cache import timeseries_segment_cache
+from .timeseries import Timeseries
 from django.utils.timezone import make_aware
-from datetime import datetime
+from asgiref.sync import sync_to_async
+from datetime import datetime, date
+from itertools import islice
+import numpy as np
+
+
+# Sent with the saved instances (as rates=[...]) by bulk writes of CurrencyExchangeRate, which skip post_save
+rates_bulk_saved = Signal()
+# Sent by bulk deletes of CurrencyExchangeRate that skip post_delete (e.g. a raw DELETE)
+rates_bulk_deleted = Signal()
+
+# rate_value_scaled is rate_value * RATE_SCALE as an integer (rate_value has 6 decimal places)
+RATE_SCALE = 10 ** 6
+RATE_READ_CHUNK_SIZE = 2000
+
+
+def scale_rate(rate_value):
+    # Same rounding to 6 decimal places (half even) as the database value of rate_value
+    rate_value = CurrencyExchangeRate._meta.get_field('rate_value').to_python(rate_value)
+    return None if rate_value is None else int(rate_value.scaleb(6).to_integral_value())
+
+
+def format_rate(rate_value):
+    # rate_value as the database returns it, with its 6 decimal places (e.g. '2.000000'), so rates sent as
+    # they are saved and rates read back give the same string
+    field = CurrencyExchangeRate._meta.get_field('rate_value')
+    return '{:.{}f}'.format(field.to_python(rate_value), field.decimal_places)
 
 
 class Currency(models.Model):
@@ -18,15 +50,134 @@ class Currency(models.Model):
         ordering = ('code',)
 
 
+class CurrencyExchangeRateQuerySet(models.QuerySet):
+
+    def latest_rates(self):
+        # Greatest-per-group: keeps, for every (source, exchanged) pair, only the row
+        # with the newest valuation_date, resolved by the database in a single query.
+        newest_valuation_date = self.model.objects.filter(
+            source_currency=OuterRef('source_currency'),
+            exchanged_currency=OuterRef('exchanged_currency'),
+        ).order_by('-valuation_date').values('valuation_date')[:1]
+        return self.filter(valuation_date=Subquery(newest_valuation_date))
+
+    def iter_rate_chunks(self, *fields, chunk_size=RATE_READ_CHUNK_SIZE, scaled=None):
+        # Yields (rows, rates) per chunk: rows are the values_list tuples of fields (plus the stored rate
+        # as their last value) and rates the rates of the rows as floats. With RATE_READ_SCALED_INTEGERS
+        # (or scaled=True) the rates are read from rate_value_scaled and the whole chunk is converted at
+        # once, instead of building a Decimal per row and calling float() on it.
+        scaled = RATE_READ_SCALED_INTEGERS if scaled is None else scaled
+        rows = self.values_list(*fields, 'rate_value_scaled' if scaled else 'rate_value').iterator(chunk_size=chunk_size)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk, self._get_float_rates(chunk, scaled)
+
+    async def aiter_rate_chunks(self, *fields, chunk_size=RATE_READ_CHUNK_SIZE, scaled=None):
+        # Async version of iter_rate_chunks, for the async views: every chunk is fetched from the cursor in
+        # the thread of the ORM, so the event loop never touches the connection and holds one chunk at a time
+        chunks = self.iter_rate_chunks(*fields, chunk_size=chunk_size, scaled=scaled)
+        try:
+            while True:
+                chunk = await sync_to_async(next)(chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            await sync_to_async(chunks.close)()
+
+    def _get_float_rates(self, chunk, scaled):
+        if scaled:
+            return (np.array([row[-1] for row in chunk], dtype=np.float64) / RATE_SCALE).tolist()
+        return [float(row[-1]) for row in chunk]
+
+    def update(self, **kwargs):
+        # Keeps rate_value_scaled in step with rate_value, also when it is set with an expression such as F()
+        if 'rate_value' in kwargs and 'rate_value_scaled' not in kwargs:
+            rate_value = kwargs['rate_value']
+            if hasattr(rate_value, 'resolve_expression'):
+                kwargs['rate_value_scaled'] = Cast(Round(rate_value * RATE_SCALE), output_field=models.BigIntegerField())
+            else:
+                kwargs['rate_value_scaled'] = scale_rate(rate_value)
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, rates_scaled=False, **kwargs):
+        # rates_scaled: rate_value_scaled of the instances is already set (e.g. computed with numpy for a whole batch)
+        objs = list(objs)
+        if not rates_scaled:
+            for obj in objs:
+                obj.rate_value_scaled = scale_rate(obj.rate_value)
+        update_fields = kwargs.get('update_fields')
+        if update_fields and 'rate_value' in update_fields and 'rate_value_scaled' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'rate_value_scaled']
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        if 'rate_value' in fields:
+            for obj in objs:
+                obj.rate_value_scaled = scale_rate(obj.rate_value)
+            if 'rate_value_scaled' not in fields:
+                fields = [*fields, 'rate_value_scaled']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    def upsert_rates(self, base_currency_code, rates):
+        # Stores a provider timeseries ({date_key: {code: rate}}) with a single bulk upsert.
+        # Unknown currencies are created with the code only, as import_exchange_rates does.
+        codes = {base_currency_code} | {code for day_rates in rates.values() for code in day_rates}
+        Currency.objects.bulk_create([Currency(code=code) for code in codes], ignore_conflicts=True)
+        currency_ids = dict(Currency.objects.filter(code__in=codes).values_list('code', 'id'))
+        exchange_rates = [
+            self.model(
+                source_currency_id=currency_ids[base_currency_code],
+                exchanged_currency_id=currency_ids[code],
+                valuation_date=date.fromisoformat(date_key),
+                rate_value=rate_value
+            )
+            for date_key, day_rates in rates.items()
+            for code, rate_value in day_rates.items()
+        ]
+        return self.bulk_upsert(exchange_rates)
+
+    def bulk_upsert(self, exchange_rates):
+        # Inserts the unsaved instances, updating rate_value of the (source, exchanged, date) rows that already exist
+        self.bulk_create(
+            exchange_rates,
+            update_conflicts=True,
+            unique_fields=['source_currency', 'exchanged_currency', 'valuation_date'],
+            update_fields=['rate_value']
+        )
+        rates_bulk_saved.send(sender=self.model, rates=exchange_rates)
+        return exchange_rates
+
+
 class CurrencyExchangeRate(models.Model):
     source_currency = models.ForeignKey(Currency, on_delete=models.CASCADE, related_name='exchanges')
     exchanged_currency = models.ForeignKey(Currency, on_delete=models.CASCADE)
     valuation_date = models.DateField(db_index=True)
     rate_value = models.DecimalField(decimal_places=6, max_digits=18)
+    # Denormalized rate_value for the hot reads (see iter_rate_chunks), kept by save(), bulk_create(), bulk_update() and update()
+    rate_value_scaled = models.BigIntegerField(null=True, editable=False)
+
+    objects = CurrencyExchangeRateQuerySet.as_manager()
 
     class Meta:
         unique_together = ('source_currency', 'exchanged_currency', 'valuation_date')
         ordering = ('valuation_date', 'source_currency', 'exchanged_currency')
+        indexes = [
+            # Covering index (the rate is read from the index) of the hot queries of the providers: every rate
+            # of a base currency in a period, ordered by date, also of a single pair (see QueryPlanTest). The
+            # newest date of a pair (latest rates) is found with the index of unique_together.
+            models.Index(fields=['source_currency', 'valuation_date', 'exchanged_currency', 'rate_value', 'rate_value_scaled'], name='rate_source_date_cover_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.rate_value_scaled = scale_rate(self.rate_value)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'rate_value' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'rate_value_scaled'}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"At {self.valuation_date.strftime('%Y-%m-%d')}, 1 {self.source_currency.code} = {self.rate_value} {self.exchanged_currency.code}"
@@ -35,6 +186,8 @@ class CurrencyExchangeRate(models.Model):
 class ProviderInterface:
 
     name = None
+    # Remote providers fetch their rates over HTTP, so they can be queried concurrently
+    is_remote = False
 
     def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
         raise NotImplementedError("Subclasses must implement this method")
@@ -42,6 +195,24 @@ class ProviderInterface:
     def get_latest_rates_dict(self, base_currency_code):
         raise NotImplementedError("Subclasses must implement this method")
 
+    def iter_rates_timeseries(self, base_currency_code, date_from, date_to):
+        # Yields (date_key, rates) pairs. Providers that can read day by day from
+        # their source (e.g. a DB cursor) override it to avoid building the full dict.
+        return iter(self.get_rates_dict_timeseries(base_currency_code, date_from, date_to).items())
+
+    # Async versions for the async views. By default the sync method runs in the thread of the ORM;
+    # providers that read from memory, the async ORM or async HTTP override them.
+
+    async def aget_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        return await sync_to_async(self.get_rates_dict_timeseries)(base_currency_code, date_from, date_to)
+
+    async def aget_latest_rates_dict(self, base_currency_code):
+        return await sync_to_async(self.get_latest_rates_dict)(base_currency_code)
+
+    async def aiter_rates_timeseries(self, base_currency_code, date_from, date_to):
+        for date_key, rates in (await self.aget_rates_dict_timeseries(base_currency_code, date_from, date_to)).items():
+            yield date_key, rates
+
     def _is_sanity_json(self, js):
         return bool(
             isinstance(js, dict) and js.get('success') == True and
@@ -52,21 +223,14 @@ class ProviderInterface:
         assert self._is_sanity_json(js)
         return js['rates']
 
-    def _get_latest_rates_from_timeseries(self, rates):
-        assert self._is_timeseries_sanity(rates)
-        latest_date = list(sorted(rates.keys()))[-1]
-        return rates[latest_date]
-
-    def _is_timeseries_sanity(self, rates):
-        return bool(
-            rates and isinstance(rates, dict) and
-            all(isinstance(k, str) and len(k) == 10 for k in rates.keys()) and
-            all(isinstance(v, dict) for v in rates.values())
-        )
-
-    def _filter_timeseries(self, rates, date_from, date_to):
-        assert self._is_timeseries_sanity(rates)
-        return {k: v for k, v in rates.items() if date_from <= k <= date_to}
+    def _get_timeseries_from_json(self, js):
+        # Timeseries of a provider answer, None if the answer is not a valid timeseries
+        if not self._is_sanity_json(js):
+            return None
+        try:
+            return Timeseries(js['rates'])
+        except ValueError:
+            return None
 
 
 class Provider(models.Model, ProviderInterface):
@@ -77,6 +241,8 @@ class Provider(models.Model, ProviderInterface):
     historical_hardcoded_json = models.JSONField(null=True, blank=True)
     priority = models.IntegerField(default=0)
     is_default = models.BooleanField(default=False)
+    write_through = models.BooleanField(default=False, help_text='Store every successful answer of the endpoints as CurrencyExchangeRate, so it is served from the database afterwards.')
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -84,39 +250,82 @@ class Provider(models.Model, ProviderInterface):
     class Meta:
         ordering = ('-is_default', '-priority',)
 
+    @property
+    def is_remote(self):
+        return not self.historical_hardcoded_json
+
+    def _fetch_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        url = self.timeseries_endpoint.format(self.access_key, base_currency_code, date_from, date_to)
+        rates = self._get_timeseries_from_json(http_client.get(url).json())
+        if rates is not None and self.write_through:
+            CurrencyExchangeRate.objects.upsert_rates(base_currency_code, rates)
+        return rates
+
+    async def _afetch_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        url = self.timeseries_endpoint.format(self.access_key, base_currency_code, date_from, date_to)
+        rates = self._get_timeseries_from_json((await thread_pool_http_client.get(url)).json())
+        if rates is not None and self.write_through:
+            await sync_to_async(CurrencyExchangeRate.objects.upsert_rates)(base_currency_code, rates)
+        return rates
+
+    def _get_hardcoded_timeseries(self):
+        # Parsed once per process for each saved version of the provider
+        return compiled_provider_registry.get(
+            self, lambda: self._get_timeseries_from_json(self.historical_hardcoded_json) or Timeseries()
+        )
+
     def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
-        js = None
         if self.historical_hardcoded_json:
-            js = self.historical_hardcoded_json
-        else:
-            url = self.timeseries_endpoint.format(self.access_key, base_currency_code, date_from, date_to)
-            js = cache.get(url)
-            if not js:
-                js = requests.get(url).json()
-                cache.set(url, js, CACHE_TIME_IN_SECONDS)
-        if self._is_sanity_json(js):
-            return self._get_rates_dict_from_json(js)
-        return {}
+            return self._get_hardcoded_timeseries().slice(date_from, date_to)
+        # Cached by days: only the days of the period that were not fetched before are requested
+        return timeseries_segment_cache.get_rates_dict_timeseries(
+            self, base_currency_code, date_from, date_to,
+            lambda gap_from, gap_to: self._fetch_rates_dict_timeseries(base_currency_code, gap_from, gap_to)
+        )
         # raise ValueError(f"Failed to get rates from {self.timeseries_endpoint} for {base_currency_code}")
 
+    async def aget_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        if self.historical_hardcoded_json:
+            return self.get_rates_dict_timeseries(base_currency_code, date_from, date_to)
+        return await timeseries_segment_cache.aget_rates_dict_timeseries(
+            self, base_currency_code, date_from, date_to,
+            lambda gap_from, gap_to: self._afetch_rates_dict_timeseries(base_currency_code, gap_from, gap_to)
+        )
+
+    def _write_through_latest(self, base_currency_code, js):
+        if self.write_through and self._is_sanity_json(js):
+            date_key = js.get('date') or datetime.now().strftime("%Y-%m-%d")
+            CurrencyExchangeRate.objects.upsert_rates(base_currency_code, {date_key: js['rates']})
+
     def get_latest_rates_dict(self, base_currency_code):
         if self.historical_hardcoded_json:
-            js = self.historical_hardcoded_json
-            if self._is_sanity_json(js):
-                rates = self._get_rates_dict_from_json(js)
-                latest_date = list(sorted(rates.keys()))[-1]
-                return rates[latest_date]
+            return self._get_hardcoded_timeseries().latest()
         else:
             url = self.latest_endpoint.format(self.access_key, base_currency_code)
             js = cache.get(url)
             if not js:
-                js = requests.get(url).json()
+                js = http_client.get(url).json()
                 cache.set(url, js, 60 * 60 * 24)
+                self._write_through_latest(base_currency_code, js)
             if self._is_sanity_json(js):
                 return self._get_rates_dict_from_json(js)
         return {}
         # raise ValueError(f"Failed to get rates from {self.latest_endpoint} for {base_currency_code}")
 
+    async def aget_latest_rates_dict(self, base_currency_code):
+        if self.historical_hardcoded_json:
+            return self.get_latest_rates_dict(base_currency_code)
+        url = self.latest_endpoint.format(self.access_key, base_currency_code)
+        js = await cache.aget(url)
+        if not js:
+            js = (await thread_pool_http_client.get(url)).json()
+            await cache.aset(url, js, 60 * 60 * 24)
+            if self.write_through:
+                await sync_to_async(self._write_through_latest)(base_currency_code, js)
+        if self._is_sanity_json(js):
+            return self._get_rates_dict_from_json(js)
+        return {}
+
 
 class SiteConfiguration(models.Model):
     # Define the min_date field with a default value of 1900-01-01
@@ -0,0 +1,93 @@
+from django.apps import apps
+from asgiref.sync import sync_to_async
+from my_currency.settings import PROVIDER_CHAIN_MAX_AGE_IN_SECONDS
+import threading
+import time
+
+
+class CompiledProviderRegistry:
+    """
+    Per-process compiled form of the providers' hardcoded data (e.g. the Timeseries of
+    historical_hardcoded_json), so a large dataset is parsed once instead of on every request.
+
+    Entries are keyed by provider id and checked against the provider's updated_at, so a provider
+    saved by another process is compiled again. Saves and deletes in this process invalidate it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._compiled = {}
+
+    def get(self, provider, compile):
+        # compile() builds the compiled form of the provider as it is now
+        if provider.pk is None:
+            return compile()
+        with self._lock:
+            entry = self._compiled.get(provider.pk)
+        if entry and entry[0] == provider.updated_at:
+            return entry[1]
+        compiled = compile()
+        with self._lock:
+            self._compiled[provider.pk] = (provider.updated_at, compiled)
+        return compiled
+
+    def invalidate(self, provider_id=None):
+        with self._lock:
+            if provider_id is None:
+                self._compiled = {}
+            else:
+                self._compiled.pop(provider_id, None)
+
+
+compiled_provider_registry = CompiledProviderRegistry()
+
+
+class ProviderChainRegistry:
+    """
+    Provider rows of the database in their chain order (Provider.Meta.ordering), loaded once per
+    process instead of on every request. Saves and deletes of providers in this process invalidate it,
+    and providers saved by other processes are seen when it is loaded again, once it is older than
+    max_age seconds.
+    """
+
+    def __init__(self, max_age=PROVIDER_CHAIN_MAX_AGE_IN_SECONDS):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # (loaded at, providers)
+        self._providers = None
+        self._version = 0
+
+    def _get_loaded_providers(self):
+        entry = self._providers
+        if entry is not None and time.monotonic() - entry[0] < self.max_age:
+            return entry[1]
+        return None
+
+    def get_providers(self):
+        providers = self._get_loaded_providers()
+        if providers is not None:
+            return providers
+        with self._lock:
+            version = self._version
+        # Loaded outside the lock; a load that raced with an invalidation is used but not kept
+        loaded_at = time.monotonic()
+        providers = tuple(apps.get_model('default_app', 'Provider').objects.all())
+        with self._lock:
+            if self._version == version:
+                self._providers = (loaded_at, providers)
+        return providers
+
+    async def aget_providers(self):
+        # For async code: only a load goes to the thread of the ORM
+        providers = self._get_loaded_providers()
+        if providers is not None:
+            return providers
+        return await sync_to_async(self.get_providers)()
+
+    def invalidate(self):
+        with self._lock:
+            self._providers = None
+            self._version += 1
+
+
+provider_chain_registry = ProviderChainRegistry()
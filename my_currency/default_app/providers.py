@@ -1,64 +1,175 @@
-from .models import ProviderInterface, Currency
+from .models import ProviderInterface, CurrencyExchangeRate
+from .rate_matrix import rate_matrix
+from .triangulation import derived_rates_cache
+from .timeseries import Timeseries
+from my_currency.settings import RATE_MATRIX_ENABLED
+from django.db.models import Avg, Max, Min
 import json
 import os
+import threading
 
 
-class MockProvider(ProviderInterface):
+TIMESERIES_CHUNK_SIZE = 2000
 
-    name = 'Mock Provider'
-    path_from_this_folder = 'json_files/mock_provider_data.json'
+
+class FileBackedProvider(ProviderInterface):
+    """
+    Provider whose timeseries is a Fixer-like JSON file ({"success": true, "rates": {date_key: {code: rate}}}).
+
+    The file is parsed once per process into a Timeseries, and parsed again only when its
+    modification time changes. Periods are then sliced with a bisect over the sorted dates.
+    """
+
+    path_from_this_folder = None
+
+    # Absolute path -> (mtime, Timeseries of the file), shared by all the instances
+    _loaded_files = {}
+    _loaded_files_lock = threading.Lock()
+
+    def _get_path(self):
+        return os.path.join(os.path.dirname(__file__), self.path_from_this_folder)
+
+    def _load(self):
+        path = self._get_path()
+        mtime = os.stat(path).st_mtime_ns
+        loaded = self._loaded_files.get(path)
+        if loaded and loaded[0] == mtime:
+            return loaded[1]
+        with self._loaded_files_lock:
+            loaded = self._loaded_files.get(path)
+            if loaded and loaded[0] == mtime:
+                return loaded[1]
+            with open(path) as f:
+                js = json.load(f)
+            timeseries = self._get_timeseries_from_json(js)
+            assert timeseries
+            self._loaded_files[path] = (mtime, timeseries)
+            return timeseries
 
     def get_latest_rates_dict(self, base_currency_code):
-        with open(os.path.join(os.path.dirname(__file__), self.path_from_this_folder)) as f:
-            js = json.load(f)
-        js["base"] = base_currency_code
-        assert self._is_sanity_json(js)
-        rates = js['rates']
-        rates = self._get_latest_rates_from_timeseries(rates)
-        return rates
+        return self._load().latest()
 
     def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
-        with open(os.path.join(os.path.dirname(__file__), self.path_from_this_folder)) as f:
-            js = json.load(f)
-        js["base"] = base_currency_code
-        assert self._is_sanity_json(js)
-        rates = js['rates']
-        assert self._is_timeseries_sanity(rates)
-        rates = self._filter_timeseries(rates, date_from, date_to)
-        return rates
+        return self._load().slice(date_from, date_to)
+
+
+class MockProvider(FileBackedProvider):
+
+    name = 'Mock Provider'
+    path_from_this_folder = 'json_files/mock_provider_data.json'
 
 
 class StoredDataProvider(ProviderInterface):
 
     name = 'Stored Data Provider'
 
+    def _get_latest_rates(self, base_currency_code):
+        return CurrencyExchangeRate.objects.latest_rates().filter(
+            source_currency__code=base_currency_code
+        ).order_by('exchanged_currency__code')
+
     def get_latest_rates_dict(self, base_currency_code):
-        rates = {}
-        base_currency_object = Currency.objects.all().filter(code=base_currency_code).first()
-        if not base_currency_object:
-            return rates
-        for currency in Currency.objects.all():
-            latest_rate = base_currency_object.exchanges.filter(
-                exchanged_currency=currency
-            ).last()
-            if latest_rate:
-                rates[currency.code] = float(latest_rate.rate_value)
-        return rates
+        if RATE_MATRIX_ENABLED:
+            return rate_matrix.get_latest_rates_dict(base_currency_code)
+        latest_rates = self._get_latest_rates(base_currency_code).iter_rate_chunks('exchanged_currency__code')
+        return {code: rate for rows, rates in latest_rates for (code, _), rate in zip(rows, rates)}
+
+    async def aget_latest_rates_dict(self, base_currency_code):
+        if RATE_MATRIX_ENABLED:
+            return await rate_matrix.aget_latest_rates_dict(base_currency_code)
+        latest_rates = self._get_latest_rates(base_currency_code).aiter_rate_chunks('exchanged_currency__code')
+        return {code: rate async for rows, rates in latest_rates for (code, _), rate in zip(rows, rates)}
     
     def _get_date_key(self, valuation_date):
         return valuation_date.strftime("%Y-%m-%d")
 
-    def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
-        rates = {}
-        base_currency_object = Currency.objects.all().filter(code=base_currency_code).first()
-        if not base_currency_object:
-            return rates
-        for rate in base_currency_object.exchanges.filter(
+    def _get_timeseries_rates(self, base_currency_code, date_from, date_to):
+        return CurrencyExchangeRate.objects.filter(
+            source_currency__code=base_currency_code,
             valuation_date__gte=date_from,
             valuation_date__lte=date_to
+        )
+
+    def _iter_days(self, chunks):
+        # (date_key, {code: rate}) per day of the (rows, rates) chunks of rows ordered by valuation_date
+        current_date, day_rates = None, None
+        for chunk, rates in chunks:
+            for (valuation_date, code, _), rate in zip(chunk, rates):
+                if valuation_date != current_date:
+                    if day_rates:
+                        yield self._get_date_key(current_date), day_rates
+                    current_date, day_rates = valuation_date, {}
+                day_rates[code] = rate
+        if day_rates:
+            yield self._get_date_key(current_date), day_rates
+
+    def iter_rates_timeseries(self, base_currency_code, date_from, date_to):
+        # Yields (date_key, {code: rate}) per day. Rows come as plain tuples straight
+        # from the cursor (no model instances, no FK lookups) and, since they are
+        # ordered by valuation_date, each date key is only formatted once.
+        return self._iter_days(self._get_timeseries_rates(base_currency_code, date_from, date_to).iter_rate_chunks(
+            'valuation_date', 'exchanged_currency__code', chunk_size=TIMESERIES_CHUNK_SIZE
+        ))
+
+    async def aiter_rates_timeseries(self, base_currency_code, date_from, date_to):
+        # Async version of iter_rates_timeseries, holding one chunk of rows at a time
+        current_date, day_rates = None, None
+        async for chunk, rates in self._get_timeseries_rates(base_currency_code, date_from, date_to).aiter_rate_chunks(
+            'valuation_date', 'exchanged_currency__code', chunk_size=TIMESERIES_CHUNK_SIZE
         ):
-            date_key = self._get_date_key(rate.valuation_date)
-            if date_key not in rates:
-                rates[date_key] = {}
-            rates[date_key][rate.exchanged_currency.code] = float(rate.rate_value)
-        return rates
+            for (valuation_date, code, _), rate in zip(chunk, rates):
+                if valuation_date != current_date:
+                    if day_rates:
+                        yield self._get_date_key(current_date), day_rates
+                    current_date, day_rates = valuation_date, {}
+                day_rates[code] = rate
+        if day_rates:
+            yield self._get_date_key(current_date), day_rates
+
+    def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        return Timeseries.from_sorted_items(self.iter_rates_timeseries(base_currency_code, date_from, date_to))
+
+    async def aget_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        chunks = [chunk async for chunk in self._get_timeseries_rates(base_currency_code, date_from, date_to).aiter_rate_chunks(
+            'valuation_date', 'exchanged_currency__code', chunk_size=TIMESERIES_CHUNK_SIZE
+        )]
+        return Timeseries.from_sorted_items(self._iter_days(chunks))
+
+    def _get_pair_rates(self, base_currency_code, exchanged_currency_code, date_from, date_to):
+        # Rates of a single pair in the period, read through the (source, exchanged, valuation_date) unique index
+        return CurrencyExchangeRate.objects.filter(
+            source_currency__code=base_currency_code,
+            exchanged_currency__code=exchanged_currency_code,
+            valuation_date__gte=date_from,
+            valuation_date__lte=date_to
+        )
+
+    def get_pair_timeseries(self, base_currency_code, exchanged_currency_code, date_from, date_to):
+        # [(date_key, rate)] of a single pair, ordered by date
+        rows = self._get_pair_rates(
+            base_currency_code, exchanged_currency_code, date_from, date_to
+        ).order_by('valuation_date').iter_rate_chunks('valuation_date')
+        return [(self._get_date_key(valuation_date), rate) for chunk, rates in rows for (valuation_date, _), rate in zip(chunk, rates)]
+
+    def get_pair_aggregates(self, base_currency_code, exchanged_currency_code, date_from, date_to):
+        # Mean, min and max rate of a single pair in the period, computed by the database
+        aggregates = self._get_pair_rates(
+            base_currency_code, exchanged_currency_code, date_from, date_to
+        ).order_by().aggregate(mean=Avg('rate_value'), min=Min('rate_value'), max=Max('rate_value'))
+        return {key: float(value) if value is not None else None for key, value in aggregates.items()}
+
+
+class TriangulatedDataProvider(ProviderInterface):
+
+    name = 'Triangulated Data Provider'
+
+    def get_latest_rates_dict(self, base_currency_code):
+        return dict(derived_rates_cache.get_latest().rates_from(base_currency_code))
+
+    def get_rates_dict_timeseries(self, base_currency_code, date_from, date_to):
+        rates = []
+        for valuation_date, derived_rates in derived_rates_cache.get_for_period(date_from, date_to).items():
+            day_rates = derived_rates.rates_from(base_currency_code)
+            if day_rates:
+                rates.append((valuation_date.strftime("%Y-%m-%d"), dict(day_rates)))
+        return Timeseries.from_sorted_items(rates)
@@ -0,0 +1,146 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from datetime import date
+from decimal import Decimal, InvalidOperation
+import csv
+import gzip
+import json
+import os
+import re
+
+
+# Parsing only uses the standard library, so the worker processes do not need Django
+
+FORMATS = ('json', 'csv', 'ndjson')
+CHUNK_LINES = 20000
+READ_SIZE = 1 << 16
+# Characters of a JSON array item; a longer one is taken as invalid instead of reading on until the end of the file
+MAX_ITEM_SIZE = 1 << 20
+
+_extensions = {'.json': 'json', '.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+_whitespace = re.compile(r'\s*')
+
+
+def get_file_format(path):
+    # From the extension, ignoring a final .gz: rates.csv.gz is a gzip-compressed csv
+    name = path[:-3] if path.endswith('.gz') else path
+    return _extensions.get(os.path.splitext(name)[1].lower())
+
+
+def open_rate_file(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode='rt', newline='')
+    return open(path, mode='r', newline='')
+
+
+def iter_json_array(file, read_size=READ_SIZE, max_item_size=MAX_ITEM_SIZE):
+    # Yields the items of the JSON array in file, parsing it chunk by chunk instead of loading it whole.
+    # Numbers with a fraction are Decimals, so rate values keep all their digits.
+    decoder = json.JSONDecoder(parse_float=Decimal)
+    buffer, position, expected = '', 0, '['
+    while True:
+        position = _whitespace.match(buffer, position).end()
+        if position == len(buffer):
+            chunk = file.read(read_size)
+            if not chunk:
+                raise ValueError('Unexpected end of file, the JSON array is not closed')
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        char = buffer[position]
+        if expected == '[':
+            if char != '[':
+                raise ValueError('The file is not a JSON array')
+            position, expected = position + 1, 'item or ]'
+            continue
+        if char == ']' and expected != 'item':
+            return
+        if expected == ', or ]':
+            if char != ',':
+                raise ValueError('Expected , or ] at "{}"'.format(buffer[position:position + 20]))
+            position, expected = position + 1, 'item'
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk (or the file is not valid JSON)
+            if len(buffer) - position > max_item_size:
+                raise ValueError('Invalid JSON item, or longer than {} characters, at "{}"'.format(max_item_size, buffer[position:position + 20]))
+            chunk = file.read(read_size)
+            if not chunk:
+                raise
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield item
+        position, expected = end, ', or ]'
+
+
+def normalize_rate(item, position):
+    # Validated exchange rate item, as the importer expects it. position is used in the error message.
+    try:
+        return {
+            'source_currency': item['source_currency'],
+            'exchanged_currency': item['exchanged_currency'],
+            'valuation_date': date.fromisoformat(item['valuation_date']).isoformat(),
+            'rate_value': Decimal(str(item['rate_value'])),
+        }
+    except (KeyError, TypeError, ValueError, InvalidOperation) as e:
+        raise ValueError('Invalid exchange rate at {}: {!r}'.format(position, item)) from e
+
+
+def parse_chunk(file_format, first_line_number, lines, header=None):
+    # Runs in the worker processes: parses and validates the lines of a csv or ndjson chunk
+    if file_format == 'csv':
+        rows = csv.DictReader(lines, fieldnames=header)
+    else:
+        rows = (json.loads(line, parse_float=Decimal) if line.strip() else None for line in lines)
+    return [
+        normalize_rate(row, 'line {}'.format(line_number))
+        for line_number, row in enumerate(rows, start=first_line_number) if row
+    ]
+
+
+def iter_chunks(file, file_format, chunk_lines=CHUNK_LINES):
+    # (first_line_number, lines, csv header) of every chunk of lines. Csv values cannot contain line breaks.
+    header, line_number = None, 1
+    if file_format == 'csv':
+        header = next(csv.reader([file.readline()]), None)
+        line_number += 1
+    lines = []
+    for line in file:
+        lines.append(line)
+        if len(lines) == chunk_lines:
+            yield line_number, lines, header
+            line_number, lines = line_number + len(lines), []
+    if lines:
+        yield line_number, lines, header
+
+
+def iter_rates(path, file_format=None, workers=1, chunk_lines=CHUNK_LINES):
+    """
+    Yields the validated exchange rate items of a json, csv or ndjson file (optionally gzip-compressed).
+
+    Csv and ndjson files are read in chunks of lines; with more than one worker the chunks are parsed and
+    validated by a pool of processes (at most two chunks per worker in flight), and the items are still
+    yielded in the order of the file, for a single writer. A json array is parsed incrementally here.
+    """
+    file_format = file_format or get_file_format(path)
+    if file_format not in FORMATS:
+        raise ValueError('Unknown format of "{}", expected one of {}'.format(path, ', '.join(FORMATS)))
+    with open_rate_file(path) as file:
+        if file_format == 'json':
+            for index, item in enumerate(iter_json_array(file)):
+                yield normalize_rate(item, 'item {}'.format(index))
+            return
+        chunks = iter_chunks(file, file_format, chunk_lines)
+        if workers <= 1:
+            for chunk in chunks:
+                yield from parse_chunk(file_format, *chunk)
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(parse_chunk, file_format, *chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
@@ -0,0 +1,165 @@
+from .models import CurrencyExchangeRate
+from my_currency.settings import RATE_MATRIX_MAX_AGE_IN_SECONDS
+from array import array
+from asgiref.sync import sync_to_async
+import threading
+import time
+
+
+class RateMatrix:
+    """
+    Latest rate of every (source, exchanged) currency pair, kept in memory for the whole process.
+
+    Every currency code gets a position; for each source position there is one array of rates
+    and one array of valuation date ordinals (0 when the pair has no rate), both indexed by the
+    exchanged currency position. It is loaded from the DB on first use and then patched by the
+    post_save and post_delete receivers in signals.py. Rates written by other processes (e.g. the management commands)
+    are seen when it is loaded again, once it is older than max_age seconds.
+    """
+
+    def __init__(self, max_age=RATE_MATRIX_MAX_AGE_IN_SECONDS):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._loaded_at = 0
+        self._positions = {}
+        self._codes = []
+        self._sorted_positions = []
+        self._rates = []
+        self._dates = []
+        self.version = 0
+
+    def _get_position(self, code):
+        position = self._positions.get(code)
+        if position is None:
+            position = len(self._codes)
+            self._positions[code] = position
+            self._codes.append(code)
+            self._sorted_positions = sorted(range(len(self._codes)), key=self._codes.__getitem__)
+            for rates, dates in zip(self._rates, self._dates):
+                rates.append(0.0)
+                dates.append(0)
+            self._rates.append(array('d', [0.0]) * len(self._codes))
+            self._dates.append(array('l', [0]) * len(self._codes))
+        return position
+
+    def _set(self, source_currency_code, exchanged_currency_code, valuation_date, rate_value):
+        source_position = self._get_position(source_currency_code)
+        exchanged_position = self._get_position(exchanged_currency_code)
+        date_ordinal = valuation_date.toordinal()
+        if date_ordinal >= self._dates[source_position][exchanged_position]:
+            self._dates[source_position][exchanged_position] = date_ordinal
+            self._rates[source_position][exchanged_position] = float(rate_value)
+
+    def _read_from_db(self):
+        # (source, exchanged, valuation_date, rate) of the latest rate of every pair
+        for rows, rates in CurrencyExchangeRate.objects.latest_rates().iter_rate_chunks(
+            'source_currency__code', 'exchanged_currency__code', 'valuation_date'
+        ):
+            for (source_currency, exchanged_currency, valuation_date, _), rate in zip(rows, rates):
+                yield source_currency, exchanged_currency, valuation_date, rate
+
+    def load(self):
+        with self._lock:
+            self._positions, self._codes, self._sorted_positions, self._rates, self._dates = {}, [], [], [], []
+            for row in self._read_from_db():
+                self._set(*row)
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+            self.version += 1
+
+    def _is_loaded(self):
+        return self._loaded and time.monotonic() - self._loaded_at < self.max_age
+
+    def _ensure_loaded(self):
+        if not self._is_loaded():
+            self.load()
+
+    def invalidate(self):
+        # The next read reloads everything from the DB
+        with self._lock:
+            self._loaded = False
+            self.version += 1
+
+    def update(self, source_currency_code, exchanged_currency_code, valuation_date, rate_value):
+        # Only newer (or same day) rates replace the stored one, as in CurrencyExchangeRate.objects.latest_rates()
+        with self._lock:
+            if self._loaded:
+                self._set(source_currency_code, exchanged_currency_code, valuation_date, rate_value)
+                self.version += 1
+
+    def refresh(self, source_currency_code, exchanged_currency_code):
+        # Reads the latest rate of the pair again, after an update or a delete that may have moved it backwards
+        with self._lock:
+            if not self._loaded:
+                return
+            latest = CurrencyExchangeRate.objects.filter(
+                source_currency__code=source_currency_code, exchanged_currency__code=exchanged_currency_code
+            ).order_by('-valuation_date').values_list('valuation_date', 'rate_value').first()
+            source_position = self._get_position(source_currency_code)
+            exchanged_position = self._get_position(exchanged_currency_code)
+            self._dates[source_position][exchanged_position] = latest[0].toordinal() if latest else 0
+            self._rates[source_position][exchanged_position] = float(latest[1]) if latest else 0.0
+            self.version += 1
+
+    def get_rate(self, source_currency_code, exchanged_currency_code):
+        with self._lock:
+            self._ensure_loaded()
+            source_position = self._positions.get(source_currency_code)
+            exchanged_position = self._positions.get(exchanged_currency_code)
+            if source_position is None or exchanged_position is None or not self._dates[source_position][exchanged_position]:
+                return None
+            return self._rates[source_position][exchanged_position]
+
+    async def _aget_loaded(self, function, *args):
+        # For async code: answered from memory, only a load (first use, after an invalidation) goes to the thread of the ORM
+        while True:
+            with self._lock:
+                if self._is_loaded():
+                    return function(*args)
+            await sync_to_async(self._ensure_loaded)()
+
+    async def aget_rate(self, source_currency_code, exchanged_currency_code):
+        return await self._aget_loaded(self.get_rate, source_currency_code, exchanged_currency_code)
+
+    async def aget_latest_rates_dict(self, base_currency_code):
+        return await self._aget_loaded(self.get_latest_rates_dict, base_currency_code)
+
+    def get_latest_rates_dict(self, base_currency_code):
+        with self._lock:
+            self._ensure_loaded()
+            source_position = self._positions.get(base_currency_code)
+            if source_position is None:
+                return {}
+            rates, dates = self._rates[source_position], self._dates[source_position]
+            return {self._codes[position]: rates[position] for position in self._sorted_positions if dates[position]}
+
+    def snapshot(self):
+        # (version, {source: {exchanged: rate}}) with every pair in the matrix, taken atomically
+        with self._lock:
+            self._ensure_loaded()
+            return self.version, {
+                self._codes[source_position]: self.get_latest_rates_dict(self._codes[source_position])
+                for source_position in self._sorted_positions
+                if any(self._dates[source_position])
+            }
+
+    def inconsistencies(self):
+        # Consistency check against the DB: list of (source, exchanged, rate in memory, rate in DB) that differ
+        with self._lock:
+            self._ensure_loaded()
+            in_db = {(source, exchanged): float(rate_value) for source, exchanged, _, rate_value in self._read_from_db()}
+            in_memory = {
+                (self._codes[source_position], self._codes[exchanged_position]): self._rates[source_position][exchanged_position]
+                for source_position in range(len(self._codes))
+                for exchanged_position in range(len(self._codes))
+                if self._dates[source_position][exchanged_position]
+            }
+        return sorted(
+            (source, exchanged, in_memory.get((source, exchanged)), in_db.get((source, exchanged)))
+            for source, exchanged in set(in_db) | set(in_memory)
+            if in_memory.get((source, exchanged)) != in_db.get((source, exchanged))
+        )
+
+
+rate_matrix = RateMatrix()
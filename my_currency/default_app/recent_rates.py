@@ -0,0 +1,144 @@
+from django.apps import apps
+from asgiref.sync import sync_to_async
+from collections import OrderedDict
+from datetime import date, timedelta
+from .models import format_rate
+from my_currency.settings import RECENT_RATES_PER_BASE, RECENT_RATES_MAX_AGE_IN_SECONDS
+import threading
+import time
+
+
+class RecentRatesBuffer:
+    """
+    Per-process ring buffers of the recent rates of every base currency, from which GraphConsumer sends the
+    snapshot of a new connection instead of the page requesting the history over HTTP.
+
+    A snapshot of some exchanged currencies is taken from a buffer per pair, and one of all of them from a
+    buffer of the base currency. Buffers are loaded from the database when first asked for (their latest
+    max_size rates by valuation date), again once they are older than max_age seconds, and in between the
+    rates broadcast to the websocket group of the base currency are added. Rates of other processes only
+    reach this one while it has connections in the group, so the buffers of the base currency are dropped
+    with the last one, unless every broadcast comes from this process (the in-memory channel layer). When
+    a buffer is full the entry updated longest ago is dropped, and complete_from is the first day from
+    which the buffer still has every rate.
+    """
+
+    def __init__(self, max_size=RECENT_RATES_PER_BASE, max_age=RECENT_RATES_MAX_AGE_IN_SECONDS):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # base currency code -> {exchanged currency code, or None for all of them:
+        #   [loaded at, {(exchanged currency code, valuation date): rate value}, complete_from]}
+        self._buffers = {}
+        self._connections = {}
+
+    def _load(self, base_currency_code, exchanged_currency_code=None):
+        rates = apps.get_model('default_app', 'CurrencyExchangeRate').objects.filter(source_currency__code=base_currency_code)
+        if exchanged_currency_code is not None:
+            rates = rates.filter(exchanged_currency__code=exchanged_currency_code)
+        rows = list(rates.order_by('-valuation_date').values_list(
+            'exchanged_currency__code', 'valuation_date', 'rate_value'
+        )[:self.max_size])
+        buffer_rates = OrderedDict(
+            ((code, valuation_date.isoformat()), format_rate(rate_value))
+            for code, valuation_date, rate_value in reversed(rows)
+        )
+        # With max_size rows, other rates of the first day loaded may have been left out
+        complete_from = (rows[-1][1] + timedelta(days=1)).isoformat() if len(rows) == self.max_size else None
+        with self._lock:
+            self._buffers.setdefault(base_currency_code, {})[exchanged_currency_code] = [time.monotonic(), buffer_rates, complete_from]
+
+    def _get_keys_to_load(self, base_currency_code, exchanged_currencies):
+        keys = [None] if exchanged_currencies is None else sorted(exchanged_currencies)
+        buffers = self._buffers.get(base_currency_code, {})
+        now = time.monotonic()
+        return [key for key in keys if key not in buffers or now - buffers[key][0] >= self.max_age]
+
+    def connect(self, base_currency_code):
+        # A connection of this process joined the group of the base currency
+        with self._lock:
+            self._connections[base_currency_code] = self._connections.get(base_currency_code, 0) + 1
+
+    def disconnect(self, base_currency_code, keep_buffer=False):
+        with self._lock:
+            self._connections[base_currency_code] -= 1
+            if not self._connections[base_currency_code]:
+                del self._connections[base_currency_code]
+                if not keep_buffer:
+                    self._buffers.pop(base_currency_code, None)
+
+    def _add_to_buffer(self, buffer, rates):
+        buffer_rates = buffer[1]
+        for rate in rates:
+            key = (rate['exchanged_currency'], rate['valuation_date'])
+            buffer_rates[key] = rate['rate_value']
+            buffer_rates.move_to_end(key)
+        while len(buffer_rates) > self.max_size:
+            (_, valuation_date), _ = buffer_rates.popitem(last=False)
+            dropped_until = (date.fromisoformat(valuation_date) + timedelta(days=1)).isoformat()
+            buffer[2] = max(buffer[2] or dropped_until, dropped_until)
+
+    def add(self, base_currency_code, rates):
+        # Rates ({"exchanged_currency", "valuation_date", "rate_value"} items) broadcast to the group of the
+        # base currency. Adding the same rate again (every connection of the group does it) changes nothing.
+        with self._lock:
+            buffers = self._buffers.get(base_currency_code)
+            if not buffers:
+                return
+            if None in buffers:
+                self._add_to_buffer(buffers[None], rates)
+            if len(buffers) > (None in buffers):
+                rates_by_code = {}
+                for rate in rates:
+                    rates_by_code.setdefault(rate['exchanged_currency'], []).append(rate)
+                for code, code_rates in rates_by_code.items():
+                    if code in buffers:
+                        self._add_to_buffer(buffers[code], code_rates)
+
+    def _get_snapshot(self, base_currency_code, date_from, exchanged_currencies):
+        keys = [None] if exchanged_currencies is None else sorted(exchanged_currencies)
+        rates, complete = [], True
+        with self._lock:
+            buffers = self._buffers.get(base_currency_code, {})
+            for key in keys:
+                buffer = buffers.get(key)
+                if buffer is None:
+                    # Invalidated since it was loaded
+                    return [], False
+                _, buffer_rates, complete_from = buffer
+                rates.extend(
+                    {
+                        'source_currency': base_currency_code,
+                        'exchanged_currency': exchanged_currency_code,
+                        'valuation_date': valuation_date,
+                        'rate_value': rate_value
+                    }
+                    for (exchanged_currency_code, valuation_date), rate_value in buffer_rates.items()
+                    if valuation_date >= date_from
+                )
+                complete = complete and (complete_from is None or complete_from <= date_from)
+        rates.sort(key=lambda rate: rate['valuation_date'])
+        return rates, complete
+
+    def get_snapshot(self, base_currency_code, date_from, exchanged_currencies=None):
+        # (rates from date_from on, sorted by valuation date, and whether those are all the stored ones)
+        for key in self._get_keys_to_load(base_currency_code, exchanged_currencies):
+            self._load(base_currency_code, key)
+        return self._get_snapshot(base_currency_code, date_from, exchanged_currencies)
+
+    async def aget_snapshot(self, base_currency_code, date_from, exchanged_currencies=None):
+        # For async code: only the loads go to the thread of the ORM
+        for key in self._get_keys_to_load(base_currency_code, exchanged_currencies):
+            await sync_to_async(self._load)(base_currency_code, key)
+        return self._get_snapshot(base_currency_code, date_from, exchanged_currencies)
+
+    def invalidate(self, base_currency_code=None):
+        # Connections are kept, they are still in the groups
+        with self._lock:
+            if base_currency_code is None:
+                self._buffers = {}
+            else:
+                self._buffers.pop(base_currency_code, None)
+
+
+recent_rates = RecentRatesBuffer()
@@ -0,0 +1,112 @@
+from django.core.cache import cache
+from my_currency.settings import CACHE_TIME_IN_SECONDS
+from .timeseries import Timeseries
+from datetime import date, timedelta
+import asyncio
+import hashlib
+
+
+def _next_day(date_key):
+    return (date.fromisoformat(date_key) + timedelta(days=1)).isoformat()
+
+
+def _previous_day(date_key):
+    return (date.fromisoformat(date_key) - timedelta(days=1)).isoformat()
+
+
+class TimeseriesSegmentCache:
+    """
+    Daily rates already fetched from a provider for a base currency, with the date segments they cover.
+
+    The cache entry of a (provider, base currency) holds the list of disjoint, sorted [date_from, date_to]
+    segments that were fetched, and the rates of every day in them. Any period inside those segments is
+    answered from the cache, and only the gaps are fetched from the provider (then merged in the entry).
+    Days without rates inside a segment (e.g. weekends) are known to be empty and are not fetched again.
+    """
+
+    def _get_key(self, provider, base_currency_code):
+        endpoint = hashlib.md5((provider.timeseries_endpoint + provider.access_key).encode('utf-8')).hexdigest()
+        return 'timeseries_segments:{}:{}:{}'.format(provider.pk, base_currency_code, endpoint)
+
+    def _get_gaps(self, segments, date_from, date_to):
+        gaps = []
+        for segment_from, segment_to in segments:
+            if segment_to < date_from:
+                continue
+            if segment_from > date_to:
+                break
+            if segment_from > date_from:
+                gaps.append((date_from, _previous_day(segment_from)))
+            date_from = _next_day(segment_to)
+            if date_from > date_to:
+                return gaps
+        gaps.append((date_from, date_to))
+        return gaps
+
+    def _merge_segment(self, segments, date_from, date_to):
+        merged = []
+        for segment_from, segment_to in sorted(segments + [[date_from, date_to]]):
+            if merged and segment_from <= _next_day(merged[-1][1]):
+                merged[-1][1] = max(merged[-1][1], segment_to)
+            else:
+                merged.append([segment_from, segment_to])
+        return merged
+
+    def _is_period_of_days(self, date_from, date_to):
+        try:
+            date.fromisoformat(date_from), date.fromisoformat(date_to)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def _add_fetched_rates(self, entry, fetched):
+        # Merges the (gap_from, gap_to, rates) fetched in the entry. Returns False if any fetch failed
+        succeeded = True
+        for gap_from, gap_to, rates in fetched:
+            if rates is None:
+                succeeded = False
+                continue
+            entry['rates'].update(rates.slice(gap_from, gap_to))
+            entry['segments'] = self._merge_segment(entry['segments'], gap_from, gap_to)
+        return succeeded
+
+    def _get_period_rates(self, entry, date_from, date_to):
+        return Timeseries.from_sorted_items(sorted(
+            (date_key, day_rates) for date_key, day_rates in entry['rates'].items() if date_from <= date_key <= date_to
+        ))
+
+    def get_rates_dict_timeseries(self, provider, base_currency_code, date_from, date_to, fetch):
+        # fetch(date_from, date_to) returns the provider's Timeseries for a gap, or None if it failed
+        if not self._is_period_of_days(date_from, date_to):
+            # Not a period of days that can be split in segments, the provider gets it as it is
+            return fetch(date_from, date_to) or Timeseries()
+        if date_from > date_to:
+            return Timeseries()
+        key = self._get_key(provider, base_currency_code)
+        entry = cache.get(key) or {'segments': [], 'rates': {}}
+        gaps = self._get_gaps(entry['segments'], date_from, date_to)
+        succeeded = self._add_fetched_rates(entry, [(gap_from, gap_to, fetch(gap_from, gap_to)) for gap_from, gap_to in gaps])
+        if gaps:
+            cache.set(key, entry, CACHE_TIME_IN_SECONDS)
+        if not succeeded:
+            return Timeseries()
+        return self._get_period_rates(entry, date_from, date_to)
+
+    async def aget_rates_dict_timeseries(self, provider, base_currency_code, date_from, date_to, afetch):
+        # Async version of get_rates_dict_timeseries: afetch is a coroutine function, and the gaps are fetched concurrently
+        if not self._is_period_of_days(date_from, date_to):
+            return await afetch(date_from, date_to) or Timeseries()
+        if date_from > date_to:
+            return Timeseries()
+        key = self._get_key(provider, base_currency_code)
+        entry = await cache.aget(key) or {'segments': [], 'rates': {}}
+        gaps = self._get_gaps(entry['segments'], date_from, date_to)
+        fetched = await asyncio.gather(*(afetch(gap_from, gap_to) for gap_from, gap_to in gaps))
+        succeeded = self._add_fetched_rates(entry, [(gap_from, gap_to, rates) for (gap_from, gap_to), rates in zip(gaps, fetched)])
+        if gaps:
+            await cache.aset(key, entry, CACHE_TIME_IN_SECONDS)
+        if not succeeded:
+            return Timeseries()
+        return self._get_period_rates(entry, date_from, date_to)
+
+timeseries_segment_cache = TimeseriesSegmentCache()
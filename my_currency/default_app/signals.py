@@ -1,23 +1,119 @@
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import CurrencyExchangeRate
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from django.db import transaction
+from .models import Currency, CurrencyExchangeRate, Provider, rates_bulk_deleted, rates_bulk_saved
+from .broadcast import currency_code_cache, rate_broadcaster
+from .provider_registry import compiled_provider_registry, provider_chain_registry
+from .rate_matrix import rate_matrix
+from .recent_rates import recent_rates
+from .triangulation import derived_rates_cache
+
+
+def _get_valuation_date(instance):
+    # Instances keep whatever was given to create() (e.g. a datetime) until they are reloaded
+    return instance._meta.get_field('valuation_date').to_python(instance.valuation_date)
+
+
+def _cache_currency_codes(instance):
+    # Currencies already loaded on the instance fill the code cache, the others are not loaded here
+    for field_name in ('source_currency', 'exchanged_currency'):
+        if instance._meta.get_field(field_name).is_cached(instance):
+            currency_code_cache.add(getattr(instance, field_name))
+
+
+def _get_broadcast_rate(instance):
+    _cache_currency_codes(instance)
+    return (instance.source_currency_id, instance.exchanged_currency_id, _get_valuation_date(instance), instance.rate_value)
+
 
 @receiver(post_save, sender=CurrencyExchangeRate)
 def input_created(instance, created, **kwargs):
     if created:
-        channel_layer = get_channel_layer()
-        instance_json = {
-            'source_currency': instance.source_currency.code,
-            'exchanged_currency': instance.exchanged_currency.code,
-            'valuation_date': instance.valuation_date.strftime('%Y-%m-%d'),
-            'rate_value': str(instance.rate_value)
-        }
-        async_to_sync(channel_layer.group_send)(
-                instance.source_currency.code,
-                {
-                    'type': 'new_exchange_rate',
-                    'new_exchange_rate': instance_json
-                }
-        )
+        rate_broadcaster.add([_get_broadcast_rate(instance)])
+
+
+def _update_rate_matrix(instance, created):
+    # Codes from the cache, instead of loading both currencies of the rate
+    _cache_currency_codes(instance)
+    currency_ids = (instance.source_currency_id, instance.exchanged_currency_id)
+    valuation_date, rate_value = _get_valuation_date(instance), instance.rate_value
+
+    def update():
+        codes = currency_code_cache.get_codes(currency_ids)
+        if created:
+            rate_matrix.update(codes[currency_ids[0]], codes[currency_ids[1]], valuation_date, rate_value)
+        else:
+            rate_matrix.refresh(codes[currency_ids[0]], codes[currency_ids[1]])
+
+    # Only the pair of the rate is patched, once it is committed (right away in autocommit mode), so
+    # rolled back rows never reach the matrix
+    transaction.on_commit(update)
+
+
+@receiver(post_save, sender=CurrencyExchangeRate)
+def update_rate_matrix(instance, created, **kwargs):
+    _update_rate_matrix(instance, created)
+
+
+@receiver(post_delete, sender=CurrencyExchangeRate)
+def update_rate_matrix_after_delete(instance, **kwargs):
+    _update_rate_matrix(instance, False)
+
+
+@receiver(post_save, sender=CurrencyExchangeRate)
+@receiver(post_delete, sender=CurrencyExchangeRate)
+def invalidate_derived_rates(instance, **kwargs):
+    # An update may also have moved the rate away from another date, so everything is dropped then
+    valuation_date = _get_valuation_date(instance) if kwargs.get('created') else None
+    derived_rates_cache.invalidate(valuation_date)
+    transaction.on_commit(lambda: derived_rates_cache.invalidate(valuation_date))
+
+
+@receiver(post_save, sender=CurrencyExchangeRate)
+@receiver(post_delete, sender=CurrencyExchangeRate)
+def invalidate_recent_rates(**kwargs):
+    # New rates reach the buffer through the broadcast, updates and deletes are not broadcast
+    if not kwargs.get('created'):
+        recent_rates.invalidate()
+        transaction.on_commit(recent_rates.invalidate)
+
+
+@receiver(rates_bulk_saved, sender=CurrencyExchangeRate)
+def broadcast_bulk_saved_rates(rates, **kwargs):
+    # Bulk writes skip post_save; their rates (inserted or updated) are broadcast together
+    rate_broadcaster.add([_get_broadcast_rate(rate) for rate in rates])
+
+
+@receiver(rates_bulk_saved, sender=CurrencyExchangeRate)
+def invalidate_caches_after_bulk_save(rates, **kwargs):
+    rate_matrix.invalidate()
+    transaction.on_commit(rate_matrix.invalidate)
+    for valuation_date in {rate.valuation_date for rate in rates}:
+        derived_rates_cache.invalidate(valuation_date)
+        transaction.on_commit(lambda valuation_date=valuation_date: derived_rates_cache.invalidate(valuation_date))
+
+
+@receiver(rates_bulk_deleted, sender=CurrencyExchangeRate)
+def invalidate_caches_after_bulk_delete(**kwargs):
+    for rates_cache in (rate_matrix, derived_rates_cache, recent_rates):
+        rates_cache.invalidate()
+        transaction.on_commit(rates_cache.invalidate)
+
+
+@receiver(post_save, sender=Provider)
+@receiver(post_delete, sender=Provider)
+def invalidate_compiled_provider(instance, **kwargs):
+    compiled_provider_registry.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Provider)
+@receiver(post_delete, sender=Provider)
+def invalidate_provider_chain(**kwargs):
+    provider_chain_registry.invalidate()
+    transaction.on_commit(provider_chain_registry.invalidate)
+
+
+@receiver(post_save, sender=Currency)
+@receiver(post_delete, sender=Currency)
+def invalidate_currency_codes(**kwargs):
+    currency_code_cache.invalidate()
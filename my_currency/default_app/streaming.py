@@ -0,0 +1,54 @@
+from django.core.handlers.asgi import ASGIHandler
+from asgiref.sync import sync_to_async
+from django.http.response import HttpResponseBase
+
+
+class AsyncStreamingHttpResponse(HttpResponseBase):
+    """
+    Streaming response over an async iterator, for the async views.
+
+    Django 4.1 only streams sync iterators, and under ASGI it iterates them in the event loop, so one that
+    reads the database would block the loop. AsyncStreamingASGIHandler sends this response part by part,
+    awaiting the iterator, as Django 4.2 does with async streaming content.
+    """
+
+    streaming = True
+
+    def __init__(self, streaming_content, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_iterator = streaming_content
+
+    async def __aiter__(self):
+        async for part in self._async_iterator:
+            yield self.make_bytes(part)
+
+    def __iter__(self):
+        raise TypeError('AsyncStreamingHttpResponse is only sent by AsyncStreamingASGIHandler')
+
+    @property
+    def streaming_content(self):
+        raise TypeError('AsyncStreamingHttpResponse is only sent by AsyncStreamingASGIHandler')
+
+
+class AsyncStreamingASGIHandler(ASGIHandler):
+    # The ASGI handler of the project (see asgi.py), also sending AsyncStreamingHttpResponses
+
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+        response_headers = [
+            (header.encode('ascii') if isinstance(header, str) else header, value.encode('latin1') if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        response_headers.extend(
+            (b'Set-Cookie', cookie.output(header='').encode('ascii').strip()) for cookie in response.cookies.values()
+        )
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': response_headers})
+        try:
+            async for part in response:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            # Sends request_finished, which closes the database connections of the request
+            await sync_to_async(response.close, thread_sensitive=True)()
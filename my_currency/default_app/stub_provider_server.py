@@ -0,0 +1,62 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import sys
+import threading
+import time
+
+
+class StubProviderRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests, like real providers do
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so without this kept-alive connections wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        route = self.server.routes.get(self.path.split('?')[0].strip('/').split('/')[0], {})
+        self.server.requests_count += 1
+        time.sleep(route.get('delay', 0))
+        status = route.get('status', 200)
+        body = json.dumps(route.get('json', {'success': False})).encode('utf-8') if status == 200 else b'Internal error'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json' if status == 200 else 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProviderServer(ThreadingHTTPServer):
+    """
+    Local HTTP server imitating Fixer-like providers, for tests and benchmarks.
+
+    Each route is the first path segment of the url (e.g. http://127.0.0.1:<port>/slow/latest?base=EUR
+    is the 'slow' route) and is configured with the 'json' to return, a 'delay' in seconds before
+    answering, and a 'status' (anything but 200 answers a non-JSON error body).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, routes=None):
+        super().__init__(('127.0.0.1', 0), StubProviderRequestHandler)
+        self.routes = routes or {}
+        self.requests_count = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow routes (timeouts) close the connection before the answer
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
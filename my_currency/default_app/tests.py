@@ -1,8 +1,33 @@
-from django.test import TestCase
+from django.test import AsyncRequestFactory, RequestFactory, TestCase
 from rest_framework.test import APITestCase
-from default_app.models import Currency, CurrencyExchangeRate, Provider
+from default_app.models import Currency, CurrencyExchangeRate, Provider, SiteConfiguration, scale_rate
+from default_app.providers import FileBackedProvider, StoredDataProvider, TriangulatedDataProvider
+from default_app.triangulation import derived_rates_cache
+from default_app.rate_matrix import rate_matrix, RateMatrix
+from default_app.timeseries import Timeseries
+from default_app.provider_registry import ProviderChainRegistry, provider_chain_registry
+from default_app.views import get_sorted_provider_list, currency_converter, acurrency_converter, currency_converter_for_all_currencies, \
+    acurrency_converter_for_all_currencies, get_list_of_rates_for_time_period, aget_list_of_rates_for_time_period, get_rates_dict_from_some_provider
+from default_app.rate_files import iter_json_array, iter_rates
+from default_app.broadcast import RateBroadcaster, rate_broadcaster
+from default_app.recent_rates import recent_rates, RecentRatesBuffer
+from django.core.management import call_command, CommandError
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from unittest import skipUnless
 from unittest.mock import patch
-from datetime import datetime
+from asgiref.sync import sync_to_async
+import asyncio
+from datetime import date, datetime
+from decimal import Decimal
+import gzip
+import io
+import json
+import os
+import pickle
+import tempfile
 import time
 
 
@@ -14,9 +39,14 @@ class MockResponse():
         return self.js
 
 # Create your tests here.
+# Provider answers are mocked on the pooled requests client, which the async views also use
 class APIV1Test(APITestCase):
     def setUp(self):
         self.maxDiff = None
+        cache.clear()
+        rate_matrix.invalidate()
+        derived_rates_cache.invalidate()
+        provider_chain_registry.invalidate()
 
     def test_mock_provider(self):
         response = self.client.get(
@@ -38,6 +68,32 @@ class APIV1Test(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'value': 4.44, 'rate': 2.22})
 
+    def test_file_backed_provider(self):
+        with tempfile.TemporaryDirectory() as directory:
+            class TemporaryFileProvider(FileBackedProvider):
+                path_from_this_folder = os.path.join(directory, 'rates.json')
+
+            def write_rates(rates, mtime):
+                with open(TemporaryFileProvider.path_from_this_folder, 'w') as f:
+                    json.dump({'success': True, 'rates': rates}, f)
+                os.utime(TemporaryFileProvider.path_from_this_folder, (mtime, mtime))
+
+            write_rates({'2020-01-03': {'USD': 1.3}, '2020-01-01': {'USD': 1.1}, '2020-01-02': {'USD': 1.2}}, 1000)
+            provider = TemporaryFileProvider()
+            with patch('default_app.providers.json.load', wraps=json.load) as mock_json_load:
+                self.assertEqual(provider.get_latest_rates_dict('EUR'), {'USD': 1.3})
+                self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-02', '2020-01-05'), {
+                    '2020-01-02': {'USD': 1.2}, '2020-01-03': {'USD': 1.3}
+                })
+                self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-03', '2020-01-01'), {})
+                # Answers are copies, changing them does not change the loaded file
+                provider.get_latest_rates_dict('EUR')['USD'] = 0
+                self.assertEqual(TemporaryFileProvider().get_latest_rates_dict('EUR'), {'USD': 1.3})
+                self.assertEqual(mock_json_load.call_count, 1)
+                write_rates({'2020-01-04': {'USD': 1.4}}, 2000)
+                self.assertEqual(provider.get_latest_rates_dict('EUR'), {'USD': 1.4})
+                self.assertEqual(mock_json_load.call_count, 2)
+
     def test_stored_data_provider(self):
         usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
         eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
@@ -81,6 +137,277 @@ class APIV1Test(APITestCase):
             'At 2020-01-03, 1 EUR = 1.130000 USD'
         ])
 
+    @patch('default_app.providers.RATE_MATRIX_ENABLED', False)
+    def test_stored_data_provider_latest_rates_single_query(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        aud = Currency.objects.create(code="AUD", name="Australian Dollar", symbol="$")
+        for exchanged_currency, valuation_date, rate_value in [
+            (usd, "2020-01-01", 1.11), (usd, "2020-01-03", 1.13), (usd, "2020-01-02", 1.12),
+            (gbp, "2019-12-31", 0.85), (gbp, "2019-12-30", 0.86),
+            (aud, "2020-01-05", 1.61),
+        ]:
+            CurrencyExchangeRate.objects.create(
+                source_currency=eur,
+                exchanged_currency=exchanged_currency,
+                valuation_date=datetime.strptime(valuation_date, '%Y-%m-%d'),
+                rate_value=rate_value
+            )
+        # Rates from another base currency must not leak into EUR's
+        CurrencyExchangeRate.objects.create(
+            source_currency=usd,
+            exchanged_currency=gbp,
+            valuation_date=datetime.strptime("2021-01-01", '%Y-%m-%d'),
+            rate_value=0.75
+        )
+        with self.assertNumQueries(1):
+            rates = StoredDataProvider().get_latest_rates_dict('EUR')
+        self.assertEqual(rates, {'AUD': 1.61, 'GBP': 0.85, 'USD': 1.13})
+        self.assertEqual(list(rates.keys()), ['AUD', 'GBP', 'USD'])
+        with self.assertNumQueries(1):
+            self.assertEqual(StoredDataProvider().get_latest_rates_dict('ABC'), {})
+
+    def test_stored_data_provider_timeseries_single_query(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        for day in range(1, 21):
+            for exchanged_currency, rate_value in [(usd, 1.1), (gbp, 0.8)]:
+                CurrencyExchangeRate.objects.create(
+                    source_currency=eur,
+                    exchanged_currency=exchanged_currency,
+                    valuation_date=datetime(2020, 1, day),
+                    rate_value=rate_value + day / 100
+                )
+        with self.assertNumQueries(1):
+            rates = StoredDataProvider().get_rates_dict_timeseries('EUR', '2020-01-05', '2020-01-07')
+        self.assertEqual(rates, {
+            '2020-01-05': {'USD': 1.15, 'GBP': 0.85},
+            '2020-01-06': {'USD': 1.16, 'GBP': 0.86},
+            '2020-01-07': {'USD': 1.17, 'GBP': 0.87},
+        })
+        with self.assertNumQueries(1):
+            self.assertEqual(len(StoredDataProvider().get_rates_dict_timeseries('EUR', '1900-01-01', '2100-01-01')), 20)
+        with self.assertNumQueries(1):
+            self.assertEqual(StoredDataProvider().get_rates_dict_timeseries('ABC', '1900-01-01', '2100-01-01'), {})
+
+    def test_scaled_integer_rates(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        rate = CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, 1), rate_value='1.1234565')
+        rate.refresh_from_db()
+        self.assertEqual((rate.rate_value, rate.rate_value_scaled), (Decimal('1.123456'), 1123456))
+        CurrencyExchangeRate.objects.bulk_upsert([
+            CurrencyExchangeRate(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, 1), rate_value='1.13'),
+            CurrencyExchangeRate(source_currency=eur, exchanged_currency=gbp, valuation_date=date(2020, 1, 1), rate_value=0.85),
+            CurrencyExchangeRate(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, 2), rate_value=1.14),
+        ])
+        CurrencyExchangeRate.objects.filter(exchanged_currency=gbp).update(rate_value=F('rate_value') * 2)
+        CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=gbp, valuation_date=date(2020, 1, 2), rate_value=12345678.000001)
+        usd_rates = list(CurrencyExchangeRate.objects.filter(exchanged_currency=usd).order_by('valuation_date'))
+        for usd_rate, rate_value in zip(usd_rates, ['1.131', '1.141']):
+            usd_rate.rate_value = rate_value
+        CurrencyExchangeRate.objects.bulk_update(usd_rates, ['rate_value'])
+        self.assertEqual(
+            list(CurrencyExchangeRate.objects.order_by('valuation_date', 'exchanged_currency__code').values_list('rate_value_scaled', flat=True)),
+            [1700000, 1131000, 12345678000001, 1141000]
+        )
+        provider = StoredDataProvider()
+        expected = {'2020-01-01': {'GBP': 1.7, 'USD': 1.131}, '2020-01-02': {'GBP': 12345678.000001, 'USD': 1.141}}
+        self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-02'), expected)
+        with patch('default_app.models.RATE_READ_SCALED_INTEGERS', True), patch('default_app.providers.RATE_MATRIX_ENABLED', False):
+            with self.assertNumQueries(1):
+                self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-02'), expected)
+            self.assertEqual(provider.get_latest_rates_dict('EUR'), expected['2020-01-02'])
+            self.assertEqual(provider.get_pair_timeseries('EUR', 'USD', '2020-01-01', '2020-01-02'), [('2020-01-01', 1.131), ('2020-01-02', 1.141)])
+        # Chunks are converted at once, and give the same floats as the Decimal of every row
+        rates = CurrencyExchangeRate.objects.order_by('valuation_date', 'exchanged_currency__code')
+        self.assertEqual(
+            [chunk_rates for _, chunk_rates in rates.iter_rate_chunks(chunk_size=3, scaled=True)],
+            [chunk_rates for _, chunk_rates in rates.iter_rate_chunks(chunk_size=3, scaled=False)]
+        )
+
+    def test_rate_matrix(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        for exchanged_currency, valuation_date, rate_value in [(usd, "2020-01-01", 1.11), (usd, "2020-01-02", 1.12), (gbp, "2020-01-01", 0.85)]:
+            CurrencyExchangeRate.objects.create(
+                source_currency=eur,
+                exchanged_currency=exchanged_currency,
+                valuation_date=datetime.strptime(valuation_date, '%Y-%m-%d'),
+                rate_value=rate_value
+            )
+        matrix = RateMatrix()
+        with self.assertNumQueries(1):
+            self.assertEqual(matrix.get_latest_rates_dict('EUR'), {'GBP': 0.85, 'USD': 1.12})
+            self.assertEqual(matrix.get_rate('EUR', 'USD'), 1.12)
+            self.assertIsNone(matrix.get_rate('USD', 'EUR'))
+            self.assertIsNone(matrix.get_rate('ABC', 'EUR'))
+            self.assertEqual(matrix.get_latest_rates_dict('ABC'), {})
+        # Older rates do not replace newer ones, new pairs and currencies are added
+        with self.assertNumQueries(0):
+            matrix.update('EUR', 'USD', datetime(2019, 1, 1).date(), 5)
+            matrix.update('EUR', 'GBP', datetime(2020, 1, 2).date(), 0.86)
+            matrix.update('USD', 'AUD', datetime(2020, 1, 2).date(), 1.5)
+            self.assertEqual(matrix.get_latest_rates_dict('EUR'), {'GBP': 0.86, 'USD': 1.12})
+            self.assertEqual(matrix.get_latest_rates_dict('USD'), {'AUD': 1.5})
+        self.assertEqual(matrix.inconsistencies(), [
+            ('EUR', 'GBP', 0.86, 0.85),
+            ('USD', 'AUD', 1.5, None),
+        ])
+        matrix.load()
+        self.assertEqual(matrix.inconsistencies(), [])
+        # The process-wide matrix follows the saved rates, and the converter answers from it without queries
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.12)
+        # Only the insert: the codes of the rate come from the instance, not from two more queries, and the
+        # pair is patched once the rate is committed
+        with self.assertNumQueries(1), TestCase.captureOnCommitCallbacks(execute=True):
+            rate = CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=datetime(2020, 1, 3), rate_value=1.13)
+            self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.12)
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.13)
+        version = rate_matrix.version
+        # An update moving the latest rate backwards reads the pair again, instead of reloading the matrix
+        with self.assertNumQueries(4), TestCase.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            rate.valuation_date, rate.rate_value = date(2019, 1, 1), 1.2
+            rate.save()
+        self.assertEqual(rate_matrix.version, version + 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.12)
+        # Rolled back rates are not applied
+        with self.assertRaises(ValueError), transaction.atomic():
+            CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=datetime(2020, 1, 4), rate_value=1.14)
+            raise ValueError()
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.12)
+        self.assertEqual(rate_matrix.inconsistencies(), [])
+        rate.valuation_date, rate.rate_value = date(2020, 1, 3), 1.13
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            rate.save()
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.13)
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/v1/calculate-exchange/',
+                data={"source_currency": "EUR", "amount": 2, "exchanged_currency": "USD"},
+            )
+        self.assertEqual(response.json(), {'success': True, 'value': 2 * 1.13, 'rate': 1.13})
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            CurrencyExchangeRate.objects.filter(valuation_date=datetime(2020, 1, 3)).delete()
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), 1.12)
+        self.assertEqual(rate_matrix.inconsistencies(), [])
+
+    def test_rate_matrix_max_age(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        rate = CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, 1), rate_value=1.1)
+        matrix = RateMatrix(max_age=60)
+        with patch('default_app.rate_matrix.time.monotonic', return_value=1000):
+            self.assertEqual(matrix.get_rate('EUR', 'USD'), 1.1)
+        # Written without signals, as another process would
+        CurrencyExchangeRate.objects.filter(pk=rate.pk).update(rate_value=1.2)
+        with patch('default_app.rate_matrix.time.monotonic', return_value=1059), self.assertNumQueries(0):
+            self.assertEqual(matrix.get_rate('EUR', 'USD'), 1.1)
+        with patch('default_app.rate_matrix.time.monotonic', return_value=1060), self.assertNumQueries(1):
+            self.assertEqual(matrix.get_rate('EUR', 'USD'), 1.2)
+
+    def test_provider_chain_max_age(self):
+        registry = ProviderChainRegistry(max_age=60)
+        with patch('default_app.provider_registry.time.monotonic', return_value=1000):
+            self.assertEqual(registry.get_providers(), ())
+        # Written without signals, as another process would
+        Provider.objects.bulk_create([Provider(name='other', access_key='key', priority=1)])
+        with patch('default_app.provider_registry.time.monotonic', return_value=1059), self.assertNumQueries(0):
+            self.assertEqual(registry.get_providers(), ())
+        with patch('default_app.provider_registry.time.monotonic', return_value=1060), self.assertNumQueries(1):
+            self.assertEqual([provider.name for provider in registry.get_providers()], ['other'])
+
+    def test_triangulated_rates(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        jpy = Currency.objects.create(code="JPY", name="Yen", symbol="¥")
+        for source_currency, exchanged_currency, valuation_date, rate_value in [
+            (eur, usd, "2020-01-01", 1.10), (eur, gbp, "2020-01-01", 0.80),
+            (eur, usd, "2020-01-02", 1.20), (eur, gbp, "2020-01-02", 0.90), (gbp, jpy, "2020-01-02", 140),
+        ]:
+            CurrencyExchangeRate.objects.create(
+                source_currency=source_currency,
+                exchanged_currency=exchanged_currency,
+                valuation_date=datetime.strptime(valuation_date, '%Y-%m-%d'),
+                rate_value=rate_value
+            )
+        # USD -> GBP is not stored, it is derived through EUR instead of asking the mock provider
+        response = self.client.get(
+            '/v1/calculate-exchange/',
+            data={"source_currency": "USD", "amount": 2, "exchanged_currency": "GBP"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.json()['rate'], 0.90 / 1.20)
+        self.assertAlmostEqual(response.json()['value'], 2 * 0.90 / 1.20)
+        response = self.client.get('/v1/current-rate-conversion/', data={"source_currency": "USD"})
+        self.assertEqual(list(response.json()['rates'].keys()), ['EUR', 'GBP', 'JPY'])
+        self.assertAlmostEqual(response.json()['rates']['EUR'], 1 / 1.20)
+        self.assertAlmostEqual(response.json()['rates']['JPY'], 0.90 / 1.20 * 140)
+        response = self.client.get(
+            '/v1/rates-for-time-period/',
+            data={"source_currency": "USD", "date_from": "2020-01-01", "date_to": "2020-01-02"},
+        )
+        rates = response.json()['rates']
+        self.assertEqual(list(rates.keys()), ['2020-01-01', '2020-01-02'])
+        self.assertEqual(list(rates['2020-01-01'].keys()), ['EUR', 'GBP'])
+        self.assertAlmostEqual(rates['2020-01-01']['GBP'], 0.80 / 1.10)
+        self.assertAlmostEqual(rates['2020-01-02']['JPY'], 0.90 / 1.20 * 140)
+        # Derived rates are computed once per date and dropped when a rate of that date changes. A period
+        # inside one already requested does not even ask for its dates
+        with self.assertNumQueries(0):
+            TriangulatedDataProvider().get_rates_dict_timeseries('USD', '2020-01-01', '2020-01-02')
+            TriangulatedDataProvider().get_rates_dict_timeseries('USD', '2020-01-02', '2020-01-02')
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            CurrencyExchangeRate.objects.create(source_currency=usd, exchanged_currency=gbp, valuation_date=datetime(2020, 1, 2), rate_value=0.7)
+        with self.assertNumQueries(2):
+            TriangulatedDataProvider().get_rates_dict_timeseries('USD', '2020-01-01', '2020-01-02')
+        self.assertEqual(TriangulatedDataProvider().get_rates_dict_timeseries('USD', '2020-01-02', '2020-01-02')['2020-01-02']['GBP'], 0.7)
+        self.assertEqual(TriangulatedDataProvider().get_latest_rates_dict('USD')['GBP'], 0.7)
+        self.assertEqual(TriangulatedDataProvider().get_latest_rates_dict('ABC'), {})
+
+    def test_rates_for_time_period_streaming(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        for day in range(1, 4):
+            for exchanged_currency, rate_value in [(usd, 1.1), (gbp, 0.8)]:
+                CurrencyExchangeRate.objects.create(
+                    source_currency=eur,
+                    exchanged_currency=exchanged_currency,
+                    valuation_date=datetime(2020, 1, day),
+                    rate_value=rate_value + day / 100
+                )
+        data = {"source_currency": "EUR", "date_from": "2020-01-01", "date_to": "2020-01-02"}
+        response = self.client.get('/v1/rates-for-time-period/', data=data)
+        self.assertFalse(response.streaming)
+        response_streaming = self.client.get('/v1/rates-for-time-period/', data=dict(data, stream='true'))
+        self.assertEqual(response_streaming.status_code, 200)
+        self.assertTrue(response_streaming.streaming)
+        self.assertEqual(response_streaming['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(response_streaming.streaming_content)), response.json())
+        self.assertEqual(response.json(), {'success': True, 'rates': {
+            '2020-01-01': {'USD': 1.11, 'GBP': 0.81},
+            '2020-01-02': {'USD': 1.12, 'GBP': 0.82},
+        }})
+        # Providers without a day by day source (the mock one here) are streamed too
+        response_streaming = self.client.get(
+            '/v1/rates-for-time-period/',
+            data={"source_currency": "ABC", "date_from": "1900-01-01", "date_to": "2100-01-01", "stream": "true"}
+        )
+        self.assertEqual(response_streaming.status_code, 200)
+        self.assertTrue(len(json.loads(b''.join(response_streaming.streaming_content))['rates']) > 0)
+        response = self.client.get(
+            '/v1/rates-for-time-period/',
+            data={"source_currency": "EUR", "date_from": "1800-01-01", "date_to": "1800-01-02", "stream": "true"}
+        )
+        self.assertEqual(response.status_code, 400)
+
     def test_different_providers(self):
         usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
         eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
@@ -158,6 +485,85 @@ class APIV1Test(APITestCase):
         )
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'value': 2 * 0.05, 'rate': 0.05})
+        # The provider chain is cached: no provider queries, and unknown providers are ignored
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [provider.name for provider in get_sorted_provider_list('Provider 3')],
+                ['Provider 3', 'Stored Data Provider', 'Triangulated Data Provider', 'Provider 2', 'Provider 1', 'Mock Provider']
+            )
+            self.assertEqual(
+                [provider.name for provider in get_sorted_provider_list('Unknown')],
+                ['Stored Data Provider', 'Triangulated Data Provider', 'Provider 2', 'Provider 1', 'Provider 3', 'Mock Provider']
+            )
+        response = self.client.get(
+            '/v1/calculate-exchange/',
+            data={"source_currency": "EUR", "amount": 2, "exchanged_currency": "GBP", "provider": "Unknown"},
+        )
+        self.assertEqual(response.json(), {'success': True, 'value': 2 * 10, 'rate': 10})
+        Provider.objects.get(name='Provider 3').delete()
+        self.assertEqual(len(get_sorted_provider_list(None)), 5)
+
+    def test_batch_conversion(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        for valuation_date, usd_rate, gbp_rate in [("2020-01-01", 1.1, 0.8), ("2020-01-02", 1.2, 0.9)]:
+            for exchanged_currency, rate_value in [(usd, usd_rate), (gbp, gbp_rate)]:
+                CurrencyExchangeRate.objects.create(
+                    source_currency=eur,
+                    exchanged_currency=exchanged_currency,
+                    valuation_date=datetime.strptime(valuation_date, '%Y-%m-%d'),
+                    rate_value=rate_value
+                )
+        Provider.objects.create(name='Provider 1', access_key='123', historical_hardcoded_json={
+            'success': True, 'rates': {'2020-01-02': {'ABC': 0.05}}
+        })
+        items = [
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 2},
+            {'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'amount': 10, 'date': '2020-01-01'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD'},
+            {'source_currency': 'USD', 'exchanged_currency': 'GBP', 'amount': 1.2},
+            {'source_currency': 'EUR', 'exchanged_currency': 'ABC', 'amount': 100},
+            {'source_currency': 'EUR', 'exchanged_currency': 'XYZ', 'amount': 1},
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 1, 'date': '2020-01-05'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'ABC', 'amount': 10, 'date': '2020-01-02'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'XYZ', 'amount': 2},
+        ]
+        # Latest and daily rates of EUR, latest of USD, then the chain once per missing pair (the second XYZ is not asked again)
+        with patch('default_app.views.get_rates_dict_from_some_provider', wraps=get_rates_dict_from_some_provider) as get_rates:
+            response = self.client.post('/v1/calculate-exchange/batch/', data={'items': items}, format='json')
+        self.assertEqual(get_rates.call_count, 7)
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(results[0], {'success': True, 'value': 2 * 1.2, 'rate': 1.2})
+        self.assertEqual(results[1], {'success': True, 'value': 10 * 0.8, 'rate': 0.8})
+        self.assertEqual(results[2], {'success': True, 'value': 1.2, 'rate': 1.2})
+        self.assertAlmostEqual(results[3]['value'], 0.9)
+        self.assertEqual(results[4], {'success': True, 'value': 100 * 0.05, 'rate': 0.05})
+        self.assertEqual(results[5], {'success': False, 'error': 'Could not convert the currency'})
+        self.assertEqual(results[6], {'success': False, 'error': 'Could not convert the currency'})
+        # Dated items fall back to the next providers of the chain too
+        self.assertEqual(results[7], {'success': True, 'value': 10 * 0.05, 'rate': 0.05})
+        self.assertEqual(results[8], results[5])
+        # Same answers as the single conversions
+        for item, result in zip(items, results):
+            if 'date' not in item:
+                single = self.client.get('/v1/calculate-exchange/', data=item)
+                self.assertEqual(single.json() if single.status_code == 200 else {'success': False, 'error': single.content.decode()}, result)
+        response = self.client.post('/v1/calculate-exchange/batch/', data={'items': [
+            {'source_currency': 'EUR', 'amount': 'a'}, {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'date': '01/01/2020'}, 'EUR',
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 'nan'}, {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': '-inf'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'errors': [
+            'items[0].exchanged_currency is required.',
+            'items[0].amount a is not a number.',
+            'items[1].date 01/01/2020 is not in the format YYYY-MM-DD.',
+            'items[2] must be an object.',
+            'items[3].amount nan is not a finite number.',
+            'items[4].amount -inf is not a finite number.',
+        ]})
+        self.assertEqual(self.client.post('/v1/calculate-exchange/batch/', data={'items': []}, format='json').status_code, 400)
 
     def test_time_weighted_exchange(self):
         usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
@@ -216,14 +622,52 @@ class APIV1Test(APITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'values': {}, 'success': True})
 
-    @patch('default_app.models.requests.get')
+    def test_time_weighted_exchange_single_pair_and_aggregates(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        gbp = Currency.objects.create(code="GBP", name="Pound", symbol="£")
+        for valuation_date, usd_rate in [("2020-01-01", 1.0), ("2020-01-04", 2.0), ("2020-01-05", 1.5)]:
+            for exchanged_currency, rate_value in [(usd, usd_rate), (gbp, 0.8)]:
+                CurrencyExchangeRate.objects.create(
+                    source_currency=eur,
+                    exchanged_currency=exchanged_currency,
+                    valuation_date=datetime.strptime(valuation_date, '%Y-%m-%d'),
+                    rate_value=rate_value
+                )
+        data = {"source_currency": "EUR", "amount": 2, "exchanged_currency": "USD", "start_date": "2020-01-01"}
+        # Only the requested pair is read
+        with self.assertNumQueries(1):
+            response = self.client.get('/v1/calculate-exchange-twrr/', data=data)
+        self.assertEqual(response.json(), {'success': True, 'values': {"2020-01-01": 2.0, "2020-01-04": 4.0, "2020-01-05": 3.0}})
+        with self.assertNumQueries(2):
+            response = self.client.get('/v1/calculate-exchange-twrr/', data=dict(data, aggregates='true'))
+        aggregates = response.json()['aggregates']
+        self.assertEqual({key: aggregates[key] for key in ('mean', 'min', 'max')}, {'mean': 3.0, 'min': 2.0, 'max': 4.0})
+        # 2.0 holds 3 days, 4.0 one day, and 3.0 from 2020-01-05 until today
+        days_of_last_value = (datetime.now().date() - datetime(2020, 1, 5).date()).days + 1
+        self.assertAlmostEqual(aggregates['time_weighted_average'], (2.0 * 3 + 4.0 + 3.0 * days_of_last_value) / (4 + days_of_last_value))
+        Provider.objects.create(name='Provider 1', access_key='123', historical_hardcoded_json={
+            'success': True, 'rates': {'2020-01-01': {'USD': 1.0}, '2020-01-03': {'USD': 3.0}}
+        })
+        response = self.client.get('/v1/calculate-exchange-twrr/', data=dict(data, aggregates='true', provider='Provider 1'))
+        self.assertEqual(response.json()['values'], {"2020-01-01": 2.0, "2020-01-03": 6.0})
+        self.assertEqual(response.json()['aggregates']['max'], 6.0)
+        # A negative amount: the min and max of the stored aggregates are swapped, the ones of the values are not
+        for provider_name, expected in [(None, {'min': -4.0, 'max': -2.0}), ('Provider 1', {'min': -6.0, 'max': -2.0})]:
+            negative_data = dict(data, amount=-2, aggregates='true')
+            if provider_name:
+                negative_data['provider'] = provider_name
+            aggregates = self.client.get('/v1/calculate-exchange-twrr/', data=negative_data).json()['aggregates']
+            self.assertEqual({key: aggregates[key] for key in ('min', 'max')}, expected)
+
+    @patch('default_app.models.http_client.get')
     def test_fixer_provider(self, mock_requests_get):
         today_date = datetime.now().strftime("%Y-%m-%d")
         usd_rate_1 = 1.322891
         usd_rate_2 = 1.315066
         usd_rate_3 = 1.314491
         usd_rate_latest = 1.23396
-        def side_effect_mock_requests_get(url, *args):
+        def side_effect_mock_requests_get(url, *args, **kwargs):
             if 'api/timeseries' in url:
                 if 'start_date=2020-01-01' in url:
                     start_date = '2020-01-01'
@@ -326,7 +770,7 @@ class APIV1Test(APITestCase):
             '/v1/rates-for-time-period/',
             data={"source_currency": "EUR", "exchanged_currency": "USD", "date_from": "2020-01-02"},
         )
-        self.assertEqual(mock_requests_get.call_count, 4)
+        self.assertEqual(mock_requests_get.call_count, 3) # No new call, the period is inside the cached one
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'rates': {
             # '2020-01-01': {'AUD': 1.278047, 'CAD': 1.302303, 'USD': usd_rate_1},
@@ -338,7 +782,7 @@ class APIV1Test(APITestCase):
             '/v1/current-rate-conversion/',
             data={"source_currency": "EUR"},
         )
-        self.assertEqual(mock_requests_get.call_count, 4) # No new call because of cache
+        self.assertEqual(mock_requests_get.call_count, 3) # No new call because of cache
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'rates': {
             'AUD': 1.566015,
@@ -351,17 +795,18 @@ class APIV1Test(APITestCase):
         }})
 
         # default provider is stored data if not specified
-        CurrencyExchangeRate.objects.create(
-            source_currency=Currency.objects.create(code="EUR", name="Euro", symbol="€"),
-            exchanged_currency=Currency.objects.create(code="USD", name="USD Dollar", symbol="$"),
-            valuation_date=datetime.strptime("2019-01-01", '%Y-%m-%d'),
-            rate_value=5
-        )
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            CurrencyExchangeRate.objects.create(
+                source_currency=Currency.objects.create(code="EUR", name="Euro", symbol="€"),
+                exchanged_currency=Currency.objects.create(code="USD", name="USD Dollar", symbol="$"),
+                valuation_date=datetime.strptime("2019-01-01", '%Y-%m-%d'),
+                rate_value=5
+            )
         response = self.client.get(
             '/v1/current-rate-conversion/',
             data={"source_currency": "EUR"},
         )
-        self.assertEqual(mock_requests_get.call_count, 4) # No new call because of cache
+        self.assertEqual(mock_requests_get.call_count, 3) # No new call because of cache
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'rates': {
             'USD': 5
@@ -371,7 +816,7 @@ class APIV1Test(APITestCase):
             '/v1/current-rate-conversion/',
             data={"source_currency": "EUR", "provider": "Fixer"},
         )
-        self.assertEqual(mock_requests_get.call_count, 4) # No new call because of cache
+        self.assertEqual(mock_requests_get.call_count, 3) # No new call because of cache
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'rates': {
             'AUD': 1.566015,
@@ -383,7 +828,7 @@ class APIV1Test(APITestCase):
             'USD': usd_rate_latest
         }})
         # If not found stored data, using Fixer
-        def side_effect_mock_requests_get(url, *args):
+        def side_effect_mock_requests_get(url, *args, **kwargs):
             self.assertEqual(url, 'http://data.fixer.io/api/latest?access_key=asd&base=ABC')
             return MockResponse(js={
                 "success": True,
@@ -399,36 +844,629 @@ class APIV1Test(APITestCase):
             '/v1/current-rate-conversion/',
             data={"source_currency": "ABC"},
         )
-        self.assertEqual(mock_requests_get.call_count, 5) # New call because url changed
+        self.assertEqual(mock_requests_get.call_count, 4) # New call because url changed
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {'success': True, 'rates': {
             'USD': usd_rate_latest
         }})
 
+    @patch('default_app.models.http_client.get')
+    def test_write_through_provider(self, mock_requests_get):
+        def side_effect_mock_requests_get(url, *args, **kwargs):
+            if 'api/timeseries' in url:
+                return MockResponse({'success': True, 'rates': {
+                    '2020-01-01': {'USD': 1.11, 'AUD': 1.61},
+                    '2020-01-02': {'USD': 1.12, 'AUD': 1.62},
+                }})
+            return MockResponse({'success': True, 'date': '2020-01-02', 'rates': {'USD': 1.125, 'GBP': 0.85}})
+        mock_requests_get.side_effect = side_effect_mock_requests_get
+        Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        Provider.objects.create(
+            name='Fixer', access_key='asd', priority=1, is_default=True, write_through=True,
+            timeseries_endpoint='http://data.fixer.io/api/timeseries?access_key={0}&base={1}&start_date={2}&end_date={3}',
+            latest_endpoint='http://data.fixer.io/api/latest?access_key={0}&base={1}'
+        )
+        data = {"source_currency": "EUR", "date_from": "2020-01-01", "date_to": "2020-01-02"}
+        response = self.client.get('/v1/rates-for-time-period/', data=data)
+        self.assertEqual(mock_requests_get.call_count, 1)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 4)
+        self.assertEqual(Currency.objects.get(code='AUD').name, '')
+        # Later requests are served by the stored data, even once the provider cache expired
+        cache.clear()
+        response_from_db = self.client.get('/v1/rates-for-time-period/', data=data)
+        self.assertEqual(mock_requests_get.call_count, 1)
+        self.assertEqual(response_from_db.json(), response.json())
+        # Latest answers are upserted in the day given by the provider
+        response = self.client.get('/v1/calculate-exchange/', data={"source_currency": "EUR", "exchanged_currency": "GBP", "provider": "Fixer"})
+        self.assertEqual(response.json(), {'success': True, 'value': 0.85, 'rate': 0.85})
+        self.assertEqual(mock_requests_get.call_count, 2)
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 5)
+        self.assertEqual(StoredDataProvider().get_latest_rates_dict('EUR'), {'AUD': 1.62, 'GBP': 0.85, 'USD': 1.125})
+        # Stored with one query for the rates (plus two to resolve the currencies)
+        with self.assertNumQueries(3):
+            CurrencyExchangeRate.objects.upsert_rates('EUR', {'2020-01-03': {'USD': 1.13, 'AUD': 1.63, 'GBP': 0.86}})
+        derived_rates = TriangulatedDataProvider().get_rates_dict_timeseries('GBP', '2020-01-03', '2020-01-03')['2020-01-03']
+        self.assertEqual(sorted(derived_rates), ['AUD', 'EUR', 'USD'])
+        self.assertAlmostEqual(derived_rates['AUD'], 1.63 / 0.86)
+        self.assertAlmostEqual(derived_rates['USD'], 1.13 / 0.86)
+
+    @patch('default_app.models.http_client.get')
+    def test_provider_timeseries_fetches_only_missing_days(self, mock_requests_get):
+        requested_periods = []
+        def side_effect_mock_requests_get(url, *args, **kwargs):
+            start_date, end_date = url.split('start_date=')[1].split('&end_date=')
+            requested_periods.append((start_date, end_date))
+            # Rates every day but the 4th of each month, that the provider does not have
+            return MockResponse({'success': True, 'rates': {
+                '2020-01-{:02d}'.format(day): {'USD': 1 + day / 100}
+                for day in range(int(start_date[-2:]), int(end_date[-2:]) + 1) if day != 4
+            }})
+        mock_requests_get.side_effect = side_effect_mock_requests_get
+        provider = Provider.objects.create(
+            name='Fixer', access_key='asd', priority=1, is_default=True,
+            timeseries_endpoint='http://data.fixer.io/api/timeseries?access_key={0}&base={1}&start_date={2}&end_date={3}',
+        )
+        self.assertEqual(list(provider.get_rates_dict_timeseries('EUR', '2020-01-05', '2020-01-10').keys()), [
+            '2020-01-05', '2020-01-06', '2020-01-07', '2020-01-08', '2020-01-09', '2020-01-10'
+        ])
+        rates = provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-12')
+        self.assertEqual(len(rates), 11)
+        self.assertEqual(list(rates.keys())[:4], ['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-05'])
+        self.assertEqual(rates['2020-01-12'], {'USD': 1.12})
+        self.assertEqual(requested_periods, [
+            ('2020-01-05', '2020-01-10'), ('2020-01-01', '2020-01-04'), ('2020-01-11', '2020-01-12'),
+        ])
+        # Any sub-period, including the missing day, is answered from the cache
+        self.assertEqual(list(provider.get_rates_dict_timeseries('EUR', '2020-01-03', '2020-01-05').keys()), ['2020-01-03', '2020-01-05'])
+        self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-04', '2020-01-04'), {})
+        self.assertEqual(len(requested_periods), 3)
+        # Other base currencies have their own days
+        provider.get_rates_dict_timeseries('USD', '2020-01-03', '2020-01-05')
+        self.assertEqual(requested_periods[3:], [('2020-01-03', '2020-01-05')])
+
+
+from default_app.stub_provider_server import StubProviderServer
+from default_app.streaming import AsyncStreamingASGIHandler, AsyncStreamingHttpResponse
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from default_app.http_client import ProviderHttpClient
+import requests
+
+
+@patch('default_app.views.PROVIDER_FANOUT_ENABLED', True)
+@patch('default_app.views.PROVIDER_TIMEOUT_IN_SECONDS', 0.5)
+@patch('default_app.models.http_client.timeout', 0.5)
+@patch('default_app.models.http_client.retries', 0)
+class ProviderFanOutTest(APITestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        cache.clear()
+        rate_matrix.invalidate()
+        derived_rates_cache.invalidate()
+        provider_chain_registry.invalidate()
+
+    def _create_http_provider(self, server, route, priority):
+        return Provider.objects.create(
+            name=route, access_key='key', priority=priority,
+            latest_endpoint=server.base_url + '/' + route + '/latest?access_key={0}&base={1}'
+        )
+
+    def _latest_json(self, usd_rate):
+        return {'success': True, 'base': 'EUR', 'rates': {'USD': usd_rate}}
+
+    def test_slow_and_failing_providers_do_not_stall_the_request(self):
+        routes = {
+            'slow': {'delay': 2, 'json': self._latest_json(1.1)},
+            'failing': {'status': 500},
+            'good': {'delay': 0.1, 'json': self._latest_json(1.3)},
+            'fast': {'json': self._latest_json(1.4)},
+        }
+        with StubProviderServer(routes) as server:
+            for priority, route in enumerate(['fast', 'good', 'failing', 'slow']):
+                self._create_http_provider(server, route, priority)
+            start = time.monotonic()
+            response = self.client.get(
+                '/v1/calculate-exchange/',
+                data={"source_currency": "EUR", "amount": 2, "exchanged_currency": "USD"},
+            )
+            elapsed = time.monotonic() - start
+            # The slow provider timed out and the failing one errored: 'good' has the highest priority
+            # among the successful ones, even though 'fast' answered before it
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {'success': True, 'value': 2 * 1.3, 'rate': 1.3})
+            self.assertLess(elapsed, 1.5)
+            self.assertEqual(server.requests_count, 4)
+
+    def test_all_providers_failing_falls_back_to_mock_provider(self):
+        routes = {'slow': {'delay': 2, 'json': self._latest_json(1.1)}, 'failing': {'status': 500}}
+        with StubProviderServer(routes) as server:
+            self._create_http_provider(server, 'slow', 2)
+            self._create_http_provider(server, 'failing', 1)
+            start = time.monotonic()
+            response = self.client.get(
+                '/v1/calculate-exchange/',
+                data={"source_currency": "EUR", "amount": 2, "exchanged_currency": "USD"},
+            )
+            self.assertLess(time.monotonic() - start, 1.5)
+            self.assertEqual(response.json(), {'success': True, 'value': 4.44, 'rate': 2.22})
+
+    def test_workers_close_their_database_connections(self):
+        routes = {'good': {'json': self._latest_json(1.3)}, 'failing': {'status': 500}}
+        with StubProviderServer(routes) as server, patch('default_app.views.close_old_connections') as close_old_connections:
+            self._create_http_provider(server, 'good', 1)
+            self._create_http_provider(server, 'failing', 2)
+            self.assertEqual(get_rates_dict_from_some_provider(None, 'EUR'), {'USD': 1.3})
+            # Also after a failed call
+            self.assertEqual(close_old_connections.call_count, 2)
+
+    def test_local_providers_answer_before_remote_ones_are_queried(self):
+        with StubProviderServer({'good': {'json': self._latest_json(1.3)}}) as server:
+            self._create_http_provider(server, 'good', 1)
+            CurrencyExchangeRate.objects.create(
+                source_currency=Currency.objects.create(code="EUR", name="Euro", symbol="€"),
+                exchanged_currency=Currency.objects.create(code="USD", name="US Dollar", symbol="$"),
+                valuation_date=datetime(2020, 1, 1),
+                rate_value=1.11
+            )
+            response = self.client.get('/v1/current-rate-conversion/', data={"source_currency": "EUR"})
+            self.assertEqual(response.json(), {'success': True, 'rates': {'USD': 1.11}})
+            self.assertEqual(server.requests_count, 0)
+            response = self.client.get('/v1/current-rate-conversion/', data={"source_currency": "EUR", "provider": "good"})
+            self.assertEqual(response.json(), {'success': True, 'rates': {'USD': 1.3}})
+            self.assertEqual(server.requests_count, 1)
+
+
+@patch('default_app.models.http_client.timeout', 0.5)
+@patch('default_app.models.http_client.retries', 2)
+class ProviderSequentialTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        rate_matrix.invalidate()
+        derived_rates_cache.invalidate()
+        provider_chain_registry.invalidate()
+
+    def test_timed_out_provider_falls_through_to_the_next_one(self):
+        routes = {'slow': {'delay': 2, 'json': {'success': True, 'base': 'EUR', 'rates': {'USD': 1.1}}}}
+        with StubProviderServer(routes) as server:
+            Provider.objects.create(name='slow', access_key='key', latest_endpoint=server.base_url + '/slow/latest?access_key={0}&base={1}')
+            start = time.monotonic()
+            response = self.client.get(
+                '/v1/calculate-exchange/',
+                data={"source_currency": "EUR", "amount": 2, "exchanged_currency": "USD"},
+            )
+            self.assertLess(time.monotonic() - start, 1.5)
+            self.assertEqual(server.requests_count, 1)
+        self.assertEqual(response.json(), {'success': True, 'value': 4.44, 'rate': 2.22})
+
+    async def test_async_timed_out_provider_falls_through_to_the_next_one(self):
+        routes = {'slow': {'delay': 2, 'json': {'success': True, 'base': 'EUR', 'rates': {'USD': 1.1}}}}
+        with StubProviderServer(routes) as server:
+            await Provider.objects.acreate(name='slow', access_key='key', latest_endpoint=server.base_url + '/slow/latest?access_key={0}&base={1}')
+            response = await acurrency_converter(RequestFactory().get('/', data={'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 2}))
+        self.assertEqual(json.loads(response.content), {'success': True, 'value': 4.44, 'rate': 2.22})
+
+
+async def get_asgi_body(response):
+    # Body of the response as sent by the ASGI handler of the project
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    # As the test client does, the transaction of the test is not closed with the request
+    request_finished.disconnect(close_old_connections)
+    try:
+        await AsyncStreamingASGIHandler().send_response(response, send)
+    finally:
+        request_finished.connect(close_old_connections)
+    return b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class AsyncViewsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        rate_matrix.invalidate()
+        derived_rates_cache.invalidate()
+        provider_chain_registry.invalidate()
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        for day, rate_value in [(1, 1.1), (2, 1.2)]:
+            CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, day), rate_value=rate_value)
+
+    async def test_async_views_answer_as_the_sync_views(self):
+        factory = RequestFactory()
+        requests = [
+            (currency_converter, acurrency_converter, {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'amount': 2}),
+            (currency_converter, acurrency_converter, {'source_currency': 'USD', 'exchanged_currency': 'EUR'}),
+            (currency_converter_for_all_currencies, acurrency_converter_for_all_currencies, {'source_currency': 'EUR'}),
+            (get_list_of_rates_for_time_period, aget_list_of_rates_for_time_period, {'source_currency': 'EUR', 'date_from': '2020-01-01', 'date_to': '2020-01-31'}),
+            (get_list_of_rates_for_time_period, aget_list_of_rates_for_time_period, {'source_currency': 'EUR', 'date_from': '2020-01-02', 'date_to': '2020-01-31', 'stream': 'true'}),
+            # Without a SiteConfiguration, date_from defaults to its min_date
+            (get_list_of_rates_for_time_period, aget_list_of_rates_for_time_period, {'source_currency': 'EUR'}),
+        ]
+        for view, async_view, data in requests:
+            response = await sync_to_async(view)(factory.get('/', data=data))
+            async_response = await async_view(AsyncRequestFactory().get('/', data=data))
+            self.assertEqual(async_response.status_code, response.status_code)
+            self.assertEqual(async_response.status_code, 200)
+            self.assertEqual(isinstance(async_response, AsyncStreamingHttpResponse), 'stream' in data)
+            self.assertEqual(await get_asgi_body(async_response), await sync_to_async(b''.join)(response) if response.streaming else response.content)
+        self.assertFalse(await SiteConfiguration.objects.aexists())
+        with patch('default_app.providers.RATE_MATRIX_ENABLED', False):
+            response = await self.async_client.get('/v1/current-rate-conversion/', data={'source_currency': 'EUR'})
+        self.assertEqual(response.json(), {'success': True, 'rates': {'USD': 1.2}})
+        response = await self.async_client.post('/v1/calculate-exchange/', data={'source_currency': 'EUR'})
+        self.assertEqual(response.status_code, 405)
+
+    @patch('default_app.models.http_client.retries', 0)
+    async def test_concurrent_requests_do_not_wait_for_each_other(self):
+        routes = {'slow': {'delay': 0.5, 'json': {'success': True, 'rates': {'USD': 1.3}}}}
+        with StubProviderServer(routes) as server:
+            await Provider.objects.acreate(name='slow', access_key='key', latest_endpoint=server.base_url + '/slow/latest?access_key={0}&base={1}')
+            start = time.monotonic()
+            # Different base currencies, so every request gets the rates from the provider
+            responses = await asyncio.gather(*(
+                acurrency_converter(RequestFactory().get('/', data={'source_currency': 'B{}'.format(index), 'exchanged_currency': 'USD', 'provider': 'slow'}))
+                for index in range(8)
+            ))
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(server.requests_count, 8)
+        self.assertEqual([json.loads(response.content)['rate'] for response in responses], [1.3] * 8)
+
+
+class ProviderHttpClientTest(TestCase):
+
+    def test_connections_are_reused_per_host(self):
+        client = ProviderHttpClient(timeout=1, retries=0)
+        with StubProviderServer({'good': {'json': {'success': True}}}) as server, StubProviderServer() as other_server:
+            for _ in range(5):
+                self.assertEqual(client.get(server.base_url + '/good/latest').json(), {'success': True})
+            client.get(other_server.base_url + '/good/latest')
+            self.assertEqual(client.get_stats(), {'requests': 6, 'connections': 2, 'reuse_rate': 1 - 2 / 6})
+            self.assertEqual(server.requests_count, 5)
+        client.close()
+
+    def test_retries_with_backoff_and_timeout(self):
+        client = ProviderHttpClient(timeout=0.2, retries=2, backoff_factor=0)
+        with StubProviderServer({'failing': {'status': 500}, 'slow': {'delay': 1}}) as server:
+            self.assertEqual(client.get(server.base_url + '/failing/latest').status_code, 500)
+            self.assertEqual(server.requests_count, 3)
+            # Read timeouts are not retried
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                client.get(server.base_url + '/slow/latest')
+            self.assertEqual(server.requests_count, 4)
+        client.close()
+
 
 from default_app.websocket import GraphConsumer
 import json
 from channels.testing import WebsocketCommunicator
 from channels.routing import URLRouter
+from channels.layers import DEFAULT_CHANNEL_LAYER, channel_layers, get_channel_layer
+from django.test import override_settings
 from django.urls import path
-from asgiref.sync import sync_to_async
+from default_app.local_redis_server import LocalRedisServer, TcpFakeServer
+from my_currency.settings import CHANNEL_LAYERS_REDIS_BACKENDS
+
+
+@sync_to_async
+def upsert_rates(base_currency_code, rates):
+    with TestCase.captureOnCommitCallbacks(execute=True):
+        CurrencyExchangeRate.objects.upsert_rates(base_currency_code, rates)
 
 
 @sync_to_async
 def get_or_create_exchange_rate(curr_from, curr_to, valuation_date, rate):
-    return CurrencyExchangeRate.objects.create(
-        source_currency=Currency.objects.get_or_create(code=curr_from, name=curr_from, symbol=curr_from)[0],
-        exchanged_currency=Currency.objects.get_or_create(code=curr_to, name=curr_to, symbol=curr_to)[0],
-        valuation_date=valuation_date,
-        rate_value=rate
-    )
+    # New rates are broadcast on commit, which the transaction of the test never does
+    with TestCase.captureOnCommitCallbacks(execute=True):
+        return CurrencyExchangeRate.objects.create(
+            source_currency=Currency.objects.get_or_create(code=curr_from, name=curr_from, symbol=curr_from)[0],
+            exchanged_currency=Currency.objects.get_or_create(code=curr_to, name=curr_to, symbol=curr_to)[0],
+            valuation_date=valuation_date,
+            rate_value=rate
+        )
+
+
+class TimeseriesTest(TestCase):
+
+    def test_sorted_slices_and_latest(self):
+        timeseries = Timeseries({'2020-01-03': {'USD': 1.3}, '2020-01-01': {'USD': 1.1}, '2020-01-02': {'USD': 1.2}})
+        self.assertEqual(timeseries.dates, ('2020-01-01', '2020-01-02', '2020-01-03'))
+        self.assertEqual(list(timeseries), ['2020-01-01', '2020-01-02', '2020-01-03'])
+        self.assertEqual(timeseries.slice('2020-01-02', '2100-01-01'), {'2020-01-02': {'USD': 1.2}, '2020-01-03': {'USD': 1.3}})
+        self.assertEqual(timeseries.slice('1900-01-01', '2020-01-01').dates, ('2020-01-01',))
+        self.assertEqual(timeseries.slice('2020-01-03', '2020-01-01'), {})
+        self.assertEqual(timeseries.latest(), {'USD': 1.3})
+        self.assertEqual(Timeseries().latest(), {})
+        self.assertEqual(json.loads(json.dumps(timeseries)), timeseries)
+        self.assertEqual(pickle.loads(pickle.dumps(timeseries)).dates, timeseries.dates)
+
+    def test_validated_and_read_only(self):
+        for rates in [[], {'2020-1-1': {'USD': 1.1}}, {'2020-01-01': 1.1}]:
+            with self.assertRaises(ValueError):
+                Timeseries(rates)
+        timeseries = Timeseries({'2020-01-01': {'USD': 1.1}})
+        with self.assertRaises(TypeError):
+            timeseries['2020-01-02'] = {'USD': 1.2}
+        with self.assertRaises(TypeError):
+            timeseries.update({'2020-01-02': {'USD': 1.2}})
+        self.assertEqual(timeseries.dates, ('2020-01-01',))
+
+    def test_hardcoded_provider_timeseries(self):
+        provider = Provider(name='Hardcoded', historical_hardcoded_json={'success': True, 'rates': {
+            '2020-01-02': {'USD': 1.2}, '2020-01-01': {'USD': 1.1}
+        }})
+        self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-02', '2020-01-31'), {'2020-01-02': {'USD': 1.2}})
+        self.assertEqual(provider.get_latest_rates_dict('EUR'), {'USD': 1.2})
+        self.assertEqual(Provider(name='Broken', historical_hardcoded_json={'success': True, 'rates': []}).get_latest_rates_dict('EUR'), {})
+
+    def test_hardcoded_provider_compiled_once_per_save(self):
+        provider = Provider.objects.create(name='Hardcoded', historical_hardcoded_json={'success': True, 'rates': {
+            '2020-01-01': {'USD': 1.1}, '2020-01-02': {'USD': 1.2}
+        }})
+        with patch('default_app.models.Timeseries', wraps=Timeseries) as mock_timeseries:
+            for _ in range(3):
+                self.assertEqual(Provider.objects.get(name='Hardcoded').get_latest_rates_dict('EUR'), {'USD': 1.2})
+            self.assertEqual(mock_timeseries.call_count, 1)
+            provider.historical_hardcoded_json = {'success': True, 'rates': {'2020-01-03': {'USD': 1.3}}}
+            provider.save()
+            self.assertEqual(Provider.objects.get(name='Hardcoded').get_latest_rates_dict('EUR'), {'USD': 1.3})
+            self.assertEqual(provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-31'), {'2020-01-03': {'USD': 1.3}})
+            self.assertEqual(mock_timeseries.call_count, 2)
+
+
+class ImportExchangeRatesTest(TestCase):
+
+    def test_iter_json_array_in_chunks(self):
+        items = [{'valuation_date': '2020-01-0{}'.format(day), 'rate_value': day / 10, 'text': 'a, ] b'} for day in range(1, 6)]
+        parsed_items = [dict(item, rate_value=Decimal(str(item['rate_value']))) for item in items]
+        for read_size in (1, 7, 1 << 16):
+            self.assertEqual(list(iter_json_array(io.StringIO(json.dumps(items, indent=4)), read_size=read_size)), parsed_items)
+        self.assertEqual(list(iter_json_array(io.StringIO(' [ ] '))), [])
+        for invalid in ('{"a": 1}', '[{"a": 1}', '[{"a": 1},]', '[{"a": 1} {"b": 2}]'):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(invalid), read_size=4))
+
+    def test_iter_json_array_stops_reading_after_an_invalid_item(self):
+        file = io.StringIO('[{"a": 1}, {"a": 1' + ' ' * 1000 + ', {"b": 2}]' * 1000)
+        with self.assertRaisesMessage(ValueError, 'longer than 100 characters'):
+            list(iter_json_array(file, read_size=10, max_item_size=100))
+        self.assertLess(file.tell(), 200)
+
+    def test_rate_values_keep_their_digits(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson') as file:
+            file.write('{"valuation_date": "2023-04-03", "source_currency": "EUR", "exchanged_currency": "USD", "rate_value": 1.123456789012345678}\n')
+            file.flush()
+            self.assertEqual([item['rate_value'] for item in iter_rates(file.name)], [Decimal('1.123456789012345678')])
+
+    def test_import_exchange_rates(self):
+        eur = Currency.objects.create(code="EUR", name="Euro", symbol="€")
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=datetime.strptime('2023-04-03', '%Y-%m-%d'), rate_value=1.3)
+        items = [
+            {'valuation_date': '2023-04-03', 'source_currency': 'EUR', 'exchanged_currency': 'USD', 'rate_value': 1.3},
+            {'valuation_date': '2023-04-03', 'source_currency': 'USD', 'exchanged_currency': 'EUR', 'rate_value': 0.7},
+            {'valuation_date': '2023-04-04', 'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'rate_value': 0.8},
+            {'valuation_date': '2023-04-04', 'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'rate_value': 0.85},
+            {'valuation_date': '2023-04-05', 'source_currency': 'EUR', 'exchanged_currency': 'USD', 'rate_value': 1.35},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as file:
+            json.dump(items, file)
+            file.flush()
+            out = io.StringIO()
+            # Currency map, then per batch: savepoint, existing keys, upsert and release (plus 2 to create GBP)
+            with self.assertNumQueries(1 + 3 * 4 + 2):
+                call_command('import_exchange_rates', file.name, '--batch-size', '2', stdout=out)
+        self.assertIn('Successfully imported 5 exchange rates (2 already existed) from "{}"'.format(file.name), out.getvalue())
+        self.assertIn('rates/s', out.getvalue())
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 4)
+        self.assertEqual(Currency.objects.get(code='GBP').name, '')
+        self.assertEqual(StoredDataProvider().get_rates_dict_timeseries('EUR', '2023-04-01', '2023-04-30'), {
+            '2023-04-03': {'USD': 1.3}, '2023-04-04': {'GBP': 0.85}, '2023-04-05': {'USD': 1.35}
+        })
+
+    def test_csv_and_ndjson_files(self):
+        items = [
+            {'valuation_date': '2023-04-0{}'.format(day), 'source_currency': 'EUR', 'exchanged_currency': code, 'rate_value': day + rate_value}
+            for day in range(1, 8) for code, rate_value in [('USD', 0.1), ('GBP', 0.2)]
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'rates.csv.gz')
+            with gzip.open(csv_path, 'wt') as file:
+                file.write('valuation_date,source_currency,exchanged_currency,rate_value\n')
+                file.writelines('{valuation_date},{source_currency},{exchanged_currency},{rate_value}\n'.format(**item) for item in items)
+            ndjson_path = os.path.join(directory, 'rates.ndjson')
+            with open(ndjson_path, 'w') as file:
+                file.writelines(json.dumps(item) + '\n' for item in items)
+            parsed_items = [dict(item, rate_value=Decimal(str(item['rate_value']))) for item in items]
+            for path in (csv_path, ndjson_path):
+                for workers in (1, 2):
+                    self.assertEqual(list(iter_rates(path, workers=workers, chunk_lines=3)), parsed_items)
+            out = io.StringIO()
+            call_command('import_exchange_rates', csv_path, '--workers', '2', stdout=out)
+            self.assertIn('Successfully imported 14 exchange rates (0 already existed)', out.getvalue())
+            call_command('import_exchange_rates', ndjson_path, stdout=out)
+            self.assertIn('Successfully imported 14 exchange rates (14 already existed)', out.getvalue())
+            self.assertEqual(CurrencyExchangeRate.objects.count(), 14)
+            with open(ndjson_path, 'a') as file:
+                file.write('{"valuation_date": "2023-04-31", "source_currency": "EUR", "exchanged_currency": "USD", "rate_value": 1}\n')
+            with self.assertRaisesMessage(CommandError, 'Invalid exchange rate at line 15'):
+                call_command('import_exchange_rates', ndjson_path, '--workers', '2', stdout=out)
+
+
+class FillDatabaseWithRandomDataTest(TestCase):
+
+    def test_random_walk_batches(self):
+        out = io.StringIO()
+        call_command('fill_database_with_random_data', 'EUR', '10', 'true', '--currencies', '12', '--seed', '1', '--batch-size', '25', stdout=out)
+        self.assertIn('Successfully created 120 exchange rates for 10 days from EUR to 12 currencies', out.getvalue())
+        self.assertEqual(Currency.objects.count(), 13)
+        self.assertEqual(CurrencyExchangeRate.objects.values('valuation_date').distinct().count(), 10)
+        rates = list(CurrencyExchangeRate.objects.order_by('id').values_list('exchanged_currency__code', 'valuation_date', 'rate_value'))
+        self.assertTrue(all(0 < rate_value < 2 for _, _, rate_value in rates))
+        # Same seed, same rates
+        call_command('fill_database_with_random_data', 'EUR', '10', 'true', '--currencies', '12', '--seed', '1', stdout=out)
+        self.assertIn('Successfully cleaned data (120 exchange rates, 13 currencies)', out.getvalue())
+        self.assertEqual(list(CurrencyExchangeRate.objects.order_by('id').values_list('exchanged_currency__code', 'valuation_date', 'rate_value')), rates)
+        # The scaled rates computed for the whole batch are the ones of rate_value
+        self.assertTrue(all(
+            rate_value_scaled == scale_rate(rate_value)
+            for rate_value, rate_value_scaled in CurrencyExchangeRate.objects.values_list('rate_value', 'rate_value_scaled')
+        ))
+        self.assertEqual(rate_matrix.get_rate('EUR', 'USD'), float(CurrencyExchangeRate.objects.filter(exchanged_currency__code='USD').last().rate_value))
+        recent_rates.connect('EUR')
+        self.assertTrue(recent_rates.get_snapshot('EUR', '2000-01-01')[0])
+        call_command('fill_database_with_random_data', 'USD', '3', 'true', stdout=out)
+        # The raw DELETE of the rates invalidates the caches of the process
+        self.assertIsNone(rate_matrix.get_rate('EUR', 'USD'))
+        self.assertEqual(recent_rates.get_snapshot('EUR', '2000-01-01')[0], [])
+        recent_rates.disconnect('EUR')
+        self.assertEqual(sorted(Currency.objects.values_list('code', flat=True)), ['AUD', 'CAD', 'CHF', 'CNY', 'EUR', 'GBP', 'JPY', 'USD'])
+        self.assertEqual(CurrencyExchangeRate.objects.count(), 3 * 7)
+        # Rates that already exist are not written again nor broadcast
+        with patch.object(rate_broadcaster, 'add') as add:
+            call_command('fill_database_with_random_data', 'USD', '4', 'false', stdout=out)
+        self.assertIn('Successfully created 7 exchange rates for 4 days from USD to 7 currencies', out.getvalue())
+        self.assertEqual(len(add.call_args[0][0]), 7)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked with SQLite EXPLAIN QUERY PLAN')
+@patch('default_app.providers.RATE_MATRIX_ENABLED', False)
+class QueryPlanTest(TestCase):
+
+    def setUp(self):
+        derived_rates_cache.invalidate()
+        currencies = [Currency.objects.create(code=code, name=code, symbol=code) for code in ('EUR', 'USD', 'GBP', 'AUD')]
+        CurrencyExchangeRate.objects.bulk_create([
+            CurrencyExchangeRate(source_currency=source_currency, exchanged_currency=exchanged_currency, valuation_date=date(2020, 1, day), rate_value=day)
+            for day in range(1, 29) for source_currency in currencies for exchanged_currency in currencies if source_currency != exchanged_currency
+        ])
+
+    def _get_rate_table_plans(self, function):
+        # EXPLAIN QUERY PLAN of the queries run by function, only the lines about the exchange rates table
+        with CaptureQueriesContext(connection) as context:
+            function()
+        self.assertTrue(context.captured_queries)
+        plans = []
+        for query in context.captured_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                plans.append([row[3] for row in cursor.fetchall() if ' default_app_currencyexchangerate ' in row[3] + ' ' or ' U0 ' in row[3]])
+        return plans
+
+    def assertNoFullScan(self, function, index=None):
+        for plan in self._get_rate_table_plans(function):
+            for line in plan:
+                self.assertFalse(line.startswith('SCAN'), 'Full scan of the exchange rates table: {}'.format(plan))
+        if index:
+            self.assertIn(index, str(self._get_rate_table_plans(function)))
+
+    def test_hot_queries_use_indexes(self):
+        provider = StoredDataProvider()
+        self.assertNoFullScan(lambda: provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-10'), 'COVERING INDEX rate_source_date_cover_idx')
+        self.assertNoFullScan(lambda: list(provider.iter_rates_timeseries('EUR', '1900-01-01', '2100-01-01')), 'COVERING INDEX rate_source_date_cover_idx')
+        self.assertNoFullScan(lambda: provider.get_latest_rates_dict('EUR'))
+        # Queries of a single pair are covered by the same index (the exchanged currency is in it too), and
+        # the newest date of a pair is found with the index of unique_together
+        self.assertNoFullScan(lambda: provider.get_pair_timeseries('EUR', 'USD', '2020-01-01', '2020-01-10'), 'COVERING INDEX rate_source_date_cover_idx')
+        self.assertNoFullScan(lambda: provider.get_pair_aggregates('EUR', 'USD', '2020-01-01', '2020-01-10'), 'COVERING INDEX rate_source_date_cover_idx')
+        self.assertNoFullScan(lambda: CurrencyExchangeRate.objects.latest_rates().filter(source_currency__code='EUR').count(), '_uniq')
+        self.assertNoFullScan(lambda: derived_rates_cache.get_for_period(date(2020, 1, 1), date(2020, 1, 10)))
+        with patch('default_app.models.RATE_READ_SCALED_INTEGERS', True):
+            self.assertNoFullScan(lambda: provider.get_rates_dict_timeseries('EUR', '2020-01-01', '2020-01-10'), 'COVERING INDEX rate_source_date_cover_idx')
+
+    def test_full_scan_is_detected(self):
+        with self.assertRaises(AssertionError):
+            self.assertNoFullScan(lambda: list(CurrencyExchangeRate.objects.filter(rate_value=1)))
+
+
+class RecentRatesBufferTest(TestCase):
+
+    def test_complete_from(self):
+        eur, usd, gbp = (Currency.objects.create(code=code, name=code, symbol=code) for code in ('EUR', 'USD', 'GBP'))
+        for exchanged_currency, day in ((usd, 1), (gbp, 1), (usd, 2), (usd, 3)):
+            CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=exchanged_currency, valuation_date=date(2020, 1, day), rate_value=day)
+        buffer = RecentRatesBuffer(max_size=2)
+        buffer.connect('EUR')
+        # Only the latest 2 rates are loaded, the first day loaded may be missing rates
+        rates, complete = buffer.get_snapshot('EUR', '2020-01-01')
+        self.assertEqual([(rate['exchanged_currency'], rate['valuation_date']) for rate in rates], [('USD', '2020-01-02'), ('USD', '2020-01-03')])
+        self.assertFalse(complete)
+        self.assertTrue(buffer.get_snapshot('EUR', '2020-01-03')[1])
+        # New rates drop the ones updated longest ago
+        buffer.add('EUR', [{'exchanged_currency': 'USD', 'valuation_date': '2020-01-04', 'rate_value': '4'}])
+        self.assertEqual(buffer.get_snapshot('EUR', '2020-01-03'), ([
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-03', 'rate_value': '3.000000'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-04', 'rate_value': '4'},
+        ], True))
+        self.assertFalse(buffer.get_snapshot('EUR', '2020-01-02')[1])
+        # Without connections in the group the process does not receive the new rates, so it is dropped and
+        # loaded from the database again
+        buffer.disconnect('EUR')
+        buffer.add('EUR', [{'exchanged_currency': 'USD', 'valuation_date': '2020-01-05', 'rate_value': '5'}])
+        buffer.connect('EUR')
+        with self.assertNumQueries(1):
+            self.assertEqual([rate['valuation_date'] for rate in buffer.get_snapshot('EUR', '2020-01-03')[0]], ['2020-01-03'])
+
+    def test_pair_buffers(self):
+        eur, usd, gbp = (Currency.objects.create(code=code, name=code, symbol=code) for code in ('EUR', 'USD', 'GBP'))
+        for day in range(1, 4):
+            for exchanged_currency in (usd, gbp):
+                CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=exchanged_currency, valuation_date=date(2020, 1, day), rate_value=day)
+        buffer = RecentRatesBuffer(max_size=4)
+        buffer.connect('EUR')
+        # The buffer of the base currency cannot hold its 6 rates, the one of the pair has its 3
+        self.assertFalse(buffer.get_snapshot('EUR', '2020-01-01')[1])
+        with self.assertNumQueries(1):
+            rates, complete = buffer.get_snapshot('EUR', '2020-01-01', {'USD'})
+        self.assertEqual([(rate['exchanged_currency'], rate['valuation_date']) for rate in rates], [('USD', '2020-01-01'), ('USD', '2020-01-02'), ('USD', '2020-01-03')])
+        self.assertTrue(complete)
+        # Broadcast rates reach the buffer of the base currency and the one of their pair
+        buffer.add('EUR', [
+            {'exchanged_currency': 'USD', 'valuation_date': '2020-01-04', 'rate_value': '4'},
+            {'exchanged_currency': 'GBP', 'valuation_date': '2020-01-04', 'rate_value': '4'},
+        ])
+        with self.assertNumQueries(0):
+            rates, complete = buffer.get_snapshot('EUR', '2020-01-01', {'USD'})
+            self.assertEqual([(rate['exchanged_currency'], rate['valuation_date']) for rate in rates][-1], ('USD', '2020-01-04'))
+            self.assertEqual((len(rates), complete), (4, True))
+            self.assertEqual([rate['exchanged_currency'] for rate in buffer.get_snapshot('EUR', '2020-01-04')[0]], ['USD', 'GBP'])
+
+class RateBroadcasterTest(TestCase):
+
+    def test_rolled_back_rates(self):
+        broadcaster = RateBroadcaster()
+        with patch.object(broadcaster, 'send') as send:
+            with TestCase.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                # The batch is started in a savepoint that is rolled back, the next rates start another one
+                with self.assertRaises(ValueError), transaction.atomic():
+                    broadcaster.add([(1, 2, date(2020, 1, 1), '1')])
+                    raise ValueError()
+                broadcaster.add([(1, 2, date(2020, 1, 2), '2')])
+                with self.assertRaises(ValueError), transaction.atomic():
+                    broadcaster.add([(1, 2, date(2020, 1, 3), '3')])
+                    raise ValueError()
+                broadcaster.add([(1, 2, date(2020, 1, 4), '4')])
+            send.assert_called_once_with([(1, 2, date(2020, 1, 2), '2'), (1, 2, date(2020, 1, 4), '4')])
+            # A rolled back transaction leaves no batch behind
+            with self.assertRaises(ValueError), transaction.atomic():
+                broadcaster.add([(1, 2, date(2020, 1, 5), '5')])
+                raise ValueError()
+            with TestCase.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                broadcaster.add([(1, 2, date(2020, 1, 6), '6')])
+            send.assert_called_with([(1, 2, date(2020, 1, 6), '6')])
 
 
 class WebsocketAccountConnectionTests(APITestCase):
 
     def setUp(self):
         self.maxDiff = None
-        pass
+        rate_matrix.invalidate()
+        derived_rates_cache.invalidate()
+        recent_rates.invalidate()
 
     async def test_websocket_application(self):
         application = URLRouter(
@@ -460,7 +1498,7 @@ class WebsocketAccountConnectionTests(APITestCase):
             {
                 'new_exchange_rate': {
                     'exchanged_currency': 'USD',
-                    'rate_value': '1.11',
+                    'rate_value': '1.110000',
                     'source_currency': 'EUR',
                     'valuation_date': '2020-01-01'
                 }
@@ -477,7 +1515,7 @@ class WebsocketAccountConnectionTests(APITestCase):
             {
                 'new_exchange_rate': {
                     'exchanged_currency': 'AUD',
-                    'rate_value': '2.1234',
+                    'rate_value': '2.123400',
                     'source_currency': 'EUR',
                     'valuation_date': '2018-01-01'
                 }
@@ -486,4 +1524,135 @@ class WebsocketAccountConnectionTests(APITestCase):
         # Check that if currency_from is not EUR, it does not send the event
         await get_or_create_exchange_rate('USD', 'EUR', datetime.strptime('2018-01-01', '%Y-%m-%d'), 2.1234)
         received_nothing = await communicator.receive_nothing(2)
-        self.assertTrue(received_nothing)
\ No newline at end of file
+        self.assertTrue(received_nothing)
+
+    async def test_subscription_options(self):
+        application = URLRouter([path("testws/graph/", GraphConsumer.as_asgi())])
+        for query_string in ('base_currency=', 'base_currency=EUR&max_rate=fast', 'base_currency=EUR&format=xml'):
+            connected, subprotocol = await WebsocketCommunicator(application, "testws/graph/?" + query_string).connect(2)
+            self.assertFalse(connected)
+        communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR&exchanged_currency=USD,GBP&max_rate=2&conflate=true&format=delta")
+        connected, subprotocol = await communicator.connect(2)
+        self.assertTrue(connected)
+        channel_layer = get_channel_layer()
+
+        async def send_rates(*rates):
+            await channel_layer.group_send('EUR', {'type': 'new_exchange_rates', 'new_exchange_rates': [
+                {'source_currency': 'EUR', 'exchanged_currency': exchanged_currency, 'valuation_date': valuation_date, 'rate_value': rate_value}
+                for exchanged_currency, valuation_date, rate_value in rates
+            ]})
+
+        # Only the latest rate of every pair, and not the currencies left out of the subscription
+        await send_rates(('USD', '2020-01-01', '1.1'), ('JPY', '2020-01-01', '150'), ('GBP', '2020-01-01', '0.8'), ('USD', '2020-01-01', '1.2'))
+        self.assertEqual(await communicator.receive_from(2), '{"delta":[["USD","1.2","2020-01-01"],["GBP","0.8","2020-01-01"]]}')
+        # The next frame waits for the end of the half second window; unchanged rates and days are left out
+        await send_rates(('USD', '2020-01-01', '1.3'), ('GBP', '2020-01-01', '0.8'))
+        await send_rates(('USD', '2020-01-01', '1.4'))
+        self.assertTrue(await communicator.receive_nothing(0.1))
+        self.assertEqual(json.loads(await communicator.receive_from(2)), {'delta': [['USD', '1.4']]})
+        await send_rates(('USD', '2020-01-02', '1.5'), ('GBP', '2020-01-01', '0.8'))
+        self.assertEqual(json.loads(await communicator.receive_from(2)), {'delta': [['USD', '1.5', '2020-01-02']]})
+        await communicator.disconnect()
+
+    async def test_snapshot_on_connect(self):
+        application = URLRouter([path("testws/graph/", GraphConsumer.as_asgi())])
+        for day in (1, 2):
+            await get_or_create_exchange_rate('EUR', 'USD', date(2020, 1, day), day)
+        await get_or_create_exchange_rate('EUR', 'GBP', date(2020, 1, 2), '0.8')
+        with patch.object(recent_rates, '_load', wraps=recent_rates._load) as load:
+            communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR&exchanged_currency=USD&snapshot_from=2020-01-02")
+            connected, subprotocol = await communicator.connect(2)
+            self.assertTrue(connected)
+            self.assertEqual(json.loads(await communicator.receive_from(2)), {'snapshot': [
+                {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-02', 'rate_value': '2.000000'},
+            ], 'complete': True})
+            # Rates broadcast to the group are added to the buffer, the next connections to the pair do not read it again
+            await get_or_create_exchange_rate('EUR', 'USD', date(2020, 1, 3), '3.5')
+            await communicator.receive_from(2)
+            delta_communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR&exchanged_currency=USD,GBP&snapshot_from=2020-01-02&format=delta")
+            connected, subprotocol = await delta_communicator.connect(2)
+            self.assertTrue(connected)
+            self.assertEqual(json.loads(await delta_communicator.receive_from(2)), {'snapshot': [
+                ['GBP', '0.800000', '2020-01-02'], ['USD', '2.000000', '2020-01-02'], ['USD', '3.500000', '2020-01-03']
+            ], 'complete': True})
+            # A rate written again is broadcast with the same string as the snapshot, so no delta is sent
+            await upsert_rates('EUR', {'2020-01-03': {'USD': 3.5}})
+            await communicator.receive_from(2)
+            self.assertTrue(await delta_communicator.receive_nothing(1))
+            await delta_communicator.disconnect()
+            await communicator.disconnect()
+            # With the in-memory channel layer the rates saved without connections are added by the broadcaster
+            await get_or_create_exchange_rate('EUR', 'USD', date(2020, 1, 4), 4)
+            communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR&exchanged_currency=USD&snapshot_from=2020-01-04")
+            connected, subprotocol = await communicator.connect(2)
+            self.assertEqual(json.loads(await communicator.receive_from(2))['snapshot'], [
+                {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-04', 'rate_value': '4.000000'},
+            ])
+            await communicator.disconnect()
+            # One buffer per pair, the USD one is loaded once
+            self.assertEqual(load.call_count, 2)
+        connected, subprotocol = await WebsocketCommunicator(application, "testws/graph/?base_currency=EUR&snapshot_from=2020-13-01").connect(2)
+        self.assertFalse(connected)
+
+    @skipUnless(TcpFakeServer, 'fakeredis is not installed')
+    async def test_rates_reach_the_websockets_of_other_processes_through_redis(self):
+        application = URLRouter([path("testws/graph/", GraphConsumer.as_asgi())])
+        with LocalRedisServer() as server, override_settings(CHANNEL_LAYERS={
+            'default': {'BACKEND': CHANNEL_LAYERS_REDIS_BACKENDS['pubsub'], 'CONFIG': {'hosts': [server.url]}}
+        }):
+            communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR")
+            connected, subprotocol = await communicator.connect(2)
+            self.assertTrue(connected)
+            # The rate is saved by another process, with its own channel layer connected to the same server
+            writer_channel_layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+            # Redis subscriptions are not acknowledged
+            await asyncio.sleep(0.2)
+            with patch('default_app.broadcast.get_channel_layer', return_value=writer_channel_layer):
+                await get_or_create_exchange_rate('EUR', 'USD', datetime.strptime('2020-01-01', '%Y-%m-%d'), 1.11)
+            self.assertEqual(json.loads(await communicator.receive_from(2)), {'new_exchange_rate': {
+                'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-01', 'rate_value': '1.110000'
+            }})
+            await communicator.disconnect()
+            await writer_channel_layer.flush()
+            await get_channel_layer().flush()
+
+    async def test_rates_saved_together_are_sent_in_one_message(self):
+        application = URLRouter([path("testws/graph/", GraphConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(application, "testws/graph/?base_currency=EUR")
+        connected, subprotocol = await communicator.connect(2)
+        self.assertTrue(connected)
+
+        @sync_to_async
+        def save_rates():
+            with TestCase.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                eur, usd, gbp = (Currency.objects.create(code=code, name=code, symbol=code) for code in ('EUR', 'USD', 'GBP'))
+                for day in (1, 2):
+                    CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=usd, valuation_date=date(2020, 1, day), rate_value=day)
+                CurrencyExchangeRate.objects.create(source_currency=usd, exchanged_currency=eur, valuation_date=date(2020, 1, 1), rate_value=0.9)
+                # Bulk writes are broadcast too, without loading the currencies of the rates
+                with self.assertNumQueries(1):
+                    CurrencyExchangeRate.objects.bulk_upsert([CurrencyExchangeRate(source_currency_id=eur.id, exchanged_currency_id=gbp.id, valuation_date=date(2020, 1, 1), rate_value='0.8')])
+                # Rolled back rates are not sent
+                with self.assertRaises(ValueError), transaction.atomic():
+                    CurrencyExchangeRate.objects.create(source_currency=eur, exchanged_currency=gbp, valuation_date=date(2020, 1, 2), rate_value=0.85)
+                    raise ValueError()
+
+        await save_rates()
+        self.assertEqual(json.loads(await communicator.receive_from(2)), {'new_exchange_rates': [
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-01', 'rate_value': '1.000000'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'USD', 'valuation_date': '2020-01-02', 'rate_value': '2.000000'},
+            {'source_currency': 'EUR', 'exchanged_currency': 'GBP', 'valuation_date': '2020-01-01', 'rate_value': '0.800000'},
+        ]})
+        self.assertTrue(await communicator.receive_nothing(1))
+
+        @sync_to_async
+        def import_rates():
+            with patch.object(rate_broadcaster, 'max_batch_size', 2), TestCase.captureOnCommitCallbacks(execute=True):
+                call_command('fill_database_with_random_data', 'EUR', '1', 'false', '--currencies', '3', stdout=io.StringIO())
+
+        await import_rates()
+        self.assertEqual(len(json.loads(await communicator.receive_from(2))['new_exchange_rates']), 2)
+        # A single rate is sent as before
+        self.assertEqual(set(json.loads(await communicator.receive_from(2))['new_exchange_rate']), {'source_currency', 'exchanged_currency', 'valuation_date', 'rate_value'})
+        self.assertTrue(await communicator.receive_nothing(1))
+        await communicator.disconnect()
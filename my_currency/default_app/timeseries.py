@@ -0,0 +1,60 @@
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+
+def is_valid_timeseries(rates):
+    # {date_key: {code: rate}} with "yyyy-mm-dd" date keys
+    return bool(
+        isinstance(rates, dict) and
+        all(isinstance(k, str) and len(k) == 10 for k in rates.keys()) and
+        all(isinstance(v, dict) for v in rates.values())
+    )
+
+
+class Timeseries(dict):
+    """
+    Read-only daily rates of a base currency ({date_key: {code: rate}}), ordered by date.
+
+    It is validated once, when built from a raw timeseries, and keeps its date keys in a sorted
+    list: a period is sliced with a bisect and the latest day is the last key. Being a dict, it is
+    serialized (and compared) like the raw timeseries. Slices share the rates of the days, which
+    must not be modified.
+    """
+
+    def __init__(self, rates=None):
+        rates = rates if rates is not None else {}
+        if not is_valid_timeseries(rates):
+            raise ValueError('Rates are not a timeseries of {date_key: {code: rate}}')
+        super().__init__(sorted(rates.items(), key=itemgetter(0)))
+        self._dates = list(dict.keys(self))
+
+    @classmethod
+    def from_sorted_items(cls, items):
+        # (date_key, rates) pairs already validated and ordered by date, e.g. from a sorted DB query
+        timeseries = cls.__new__(cls)
+        dict.__init__(timeseries, items)
+        timeseries._dates = list(dict.keys(timeseries))
+        return timeseries
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Timeseries is read-only')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        # Pickled (e.g. by the cache) as the raw timeseries, since unpickling a dict sets items one by one
+        return (self.__class__, (dict(self),))
+
+    @property
+    def dates(self):
+        return tuple(self._dates)
+
+    def slice(self, date_from, date_to):
+        start, end = bisect_left(self._dates, date_from), bisect_right(self._dates, date_to)
+        return self.from_sorted_items((date_key, dict.__getitem__(self, date_key)) for date_key in self._dates[start:end])
+
+    def latest(self):
+        # Copy of the rates of the newest day, {} if there is none
+        if not self._dates:
+            return {}
+        return dict(dict.__getitem__(self, self._dates[-1]))
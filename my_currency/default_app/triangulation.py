@@ -0,0 +1,149 @@
+from .models import CurrencyExchangeRate
+from .rate_matrix import rate_matrix
+from my_currency.settings import RATE_MATRIX_ENABLED, DERIVED_RATES_CACHE_MAX_DATES
+from collections import defaultdict, deque, OrderedDict
+import threading
+
+
+class DerivedRates:
+    """
+    Inverse and cross rates derivable from the stored rates of a single valuation date.
+
+    Stored rates and their inverses are the edges of the currency graph. The rate from one
+    currency to another is the product of the rates along the shortest path between them
+    (fewest conversions), so a pair sharing a pivot currency with the stored ones is derived
+    through it. Rates from an origin currency are computed once, on first use.
+    """
+
+    def __init__(self, direct_rates):
+        self._graph = defaultdict(dict)
+        for source_currency, rates in direct_rates.items():
+            for exchanged_currency, rate in rates.items():
+                if rate:
+                    self._graph[source_currency][exchanged_currency] = rate
+                    # Stored rates take precedence over inverted ones
+                    self._graph[exchanged_currency].setdefault(source_currency, 1 / rate)
+        self._rates_from = {}
+
+    def rates_from(self, origin_currency):
+        if origin_currency not in self._rates_from:
+            reached = {origin_currency: 1.0}
+            queue = deque([origin_currency])
+            while queue:
+                currency = queue.popleft()
+                for neighbour, rate in self._graph.get(currency, {}).items():
+                    if neighbour not in reached:
+                        reached[neighbour] = reached[currency] * rate
+                        queue.append(neighbour)
+            del reached[origin_currency]
+            self._rates_from[origin_currency] = {code: reached[code] for code in sorted(reached)}
+        return self._rates_from[origin_currency]
+
+
+class DerivedRatesCache:
+    """
+    DerivedRates per valuation date, built from the DB the first time a date is requested
+    and dropped by the CurrencyExchangeRate signals when rates of that date change.
+
+    The periods already requested are kept too, so a period inside one of them is answered
+    without asking the DB for its dates, until a date of the period is dropped.
+    """
+
+    dates_per_query = 500
+
+    def __init__(self, max_dates=DERIVED_RATES_CACHE_MAX_DATES):
+        self.max_dates = max_dates
+        self._lock = threading.RLock()
+        self._derived_rates = OrderedDict()
+        self._periods = []
+        self._version = 0
+        self._latest = (None, None)
+
+    def _drop_periods(self, valuation_date):
+        self._periods = [period for period in self._periods if not period[0] <= valuation_date <= period[1]]
+        self._version += 1
+
+    def invalidate(self, valuation_date=None):
+        with self._lock:
+            if valuation_date is None:
+                self._derived_rates.clear()
+                self._periods = []
+                self._version += 1
+            else:
+                valuation_date = CurrencyExchangeRate._meta.get_field('valuation_date').to_python(valuation_date)
+                self._derived_rates.pop(valuation_date, None)
+                self._drop_periods(valuation_date)
+
+    def get_latest(self):
+        # DerivedRates of the latest rate of every pair, rebuilt when the rate matrix changes
+        if not RATE_MATRIX_ENABLED:
+            direct_rates = defaultdict(dict)
+            for rows, rates in CurrencyExchangeRate.objects.latest_rates().iter_rate_chunks(
+                'source_currency__code', 'exchanged_currency__code'
+            ):
+                for (source_currency, exchanged_currency, _), rate in zip(rows, rates):
+                    direct_rates[source_currency][exchanged_currency] = rate
+            return DerivedRates(direct_rates)
+        version, derived_rates = self._latest
+        if version != rate_matrix.version:
+            version, direct_rates = rate_matrix.snapshot()
+            derived_rates = DerivedRates(direct_rates)
+            self._latest = (version, derived_rates)
+        return derived_rates
+
+    def _load(self, valuation_dates):
+        direct_rates = {valuation_date: defaultdict(dict) for valuation_date in valuation_dates}
+        for start in range(0, len(valuation_dates), self.dates_per_query):
+            for rows, rates in CurrencyExchangeRate.objects.filter(
+                valuation_date__in=valuation_dates[start:start + self.dates_per_query]
+            ).iter_rate_chunks('valuation_date', 'source_currency__code', 'exchanged_currency__code'):
+                for (valuation_date, source_currency, exchanged_currency, _), rate in zip(rows, rates):
+                    direct_rates[valuation_date][source_currency][exchanged_currency] = rate
+        return {valuation_date: DerivedRates(rates) for valuation_date, rates in direct_rates.items()}
+
+    def _get_cached_period(self, date_from, date_to):
+        # Cached dates of the period, or None if it is not inside a period already requested
+        with self._lock:
+            if not any(period_from <= date_from and date_to <= period_to for period_from, period_to in self._periods):
+                return None
+            result = {}
+            for valuation_date in sorted(valuation_date for valuation_date in self._derived_rates if date_from <= valuation_date <= date_to):
+                self._derived_rates.move_to_end(valuation_date)
+                result[valuation_date] = self._derived_rates[valuation_date]
+            return result
+
+    def get_for_period(self, date_from, date_to):
+        # {valuation_date: DerivedRates} for every date with stored rates in the period, sorted by date
+        date_field = CurrencyExchangeRate._meta.get_field('valuation_date')
+        date_from, date_to = date_field.to_python(date_from), date_field.to_python(date_to)
+        result = self._get_cached_period(date_from, date_to)
+        if result is not None:
+            return result
+        with self._lock:
+            version = self._version
+        valuation_dates = list(CurrencyExchangeRate.objects.filter(
+            valuation_date__gte=date_from,
+            valuation_date__lte=date_to
+        ).order_by('valuation_date').values_list('valuation_date', flat=True).distinct())
+        with self._lock:
+            missing_dates = [valuation_date for valuation_date in valuation_dates if valuation_date not in self._derived_rates]
+        loaded = self._load(missing_dates) if missing_dates else {}
+        with self._lock:
+            self._derived_rates.update(loaded)
+            result = {}
+            for valuation_date in valuation_dates:
+                if valuation_date in self._derived_rates:
+                    self._derived_rates.move_to_end(valuation_date)
+                    result[valuation_date] = self._derived_rates[valuation_date]
+                else:
+                    result[valuation_date] = loaded[valuation_date]
+            while len(self._derived_rates) > self.max_dates:
+                evicted_date, _ = self._derived_rates.popitem(last=False)
+                self._drop_periods(evicted_date)
+            # Unless a date was dropped meanwhile, every date of the period is cached now
+            if self._version == version and len(result) <= self.max_dates:
+                self._periods.append((date_from, date_to))
+        return result
+
+
+derived_rates_cache = DerivedRatesCache()
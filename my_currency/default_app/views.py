@@ -1,15 +1,34 @@
 from rest_framework import viewsets, mixins
-from .models import Currency, CurrencyExchangeRate, Provider, SiteConfiguration
+from .models import Currency, CurrencyExchangeRate, SiteConfiguration
 from .serializers import CurrencySerializer, CurrencyExchangeRateSerializer
-from django.http import JsonResponse, HttpResponseBadRequest
-from .providers import MockProvider, StoredDataProvider
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseNotAllowed, StreamingHttpResponse
+from .providers import MockProvider, StoredDataProvider, TriangulatedDataProvider
+from .rate_matrix import rate_matrix
+from .provider_registry import provider_chain_registry
+from .streaming import AsyncStreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from my_currency.settings import RATE_MATRIX_ENABLED, PROVIDER_FANOUT_ENABLED, PROVIDER_FANOUT_MAX_WORKERS, PROVIDER_TIMEOUT_IN_SECONDS, \
+    CONVERSION_BATCH_MAX_ITEMS
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
 from rest_framework.decorators import api_view
+from asgiref.sync import sync_to_async
+import asyncio
 import datetime
+import functools
+import itertools
+import json
+import math
+import numpy as np
+import time
 from django.shortcuts import render
 from rest_framework import status
 from rest_framework.response import Response
 
 
+provider_executor = ThreadPoolExecutor(max_workers=PROVIDER_FANOUT_MAX_WORKERS, thread_name_prefix='provider')
+
+
 class CurrencyViewSet(viewsets.ModelViewSet):
     queryset = Currency.objects.all()
     serializer_class = CurrencySerializer
@@ -83,27 +102,232 @@ class CurrencyExchangeRateViewSet(viewsets.ModelViewSet):
 
 
 def get_sorted_provider_list(provider_name):
-    first_providers = []
-    if provider_name:
-        first_providers.append(Provider.objects.get(name=provider_name))
+    # Resolved from the cached provider chain, without queries. An unknown provider_name is ignored.
+    return _sort_providers(provider_chain_registry.get_providers(), provider_name)
+
+
+async def aget_sorted_provider_list(provider_name):
+    return _sort_providers(await provider_chain_registry.aget_providers(), provider_name)
+
+
+def _sort_providers(providers, provider_name):
+    first_providers = [provider for provider in providers if provider.name == provider_name]
     first_providers.append(StoredDataProvider())
-    return first_providers + list(Provider.objects.exclude(name=provider_name)) + [MockProvider()]
+    first_providers.append(TriangulatedDataProvider())
+    return first_providers + [provider for provider in providers if provider.name != provider_name] + [MockProvider()]
+
+
+def _get_rates_dict_from_provider(provider, source_currency, date_from=None, date_to=None, exchanged_currency=None):
+    if date_from:
+        rates = provider.get_rates_dict_timeseries(source_currency, date_from, date_to)
+        if exchanged_currency and not any(exchanged_currency in day_rates for day_rates in rates.values()):
+            return {}
+        return rates
+    rates = provider.get_latest_rates_dict(source_currency)
+    if exchanged_currency and rates and exchanged_currency not in rates:
+        return {}
+    return rates
+
+
+def _get_rates_dict_or_nothing(provider, *args):
+    # Errors of remote providers (timeouts, bad answers) count as no answer, as in _get_rates_dict_concurrently
+    try:
+        return _get_rates_dict_from_provider(provider, *args)
+    except Exception:
+        if not provider.is_remote:
+            raise
+        return {}
+
+
+def _get_rates_dict_in_worker(provider, *args):
+    # Runs in a thread of provider_executor, which keeps its database connection between calls otherwise
+    try:
+        return _get_rates_dict_from_provider(provider, *args)
+    finally:
+        close_old_connections()
+
+
+def _get_rates_dict_concurrently(providers, *args):
+    # Queries all the given providers at once and returns the answer of the first one (in the
+    # given order) that succeeds before the deadline. Failures and timeouts count as no answer.
+    # Calls still running at the deadline are not stopped (cancel() only drops the ones not started):
+    # they keep their worker until the HTTP client gives up, after PROVIDER_TIMEOUT_IN_SECONDS.
+    futures = [provider_executor.submit(_get_rates_dict_in_worker, provider, *args) for provider in providers]
+    deadline = time.monotonic() + PROVIDER_TIMEOUT_IN_SECONDS
+    try:
+        for future in futures:
+            try:
+                rates = future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception:
+                continue
+            if rates:
+                return rates
+        return {}
+    finally:
+        for future in futures:
+            future.cancel()
 
 
 def get_rates_dict_from_some_provider(provider_name, source_currency, date_from=None, date_to=None, exchanged_currency=None):
-    for provider in get_sorted_provider_list(provider_name):
-        if date_from:
-            rates = provider.get_rates_dict_timeseries(source_currency, date_from, date_to)
-        else:
-            rates = provider.get_latest_rates_dict(source_currency)
-            if exchanged_currency and rates and exchanged_currency not in rates:
-                rates = {}
+    args = (source_currency, date_from, date_to, exchanged_currency)
+    providers = get_sorted_provider_list(provider_name)
+    if PROVIDER_FANOUT_ENABLED:
+        # Local providers are tried one by one, each run of consecutive remote providers concurrently
+        for is_remote, providers_group in itertools.groupby(providers, key=lambda provider: provider.is_remote):
+            if is_remote:
+                rates = _get_rates_dict_concurrently(list(providers_group), *args)
+                if rates:
+                    return rates
+                continue
+            for provider in providers_group:
+                rates = _get_rates_dict_from_provider(provider, *args)
+                if rates:
+                    return rates
+        return {}
+    for provider in providers:
+        rates = _get_rates_dict_or_nothing(provider, *args)
         if rates:
             return rates
     return {}
     # raise ValueError('No provider could provide the rates for {} (exchanged_currency={})'.format(source_currency, exchanged_currency))
 
 
+async def _aget_rates_dict_from_provider(provider, source_currency, date_from=None, date_to=None, exchanged_currency=None):
+    if date_from:
+        rates = await provider.aget_rates_dict_timeseries(source_currency, date_from, date_to)
+        if exchanged_currency and not any(exchanged_currency in day_rates for day_rates in rates.values()):
+            return {}
+        return rates
+    rates = await provider.aget_latest_rates_dict(source_currency)
+    if exchanged_currency and rates and exchanged_currency not in rates:
+        return {}
+    return rates
+
+
+async def _aget_rates_dict_or_nothing(provider, *args):
+    try:
+        return await _aget_rates_dict_from_provider(provider, *args)
+    except Exception:
+        if not provider.is_remote:
+            raise
+        return {}
+
+
+async def _aget_rates_dict_concurrently(providers, *args):
+    # Async version of _get_rates_dict_concurrently: the providers are queried as tasks of the event loop
+    tasks = [asyncio.ensure_future(_aget_rates_dict_from_provider(provider, *args)) for provider in providers]
+    deadline = time.monotonic() + PROVIDER_TIMEOUT_IN_SECONDS
+    try:
+        for task in tasks:
+            try:
+                rates = await asyncio.wait_for(task, timeout=max(0, deadline - time.monotonic()))
+            except Exception:
+                continue
+            if rates:
+                return rates
+        return {}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def aget_rates_dict_from_some_provider(provider_name, source_currency, date_from=None, date_to=None, exchanged_currency=None):
+    # Async version of get_rates_dict_from_some_provider, for the async views
+    args = (source_currency, date_from, date_to, exchanged_currency)
+    providers = await aget_sorted_provider_list(provider_name)
+    if PROVIDER_FANOUT_ENABLED:
+        for is_remote, providers_group in itertools.groupby(providers, key=lambda provider: provider.is_remote):
+            if is_remote:
+                rates = await _aget_rates_dict_concurrently(list(providers_group), *args)
+                if rates:
+                    return rates
+                continue
+            for provider in providers_group:
+                rates = await _aget_rates_dict_from_provider(provider, *args)
+                if rates:
+                    return rates
+        return {}
+    for provider in providers:
+        rates = await _aget_rates_dict_or_nothing(provider, *args)
+        if rates:
+            return rates
+    return {}
+
+
+def iter_rates_from_some_provider(provider_name, source_currency, date_from, date_to):
+    # Same provider order as get_rates_dict_from_some_provider, but returns an iterator
+    # of (date_key, rates) pairs, peeking only the first day to decide which provider answers.
+    for provider in get_sorted_provider_list(provider_name):
+        rates_iterator = provider.iter_rates_timeseries(source_currency, date_from, date_to)
+        try:
+            first_day = next(rates_iterator, None)
+        except Exception:
+            if not provider.is_remote:
+                raise
+            continue
+        if first_day:
+            return itertools.chain([first_day], rates_iterator)
+    return None
+
+
+async def aiter_rates_from_some_provider(provider_name, source_currency, date_from, date_to):
+    # Async version of iter_rates_from_some_provider, returning an async iterator
+    for provider in await aget_sorted_provider_list(provider_name):
+        rates_iterator = provider.aiter_rates_timeseries(source_currency, date_from, date_to)
+        try:
+            first_day = await rates_iterator.__anext__()
+        except StopAsyncIteration:
+            continue
+        except Exception:
+            if not provider.is_remote:
+                raise
+            continue
+        return _achain(first_day, rates_iterator)
+    return None
+
+
+async def _achain(first_item, iterator):
+    yield first_item
+    async for item in iterator:
+        yield item
+
+
+def _stream_rates_json(rates_iterator):
+    # Yields the same document as JsonResponse({'success': True, 'rates': rates}), one day at a time
+    yield '{"success": true, "rates": {'
+    separator = ''
+    for date_key, rates in rates_iterator:
+        yield '{}{}: {}'.format(separator, json.dumps(date_key), json.dumps(rates))
+        separator = ', '
+    yield '}}'
+
+
+async def _astream_rates_json(rates_iterator):
+    yield '{"success": true, "rates": {'
+    separator = ''
+    async for date_key, rates in rates_iterator:
+        yield '{}{}: {}'.format(separator, json.dumps(date_key), json.dumps(rates))
+        separator = ', '
+    yield '}}'
+
+
+def async_api_view(http_method_names):
+    # @api_view for the async views (DRF views are sync only): other methods get a 405
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in http_method_names:
+                return HttpResponseNotAllowed(http_method_names)
+            return await view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _get_min_date(site_configuration):
+    # Read only: without a SiteConfiguration row the period starts at the default min_date
+    return site_configuration.min_date.strftime("%Y-%m-%d") if site_configuration else '1900-01-01'
+
+
 @api_view(['GET'])
 def get_list_of_rates_for_time_period(request):
     data = request.query_params.dict()
@@ -111,16 +335,46 @@ def get_list_of_rates_for_time_period(request):
     date_from = data.get('date_from')
     date_to = data.get('date_to')
     if not date_from:
-        date_from = SiteConfiguration.objects.get().start_date.strftime("%Y-%m-%d")
+        date_from = _get_min_date(SiteConfiguration.objects.first())
     if not date_to:
         date_to = datetime.datetime.now().strftime("%Y-%m-%d")
     provider_name = data.get('provider')
+    if data.get('stream') in ('True', 'true', '1', 'yes'):
+        rates_iterator = iter_rates_from_some_provider(provider_name, source_currency, date_from, date_to)
+        if rates_iterator:
+            return StreamingHttpResponse(_stream_rates_json(rates_iterator), content_type='application/json')
+        return HttpResponseBadRequest('Could not convert the currency')
     rates = get_rates_dict_from_some_provider(provider_name, source_currency, date_from, date_to)
     if rates:
         return JsonResponse({'success': True, 'rates': rates})
     return HttpResponseBadRequest('Could not convert the currency')
 
 
+@async_api_view(['GET'])
+async def aget_list_of_rates_for_time_period(request):
+    data = request.GET.dict()
+    source_currency = data.get('source_currency')
+    date_from = data.get('date_from')
+    date_to = data.get('date_to')
+    if not date_from:
+        date_from = _get_min_date(await SiteConfiguration.objects.afirst())
+    if not date_to:
+        date_to = datetime.datetime.now().strftime("%Y-%m-%d")
+    if data.get('stream') in ('True', 'true', '1', 'yes'):
+        if not isinstance(request, ASGIRequest):
+            # Served by a WSGI server (or the test client), which iterates the sync view's stream in its own thread
+            return await sync_to_async(get_list_of_rates_for_time_period)(request)
+        # Read from the database one chunk at a time, in the thread of the ORM (see AsyncStreamingHttpResponse)
+        rates_iterator = await aiter_rates_from_some_provider(data.get('provider'), source_currency, date_from, date_to)
+        if rates_iterator:
+            return AsyncStreamingHttpResponse(_astream_rates_json(rates_iterator), content_type='application/json')
+        return HttpResponseBadRequest('Could not convert the currency')
+    rates = await aget_rates_dict_from_some_provider(data.get('provider'), source_currency, date_from, date_to)
+    if not rates:
+        return HttpResponseBadRequest('Could not convert the currency')
+    return JsonResponse({'success': True, 'rates': rates})
+
+
 @api_view(['GET'])
 def currency_converter(request):
     data = request.query_params.dict()
@@ -131,12 +385,115 @@ def currency_converter(request):
         return HttpResponseBadRequest('Amount must be a number')
     exchanged_currency = data.get('exchanged_currency')
     provider_name = data.get('provider')
+    if not provider_name and RATE_MATRIX_ENABLED:
+        # Stored data is the first provider when none is given, so its rate can be answered from memory
+        rate = rate_matrix.get_rate(source_currency, exchanged_currency)
+        if rate is not None:
+            return JsonResponse({'success': True, 'value': amount * rate, 'rate': rate})
     rates = get_rates_dict_from_some_provider(provider_name, source_currency, exchanged_currency=exchanged_currency)
     if rates and exchanged_currency in rates:
         return JsonResponse({'success': True, 'value': amount * rates[exchanged_currency], 'rate': rates[exchanged_currency]})
     return HttpResponseBadRequest('Could not convert the currency')
 
 
+@async_api_view(['GET'])
+async def acurrency_converter(request):
+    data = request.GET.dict()
+    source_currency = data.get('source_currency')
+    try:
+        amount = float(data.get('amount') or '1')
+    except ValueError:
+        return HttpResponseBadRequest('Amount must be a number')
+    exchanged_currency = data.get('exchanged_currency')
+    provider_name = data.get('provider')
+    if not provider_name and RATE_MATRIX_ENABLED:
+        rate = await rate_matrix.aget_rate(source_currency, exchanged_currency)
+        if rate is not None:
+            return JsonResponse({'success': True, 'value': amount * rate, 'rate': rate})
+    rates = await aget_rates_dict_from_some_provider(provider_name, source_currency, exchanged_currency=exchanged_currency)
+    if rates and exchanged_currency in rates:
+        return JsonResponse({'success': True, 'value': amount * rates[exchanged_currency], 'rate': rates[exchanged_currency]})
+    return HttpResponseBadRequest('Could not convert the currency')
+
+
+def _get_conversion_items_and_errors(data):
+    # Validated (source_currency, exchanged_currency, amount, date_key or None) of a batch conversion request
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return [], ['items must be a non-empty list.']
+    if len(items) > CONVERSION_BATCH_MAX_ITEMS:
+        return [], ['items cannot have more than {} conversions.'.format(CONVERSION_BATCH_MAX_ITEMS)]
+    conversion_items, errors = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append('items[{}] must be an object.'.format(index))
+            continue
+        for key in ('source_currency', 'exchanged_currency'):
+            if not item.get(key):
+                errors.append('items[{}].{} is required.'.format(index, key))
+        try:
+            amount = float(item.get('amount', 1))
+        except (TypeError, ValueError):
+            errors.append('items[{}].amount {} is not a number.'.format(index, item.get('amount')))
+            continue
+        if not math.isfinite(amount):
+            errors.append('items[{}].amount {} is not a finite number.'.format(index, item.get('amount')))
+            continue
+        date_key = item.get('date')
+        if date_key:
+            try:
+                date_key = datetime.datetime.strptime(date_key, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except (TypeError, ValueError):
+                errors.append('items[{}].date {} is not in the format YYYY-MM-DD.'.format(index, date_key))
+                continue
+        conversion_items.append((item.get('source_currency'), item.get('exchanged_currency'), amount, date_key or None))
+    return conversion_items, errors
+
+
+def _get_batch_rates(provider_name, items):
+    # Rate of every item, or nan. Rates are fetched once per source currency: its latest rates, and
+    # one timeseries covering all the dates asked for it (instead of one provider lookup per item).
+    latest_rates, daily_rates, date_ranges = {}, {}, {}
+    for source_currency, source_items in itertools.groupby(sorted(items, key=lambda item: item[0]), key=lambda item: item[0]):
+        source_items = list(source_items)
+        if any(date_key is None for _, _, _, date_key in source_items):
+            latest_rates[source_currency] = get_rates_dict_from_some_provider(provider_name, source_currency)
+        date_keys = [date_key for _, _, _, date_key in source_items if date_key]
+        if date_keys:
+            date_ranges[source_currency] = (min(date_keys), max(date_keys))
+            daily_rates[source_currency] = get_rates_dict_from_some_provider(provider_name, source_currency, *date_ranges[source_currency])
+    # (source, exchanged, dated) -> answer of the chain for the pair, also when it has nothing
+    pair_rates = {}
+    rates = []
+    for source_currency, exchanged_currency, _, date_key in items:
+        source_rates = daily_rates[source_currency].get(date_key, {}) if date_key else latest_rates[source_currency]
+        rate = source_rates.get(exchanged_currency)
+        if rate is None:
+            # As in currency_converter: the next providers of the chain may have this currency. The chain
+            # is asked once per pair (for all the dates asked for the source currency).
+            key = (source_currency, exchanged_currency, date_key is not None)
+            if key not in pair_rates:
+                date_range = date_ranges[source_currency] if date_key else ()
+                pair_rates[key] = get_rates_dict_from_some_provider(provider_name, source_currency, *date_range, exchanged_currency=exchanged_currency)
+            rate = (pair_rates[key].get(date_key, {}) if date_key else pair_rates[key]).get(exchanged_currency)
+        rates.append(np.nan if rate is None else rate)
+    return np.array(rates, dtype=float)
+
+
+@api_view(['POST'])
+def currency_converter_batch(request):
+    items, errors = _get_conversion_items_and_errors(request.data)
+    if errors:
+        return Response({'errors': errors}, status=status.HTTP_400_BAD_REQUEST)
+    rates = _get_batch_rates(request.data.get('provider'), items)
+    values = np.array([amount for _, _, amount, _ in items], dtype=float) * rates
+    results = [
+        {'success': False, 'error': 'Could not convert the currency'} if np.isnan(rate) else {'success': True, 'value': value, 'rate': rate}
+        for value, rate in zip(values.tolist(), rates.tolist())
+    ]
+    return JsonResponse({'success': True, 'results': results})
+
+
 @api_view(['GET'])
 def currency_converter_for_all_currencies(request):
     data = request.query_params.dict()
@@ -148,6 +505,24 @@ def currency_converter_for_all_currencies(request):
     return HttpResponseBadRequest('Could not convert the currency')
 
 
+@async_api_view(['GET'])
+async def acurrency_converter_for_all_currencies(request):
+    data = request.GET.dict()
+    rates = await aget_rates_dict_from_some_provider(data.get('provider'), data.get('source_currency'))
+    if rates:
+        return JsonResponse({'success': True, 'rates': rates})
+    return HttpResponseBadRequest('Could not convert the currency')
+
+
+def _time_weighted_average(date_keys, values, date_to):
+    # Average of the values weighting each one by the days it holds: until the next day with a value,
+    # and the last one until date_to (included)
+    days = np.array([datetime.date.fromisoformat(date_key).toordinal() for date_key in date_keys])
+    end_day = max(datetime.date.fromisoformat(date_to).toordinal() + 1, days[-1] + 1)
+    weights = np.diff(np.append(days, end_day))
+    return float(np.average(values, weights=weights))
+
+
 @api_view(['GET'])
 def get_time_weighted_exchange(request):
     data = request.query_params.dict()
@@ -162,14 +537,40 @@ def get_time_weighted_exchange(request):
         date_from = '1900-01-01'
     date_to = datetime.datetime.now().strftime("%Y-%m-%d")
     provider_name = data.get('provider')
-    rates = get_rates_dict_from_some_provider(provider_name, source_currency, date_from, date_to)
-    if rates:
-        twrr_dict = {}
-        for date_key in rates:
-            if exchanged_currency in rates[date_key]:
-                twrr_dict[date_key] = amount * rates[date_key][exchanged_currency]
-        return JsonResponse({'success': True, 'values': twrr_dict})
-    return HttpResponseBadRequest('Could not convert the currency')
+    with_aggregates = data.get('aggregates') in ('True', 'true', '1', 'yes')
+    pair_rates, db_aggregates = [], None
+    if not provider_name:
+        # Stored data is the first provider when none is given: only the requested pair is read
+        stored_data_provider = StoredDataProvider()
+        pair_rates = stored_data_provider.get_pair_timeseries(source_currency, exchanged_currency, date_from, date_to)
+        if pair_rates and with_aggregates:
+            db_aggregates = stored_data_provider.get_pair_aggregates(source_currency, exchanged_currency, date_from, date_to)
+    if not pair_rates:
+        rates = get_rates_dict_from_some_provider(provider_name, source_currency, date_from, date_to)
+        if not rates:
+            return HttpResponseBadRequest('Could not convert the currency')
+        pair_rates = [(date_key, day_rates[exchanged_currency]) for date_key, day_rates in rates.items() if exchanged_currency in day_rates]
+    date_keys = [date_key for date_key, _ in pair_rates]
+    values = amount * np.array([rate for _, rate in pair_rates], dtype=float)
+    response = {'success': True, 'values': dict(zip(date_keys, values.tolist()))}
+    if with_aggregates:
+        if not pair_rates:
+            response['aggregates'] = None
+        else:
+            if db_aggregates:
+                mean, minimum, maximum = (amount * db_aggregates[key] for key in ('mean', 'min', 'max'))
+                # Aggregates of the rates: a negative amount turns the min rate into the max value
+                if amount < 0:
+                    minimum, maximum = maximum, minimum
+            else:
+                mean, minimum, maximum = float(values.mean()), float(values.min()), float(values.max())
+            response['aggregates'] = {
+                'mean': mean,
+                'time_weighted_average': _time_weighted_average(date_keys, values, date_to),
+                'min': minimum,
+                'max': maximum,
+            }
+    return JsonResponse(response)
 
 
 
@@ -1,30 +1,135 @@
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import InMemoryChannelLayer
+from urllib.parse import parse_qs
+from datetime import date
+from .recent_rates import recent_rates
+import asyncio
+import json
+import time
+
+
+FRAME_FORMATS = ('full', 'delta')
 
 
 class GraphConsumer(AsyncJsonWebsocketConsumer):
+    """
+    New rates of a base currency: /ws/graph/?base_currency=EUR
+
+    Subscription options of the connection, in the query string:
+    - exchanged_currency=USD,GBP: only the rates to those currencies
+    - max_rate=N: at most N frames per second, the rates that arrive in between are sent in the next frame
+    - conflate=true: only the latest rate of every pair in a frame
+    - format=delta: compact {"delta": [[exchanged_currency, rate_value(, valuation_date)], ...]} frames, that
+      leave out the valuation_date when it is the last one sent for the pair, and rates that did not change
+    - snapshot_from=YYYY-MM-DD: a first {"snapshot": [...], "complete": true} frame with the rates of the
+      subscription from that day on, from the recent rates buffer of the process. complete is false when
+      the buffer does not have all of them (the history must then be requested over HTTP).
+    """
 
     async def connect(self):
-        if 'base_currency' in self.scope.get('query_string').decode('utf-8'):
-            base_currency = self.scope.get('query_string').decode('utf-8').split('=')[1]
-            await self.channel_layer.group_add(
-                base_currency, self.channel_name
-            )
-            await self.accept()
-        else:
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        frame_format = query.get('format', ['full'])[0]
+        try:
+            max_rate = float(query.get('max_rate', ['0'])[0])
+            snapshot_from = query.get('snapshot_from', [''])[0]
+            if snapshot_from:
+                snapshot_from = date.fromisoformat(snapshot_from).isoformat()
+            valid = max_rate >= 0
+        except ValueError:
+            valid = False
+        if not valid or not query.get('base_currency') or frame_format not in FRAME_FORMATS:
             await self.close()
+            return
+        exchanged_currencies = {code for value in query.get('exchanged_currency', []) for code in value.split(',') if code}
+        self.exchanged_currencies = exchanged_currencies or None
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.conflate = query.get('conflate', ['false'])[0] in ('True', 'true', '1', 'yes')
+        self.frame_format = frame_format
+        # Rates waiting for the next frame, and the last rate sent per pair
+        self._pending = []
+        self._sent = {}
+        self._last_frame_at = 0
+        self._flush_task = None
+        self.base_currency = query['base_currency'][0]
+        # Joined before the snapshot is taken, so no rate is missed in between
+        await self.channel_layer.group_add(self.base_currency, self.channel_name)
+        recent_rates.connect(self.base_currency)
+        await self.accept()
+        if snapshot_from:
+            rates, complete = await recent_rates.aget_snapshot(self.base_currency, snapshot_from, self.exchanged_currencies)
+            if self.frame_format == 'delta':
+                rates = self._get_delta_entries(rates)
+            await self.send_json({'snapshot': rates, 'complete': complete})
+
+    async def disconnect(self, code):
+        if getattr(self, '_flush_task', None):
+            self._flush_task.cancel()
+        if getattr(self, 'base_currency', None):
+            # With the in-memory layer the broadcaster adds every new rate to the buffer, connections or not
+            recent_rates.disconnect(self.base_currency, keep_buffer=isinstance(self.channel_layer, InMemoryChannelLayer))
+            await self.channel_layer.group_discard(self.base_currency, self.channel_name)
 
-    async def disconnect(self):
-        pass
+    async def new_exchange_rates(self, event):
+        # Rates saved together (see broadcast.py)
+        await self._add_rates(event['new_exchange_rates'])
 
     async def new_exchange_rate(self, event):
-        await self.send_json(
-            {
-                'new_exchange_rate': event['new_exchange_rate'],
-            },
+        await self._add_rates([event['new_exchange_rate']])
+
+    async def _add_rates(self, rates):
+        recent_rates.add(self.base_currency, rates)
+        self._pending.extend(
+            rate for rate in rates
+            if self.exchanged_currencies is None or rate['exchanged_currency'] in self.exchanged_currencies
         )
+        if not self._pending or self._flush_task:
+            return
+        delay = self._last_frame_at + self.min_interval - time.monotonic()
+        if delay > 0:
+            self._flush_task = asyncio.ensure_future(self._flush_later(delay))
+        else:
+            await self._flush()
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        rates, self._pending = self._pending, []
+        if self.conflate:
+            rates = list({rate['exchanged_currency']: rate for rate in rates}.values())
+        self._last_frame_at = time.monotonic()
+        if self.frame_format == 'delta':
+            entries = self._get_delta_entries(rates)
+            if entries:
+                await self.send_json({'delta': entries})
+        elif len(rates) == 1:
+            # A single rate keeps the new_exchange_rate frame
+            await self.send_json({'new_exchange_rate': rates[0]})
+        else:
+            await self.send_json({'new_exchange_rates': rates})
+
+    def _get_delta_entries(self, rates):
+        entries = []
+        for rate in rates:
+            exchanged_currency, valuation_date, rate_value = rate['exchanged_currency'], rate['valuation_date'], rate['rate_value']
+            last_sent = self._sent.get(exchanged_currency)
+            if last_sent == (valuation_date, rate_value):
+                continue
+            entry = [exchanged_currency, rate_value]
+            if not last_sent or last_sent[0] != valuation_date:
+                entry.append(valuation_date)
+            self._sent[exchanged_currency] = (valuation_date, rate_value)
+            entries.append(entry)
+        return entries
 
     async def receive(self, text_data):
         if text_data == 'ping':
             await self.send_json({
                 'message': 'pong',
             })
+
+    @classmethod
+    async def encode_json(cls, content):
+        return json.dumps(content, separators=(',', ':'))
@@ -9,9 +9,14 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
-django_asgi_app = get_asgi_application()
+django.setup(set_prefix=False)
+
+from default_app.streaming import AsyncStreamingASGIHandler
+
+# get_asgi_application(), with a handler that also streams the async iterators of the async views
+django_asgi_app = AsyncStreamingASGIHandler()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
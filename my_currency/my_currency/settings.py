@@ -96,6 +96,72 @@ if ENV == 'test':
     CACHE_TIME_IN_SECONDS = 5
     DEBUG = True
 
+# Latest stored rates are answered from a process-wide in-memory matrix (default_app/rate_matrix.py)
+# kept up to date by post_save, and loaded again from the database after RATE_MATRIX_MAX_AGE_IN_SECONDS
+# (rates written by other processes are seen then). Disable it to always read the database.
+RATE_MATRIX_ENABLED = os.getenv("RATE_MATRIX_ENABLED", "True") in ("True", "true", "1", "yes")
+RATE_MATRIX_MAX_AGE_IN_SECONDS = 60
+
+# Hot reads of stored rates (timeseries, latest rates) decode rate_value_scaled, the rate as an integer
+# of millionths, a chunk of rows at once instead of a Decimal per row. Rows written with raw SQL must
+# fill rate_value_scaled too (the ORM does it) before enabling it.
+RATE_READ_SCALED_INTEGERS = os.getenv("RATE_READ_SCALED_INTEGERS", "False") in ("True", "true", "1", "yes")
+
+# Triangulated rates are derived per valuation date and cached for at most this many dates (more than the
+# 30 years of daily rates of fill_database_with_random_data, so a full-range request fits)
+DERIVED_RATES_CACHE_MAX_DATES = 20000
+
+# HTTP providers give up after this many seconds. With PROVIDER_FANOUT_ENABLED, consecutive HTTP
+# providers of the chain are queried concurrently and the highest priority successful answer wins.
+PROVIDER_TIMEOUT_IN_SECONDS = 10
+PROVIDER_FANOUT_ENABLED = os.getenv("PROVIDER_FANOUT_ENABLED", "False") in ("True", "true", "1", "yes")
+PROVIDER_FANOUT_MAX_WORKERS = 16
+
+# The provider chain is loaded once per process (default_app/provider_registry.py), and again after
+# PROVIDER_CHAIN_MAX_AGE_IN_SECONDS (providers saved by other processes are seen then)
+PROVIDER_CHAIN_MAX_AGE_IN_SECONDS = 60
+
+# Connections to provider hosts are pooled and kept alive (default_app/http_client.py)
+PROVIDER_HTTP_POOL_SIZE = 10
+PROVIDER_HTTP_RETRIES = 2
+PROVIDER_HTTP_BACKOFF_FACTOR = 0.3
+
+# The /v1/ converter endpoints (calculate-exchange, current-rate-conversion, rates-for-time-period) are
+# async views, using the async ORM and a thread pool for the HTTP requests to the providers
+ASYNC_VIEWS_ENABLED = os.getenv("ASYNC_VIEWS_ENABLED", "True") in ("True", "true", "1", "yes")
+
+# New rates are sent to the websocket clients of their base currency in messages of at most this many rates
+RATE_BROADCAST_MAX_BATCH = 1000
+
+# Websocket groups (/ws/graph/) are kept in the memory of each process, so new rates only reach the clients
+# connected to the process that saved them. With CHANNEL_LAYERS_REDIS_URL (e.g. redis://localhost:6379/0) they
+# go through a Redis-protocol server instead, and any number of daphne processes can serve the websockets.
+# CHANNEL_LAYERS_REDIS_BACKEND is 'pubsub' (one PUBLISH per group message, received by every subscribed
+# process, at most once) or 'core' (messages queued per channel, needs Lua scripting in the server).
+CHANNEL_LAYERS_REDIS_BACKENDS = {
+    'pubsub': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+    'core': 'channels_redis.core.RedisChannelLayer',
+}
+CHANNEL_LAYERS_REDIS_URL = os.getenv("CHANNEL_LAYERS_REDIS_URL")
+CHANNEL_LAYERS_REDIS_BACKEND = os.getenv("CHANNEL_LAYERS_REDIS_BACKEND", "pubsub")
+
+if CHANNEL_LAYERS_REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": CHANNEL_LAYERS_REDIS_BACKENDS[CHANNEL_LAYERS_REDIS_BACKEND],
+            "CONFIG": {"hosts": [CHANNEL_LAYERS_REDIS_URL]},
+        }
+    }
+
+# GraphConsumer sends the snapshot of a new websocket from per-process buffers of the latest
+# RECENT_RATES_PER_BASE rates of each subscribed pair, or of the base currency without exchanged_currency
+# (default_app/recent_rates.py), loaded again from the database after RECENT_RATES_MAX_AGE_IN_SECONDS
+RECENT_RATES_PER_BASE = 10000
+RECENT_RATES_MAX_AGE_IN_SECONDS = 60
+
+# Maximum number of conversions in a request to /v1/calculate-exchange/batch/
+CONVERSION_BATCH_MAX_ITEMS = 10000
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -18,10 +18,17 @@ from django.contrib import admin
 from django.urls import path, re_path, include
 from rest_framework.routers import DefaultRouter
 from default_app.views import CurrencyViewSet, CurrencyExchangeRateViewSet, \
-    get_list_of_rates_for_time_period, currency_converter, get_time_weighted_exchange, currency_converter_for_all_currencies, \
+    get_list_of_rates_for_time_period, currency_converter, currency_converter_batch, get_time_weighted_exchange, currency_converter_for_all_currencies, \
+        aget_list_of_rates_for_time_period, acurrency_converter, acurrency_converter_for_all_currencies, \
         history_conversion_graph_view, current_conversion_view
+from my_currency.settings import ASYNC_VIEWS_ENABLED
 
 
+if ASYNC_VIEWS_ENABLED:
+    get_list_of_rates_for_time_period = aget_list_of_rates_for_time_period
+    currency_converter = acurrency_converter
+    currency_converter_for_all_currencies = acurrency_converter_for_all_currencies
+
 router = DefaultRouter()
 router.register(r'currencies', CurrencyViewSet)
 router.register(r'currency_exchange_rates', CurrencyExchangeRateViewSet)
@@ -37,6 +44,7 @@ urlpatterns = [
     path('history-graph/', history_conversion_graph_view, name='history_conversion_graph'),
     path('current-conversion/', current_conversion_view, name='current_conversion'),
     re_path(r'^v1/rates-for-time-period/', get_list_of_rates_for_time_period),
+    re_path(r'^v1/calculate-exchange/batch/', currency_converter_batch),
     re_path(r'^v1/calculate-exchange/', currency_converter),
     re_path(r'^v1/calculate-exchange-twrr/', get_time_weighted_exchange),
     re_path(r'^v1/current-rate-conversion/', currency_converter_for_all_currencies),